@@ -6,7 +6,7 @@ from hsettings import Settings
 from hsettings.loaders import DictLoader, YamlLoader
 from jumpserver_sync import __prog__, __version__
 from jumpserver_sync.utils import *
-from jumpserver_sync.workflow import DumpSettings, AssetsSync, AssetsSmartSync, AssetsCheckSync, AssetsCleanSync, AssetsListenSync
+from jumpserver_sync.workflow import DumpSettings, CacheWarm, AssetsSync, AssetsSmartSync, AssetsCheckSync, AssetsCleanSync, AssetsListenSync
 
 
 @click.group()
@@ -37,12 +37,28 @@ def dump(**kwargs):
     app.run_workflow(DumpSettings)
 
 
+@cli.command(short_help='Load Jumpserver resources into cache.')
+@click.option('-c', '--config-file', help='config file path', type=click.File('r'))
+@click.option('-h', '--host', help='jumpserver host')
+@click.option('-u', '--user', help='jumpserver admin username')
+@click.option('-w', '--password', help='jumpserver admin password')
+def warm(**kwargs):
+    """
+    Login and load admin users, domains, labels, nodes and system users into cache concurrently.
+
+    Later runs in cache ttl read them from cache.
+    """
+    app = Application(args=kwargs)
+    app.run_workflow(CacheWarm)
+
+
 @cli.command(short_help='Sync assets to Jumpserver.')
 @click.option('-c', '--config-file', help='config file path', type=click.File('r'))
 @click.option('-h', '--host', help='jumpserver host')
 @click.option('-u', '--user', help='jumpserver admin username')
 @click.option('-w', '--password', help='jumpserver admin password')
-@click.option('-p', '--profile', help='profile name')
+@click.option('-p', '--profile', help='profile name or comma separated list')
+@click.option('--all-profiles/--no-all-profiles', help='sync assets of all profiles', default=False)
 @click.option('-i', '--instance-ids', help='instance id or comma separated list')
 @click.option('-e', '--provider', help='instance provider', type=click.Choice(['aws']), default='aws')
 @click.option('--all/--no-all', help='force to sync all assets from provider', default=False)
@@ -55,6 +71,16 @@ def dump(**kwargs):
 @click.option('--push-max-tries', help='max tries to push system_user', type=int)
 @click.option('--push-system-users', help='specify system_users to push, comma separated, default is to push all')
 @click.option('--show-task-log/--no-show-task-log', help='show task output log', default=False)
+@click.option('--preload/--no-preload', help='load Jumpserver resources concurrently before sync', default=False)
+@click.option('--concurrency', help='number of assets to link and sync concurrently', type=int)
+@click.option('--check-concurrency', help='number of assets to push and check concurrently, default is concurrency',
+              type=int)
+@click.option('--queue-size', help='max assets waiting between two sync stages', type=int)
+@click.option('--resume/--no-resume', help='skip assets completed by last interrupted sync if not changed',
+              default=False)
+@click.option('--shard', help='only sync instances in shard i of N by hash of instance id, e.g. 0/4')
+@click.option('--force-write/--no-force-write', help='write all assets even if not changed since last sync',
+              default=False)
 def sync(**kwargs):
     """
     Sync assets from cloud service provider (such as AWS) to Jumpserver.
@@ -63,7 +89,9 @@ def sync(**kwargs):
     If --instance-ids option is specified, only sync assets specified.
     Otherwise, will compare difference between Jumpserver and provider.
     Add assets to Jumpserver if assets produced by provider not exists.
+    Update assets in Jumpserver if hostname, ip, public ip, admin user, domain, labels or nodes are changed.
     And delete assets in Jumpserver if assets not exists in provider.
+    Use comma separated --profile or --all-profiles to sync profiles concurrently in one run.
     """
     app = Application(args=kwargs)
     if app.settings.get(CONF_INSTANCE_ALL_KEY, False) is True:
@@ -94,6 +122,7 @@ def sync(**kwargs):
 @click.option('--push-system-users', help='specify system_users to push, comma separated, default is to push all')
 @click.option('--show-task-log/--no-show-task-log', help='show task output log', default=False)
 @click.option('--listen-interval', help='interval seconds between two check', type=int, default=3)
+@click.option('--preload/--no-preload', help='load Jumpserver resources concurrently before listening', default=False)
 def listen(**kwargs):
     """
     Listening on queues (such as AWS SQS) to sync assets to Jumpserver
@@ -151,11 +180,37 @@ class Application:
             'base_url': '',
             'user': '',
             'password': '',
-            'login_url': '/api/users/v1/auth/'
+            'login_url': '/api/users/v1/auth/',
+            'token_ttl': 3600,
+            'token_refresh_before': 60,
+            'pool_size': 10,
+            'keep_alive': True,
+            'timeout': 30,
+            'page_size': 100,
+            'prefetch': False,
+            'bulk_size': 100,
+            'rate_limit': 0,
+            'rate_burst': None,
+            'max_retries': 3,
+            'backoff_factor': 0.5,
+            'backoff_max': 30,
+            'retry_after_max': 300,
+            'breaker_threshold': 5,
+            'breaker_cooldown': 30
         },
         'cache': {
+            'backend': 'disk',
             'dir': '.jumpserver_cache',
-            'ttl': 60
+            'url': '',
+            'prefix': 'jumpserver_sync:',
+            'ttl': 60,
+            'ttls': {},
+            'memory_size': 1024,
+            'miss_ttl': 30,
+            'payload_ttl': 86400,
+            'mirror': False,
+            'mirror_path': '',
+            'mirror_reconcile_interval': 3600
         },
         'log': {
             'log_level': 'INFO',
@@ -175,6 +230,7 @@ class Application:
         'app': {
             'provider': '',
             'profile': '',
+            'all_profiles': False,
             'instance_all': False,
             'instance_ids': None,
             'push': False,
@@ -188,6 +244,13 @@ class Application:
             'show_task_log': False,
             'listen_provider': '',
             'listen_interval': None,
+            'preload': False,
+            'concurrency': 1,
+            'check_concurrency': None,
+            'queue_size': 100,
+            'resume': False,
+            'shard': None,
+            'force_write': False,
         },
     }
 
@@ -197,6 +260,7 @@ class Application:
         'password': CONF_PWD_KEY,
         'provider': CONF_PROVIDER_KEY,
         'profile': CONF_PROFILE_KEY,
+        'all_profiles': CONF_ALL_PROFILES_KEY,
         'all': CONF_INSTANCE_ALL_KEY,
         'instance_ids': CONF_INSTANCE_IDS_KEY,
         'push': CONF_PUSH_KEY,
@@ -210,6 +274,13 @@ class Application:
         'show_task_log': CONF_SHOW_TASK_LOG_KEY,
         'listen_provider': CONF_LISTEN_PROVIDER_KEY,
         'listen_interval': CONF_LISTEN_INTERVAL_KEY,
+        'preload': CONF_PRELOAD_KEY,
+        'concurrency': CONF_CONCURRENCY_KEY,
+        'check_concurrency': CONF_CHECK_CONCURRENCY_KEY,
+        'queue_size': CONF_QUEUE_SIZE_KEY,
+        'resume': CONF_RESUME_KEY,
+        'shard': CONF_SHARD_KEY,
+        'force_write': CONF_FORCE_WRITE_KEY,
     }
 
     def __init__(self, args):
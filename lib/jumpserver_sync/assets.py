@@ -1,7 +1,17 @@
+import asyncio
+import hashlib
+import json
 import logging
-from jumpserver_sync.utils import JumpserverError
+import threading
+import time
+from jumpserver_sync.utils import JumpserverError, CONF_BULK_SIZE_KEY, CONF_CACHE_MISS_TTL_KEY, CONF_FORCE_WRITE_KEY
 from jumpserver_sync.jumpserver import LabelTag
 from jumpserver_sync.jumpserver.clients import AdminUser, Domain, Label, Node, Asset, SystemUser
+from jumpserver_sync.jumpserver.async_clients import get_runner
+from jumpserver_sync.mirror import AssetMirror, get_mirror
+from jumpserver_sync.cache import LRUCache
+from jumpserver_sync.executor import get_executor
+from jumpserver_sync.payloads import get_payload_store
 
 
 class InstanceAsset:
@@ -107,8 +117,73 @@ class InstanceAsset:
         return None
 
 
+class ResourceIndex:
+    """
+    Hash indexes of resource list, name to id and id to resource.
+    """
+
+    def __init__(self, resources, name_func=None, expires_at=None):
+        """
+
+        :param resources: resource list
+        :param name_func: function to get hashable name of resource, use name field if None
+        :param expires_at: time to refresh index, never expired if None
+        """
+        self.resources = resources
+        self.expires_at = expires_at
+        self.ids = {}
+        self.names = {}
+        for r in resources:
+            if 'id' not in r:
+                continue
+            self.ids[r['id']] = r
+            try:
+                name = name_func(r) if name_func else r['name']
+            except (KeyError, JumpserverError):
+                continue
+            # keep the first one for duplicated names
+            self.names.setdefault(name, r['id'])
+
+    def get_id(self, name):
+        return self.names.get(name)
+
+    def get(self, res_id):
+        return self.ids.get(res_id)
+
+    def is_expired(self, now=None):
+        return self.expires_at is not None and (now or time.monotonic()) >= self.expires_at
+
+
+def label_index_key(label):
+    """
+    Get hashable key of label.
+
+    :param label: LabelTag or label object
+    :return: tuple of key and value
+    """
+    if not isinstance(label, LabelTag):
+        label = LabelTag.create_tag(label)
+    return label.key, label.value
+
+
 class AssetAgent:
 
+    DEFAULT_BULK_SIZE = 100
+    DEFAULT_MISS_TTL = 30
+    MISS_CACHE_SIZE = 1024
+
+    # reference resources to link assets, key, client class and name function of index
+    REFERENCE_RESOURCES = (
+        ('admin_user', AdminUser, None),
+        ('domain', Domain, None),
+        ('label', Label, label_index_key),
+        ('node', Node, None),
+        ('system_user', SystemUser, None)
+    )
+
+    # fields compared to detect changed assets
+    FINGERPRINT_FIELDS = ('hostname', 'ip', 'public_ip', 'admin_user_id', 'domain_id', 'label_ids', 'node_ids')
+
     _check_fields = ['admin_user', 'admin_user_id', 'domain', 'domain_id', 'labels', 'label_ids', 'nodes', 'node_ids']
 
     _attr_maps = {
@@ -121,7 +196,20 @@ class AssetAgent:
     def __init__(self, settings):
         self._settings = settings
         self._client_cache = {}
-        self._list_cache = {}
+        self._index_cache = {}
+        self._index_locks = {}
+        self._lock = threading.Lock()
+        self._executor = get_executor(settings, name='asset')
+        self._mirror = get_mirror(settings)
+        self._miss_ttl = settings.get(CONF_CACHE_MISS_TTL_KEY, None)
+        if self._miss_ttl is None:
+            self._miss_ttl = self.DEFAULT_MISS_TTL
+        self._miss_cache = LRUCache(max_size=self.MISS_CACHE_SIZE)
+        self._missing = {}
+        self._missing_lock = threading.Lock()
+        self._payloads = get_payload_store(settings)
+        self._force_write = settings.get(CONF_FORCE_WRITE_KEY, False) is True
+        self._writes = {'skipped': 0, 'patched': 0}
 
     def is_asset_linked(self, asset):
         """
@@ -143,51 +231,79 @@ class AssetAgent:
         :return: asset
         """
         if asset.admin_user and asset.admin_user_id is None:
-            asset.set_attr('admin_user_id', self.get_admin_user_id(asset.admin_user))
+            asset.set_attr('admin_user_id', self._lookup('Admin user', asset.admin_user, self.get_admin_user_id))
         elif asset.admin_user is None and asset.admin_user_id:
-            asset.set_attr('admin_user', asset.get_admin_user_name(asset.admin_user_id))
+            asset.set_attr('admin_user', self._lookup('Admin user id', asset.admin_user_id,
+                                                      self.get_admin_user_name))
         if asset.domain and asset.domain_id is None:
-            asset.set_attr('domain_id', self.get_domain_id(asset.domain))
+            asset.set_attr('domain_id', self._lookup('Domain', asset.domain, self.get_domain_id))
         elif asset.domain is None and asset.domain_id:
-            asset.set_attr('domain', self.get_domain_name(asset.domain_id))
+            asset.set_attr('domain', self._lookup('Domain id', asset.domain_id, self.get_domain_name))
         if asset.labels and not asset.label_ids:
-            ids = []
-            for l in asset.labels:
-                lid = self.get_label_id(l)
-                if lid is None:
-                    logging.warning('Label {} not found'.format(l))
-                else:
-                    ids.append(lid)
-            asset.set_attr('label_ids', ids)
+            ids = [self._lookup('Label', l, self.get_label_id) for l in asset.labels]
+            asset.set_attr('label_ids', [i for i in ids if i is not None])
         elif not asset.labels and asset.label_ids:
-            lbs = []
-            for lid in asset.label_ids:
-                lb = self.get_label_name(lid)
-                if lb is None:
-                    logging.warning('Label id {} not found'.format(lid))
-                else:
-                    lbs.append(lb)
-            asset.set_attr('labels', lbs)
+            lbs = [self._lookup('Label id', lid, self.get_label_name) for lid in asset.label_ids]
+            asset.set_attr('labels', [lb for lb in lbs if lb is not None])
         if asset.nodes and not asset.node_ids:
-            ids = []
-            for n in asset.nodes:
-                nid = self.get_node_id(n)
-                if nid is None:
-                    logging.warning('Node {} not found'.format(n))
-                else:
-                    ids.append(nid)
-            asset.set_attr('node_ids', ids)
+            ids = [self._lookup('Node', n, self.get_node_id) for n in asset.nodes]
+            asset.set_attr('node_ids', [i for i in ids if i is not None])
         elif not asset.nodes and asset.node_ids:
-            nds = []
-            for nid in asset.nodes:
-                nd = self.get_node_path(nid)
-                if nd is None:
-                    logging.warning('Node id {} not found'.format(nid))
-                else:
-                    nds.append(nd)
-            asset.set_attr('nodes', nds)
+            nds = [self._lookup('Node id', nid, self.get_node_path) for nid in asset.node_ids]
+            asset.set_attr('nodes', [nd for nd in nds if nd is not None])
         return asset
 
+    def report_missing(self):
+        """
+        Log references not found since last report, once for each reference.
+
+        :return: dict of (kind, name) and number of lookups
+        """
+        with self._missing_lock:
+            missing = self._missing
+            self._missing = {}
+        for (kind, name), n in sorted(missing.items()):
+            logging.warning('{} {} not found for {} assets'.format(kind, name, n))
+        return missing
+
+    def report_writes(self):
+        """
+        Log writes skipped or reduced by payload store since last report.
+
+        :return: dict of skipped and patched numbers
+        """
+        with self._lock:
+            writes = self._writes
+            self._writes = {'skipped': 0, 'patched': 0}
+        if writes['skipped'] or writes['patched']:
+            logging.info('Skipped {} unchanged assets, patched {} assets'.format(writes['skipped'], writes['patched']))
+        return writes
+
+    def _count_write(self, kind, n=1):
+        with self._lock:
+            self._writes[kind] += n
+
+    def _lookup(self, kind, name, func):
+        """
+        Look up reference by func, misses are cached for a short time and counted.
+
+        :param kind: reference kind for report
+        :param name: reference name or id
+        :param func: lookup function
+        :return: lookup result, None if not found
+        """
+        key = (kind, str(name))
+        res = None
+        if self._miss_cache.get(key) is None:
+            res = func(name)
+            if res is None and self._miss_ttl:
+                self._miss_cache.set(key, True, expire_at=time.time() + self._miss_ttl)
+        if res is None:
+            logging.debug('{} {} not found'.format(kind, name))
+            with self._missing_lock:
+                self._missing[key] = self._missing.get(key, 0) + 1
+        return res
+
     def sync_asset(self, asset):
         """
         Sync asset to Jumpserver, create if not exists or update if exists.
@@ -211,36 +327,173 @@ class AssetAgent:
         """
         if not self.is_asset_linked(asset):
             asset = self.link_asset(asset)
-        d = asset.to_dict()
-        for k, v in self._attr_maps.items():
-            if k in d:
-                d[v] = d[k]
-                del d[k]
+        d = self.to_jumpserver(asset)
         logging.info('Create asset {}'.format(asset))
         client = self.get_client(key='asset', client_cls=Asset)
         res = client.post_resource(data=d)
+        if res and 'id' in res:
+            self._payloads.put(res['id'], d)
+        self._mirror_put(res)
         return self.from_jumpserver(res)
 
-    def update_asset(self, asset_id, asset):
+    def update_asset(self, asset_id, asset, force=False):
         """
         Update Jumpserver asset.
+        Skip if payload is the same as last written, or update changed fields only, unless force.
 
         :param str asset_id:
         :param InstanceAsset asset:
+        :param force: write full asset without checking payload store
         :return: asset
         """
         if not self.is_asset_linked(asset):
             asset = self.link_asset(asset)
-        d = asset.to_dict()
-        for k, v in self._attr_maps.items():
-            if k in d:
-                d[v] = d[k]
-                del d[k]
-        logging.info('Update asset {}'.format(asset))
+        d = self.to_jumpserver(asset)
+        changed = None if force or self._force_write else self._payloads.diff(asset_id, d)
+        if changed == {}:
+            logging.debug('Skip unchanged asset {}'.format(asset))
+            self._count_write('skipped')
+            asset.set_attr('id', asset_id)
+            return asset
         client = self.get_client(key='asset', client_cls=Asset)
-        res = client.put_resource(res_id=asset_id, data=d)
+        if changed:
+            logging.info('Update fields {} of asset {}'.format(', '.join(sorted(changed)), asset))
+            self._count_write('patched')
+            res = client.patch_resource(res_id=asset_id, data=changed)
+        else:
+            logging.info('Update asset {}'.format(asset))
+            res = client.put_resource(res_id=asset_id, data=d)
+        if res:
+            self._payloads.put(asset_id, d)
+        self._mirror_put(res)
         return self.from_jumpserver(res)
 
+    def bulk_sync_assets(self, assets, batch_size=None):
+        """
+        Sync assets to Jumpserver by bulk requests, create if not exists or update if exists.
+        Fall back to sync one by one if bulk request is rejected.
+
+        :param assets: list of InstanceAsset
+        :param batch_size: assets per bulk request
+        :return: synced assets with id in the same order, None if failed
+        """
+        to_create = []
+        to_update = []
+        # link and find assets concurrently
+        ids = self._executor.map(self._prepare_asset, assets)
+        for i, (asset, aid) in enumerate(zip(assets, ids)):
+            if aid:
+                asset.set_attr('id', aid)
+                to_update.append(i)
+            elif aid is not None:
+                to_create.append(i)
+        return self._bulk_sync(assets, to_create, to_update, batch_size)
+
+    def _prepare_asset(self, asset):
+        """
+        Link asset and get its id.
+
+        :param asset:
+        :return: asset id, or '' if not exists
+        """
+        if not self.is_asset_linked(asset):
+            self.link_asset(asset)
+        return self.get_asset_id(asset) or ''
+
+    def prepare_asset(self, asset):
+        """
+        Link asset and set its id if exists in Jumpserver.
+
+        :param InstanceAsset asset:
+        :return: asset
+        """
+        aid = self._prepare_asset(asset)
+        if aid:
+            asset.set_attr('id', aid)
+        return asset
+
+    def bulk_write_assets(self, assets, batch_size=None, force=False, concurrency=None):
+        """
+        Write prepared assets by bulk requests, update assets with known Jumpserver id and create others.
+
+        :param assets: list of InstanceAsset
+        :param batch_size: assets per bulk request
+        :param force: update assets without checking payload store
+        :param concurrency: max concurrent requests, 1 if caller runs concurrently already
+        :return: written assets in the same order, None if failed
+        """
+        self._executor.map(self.link_asset, [a for a in assets if not self.is_asset_linked(a)],
+                           concurrency=concurrency)
+        to_create = [i for i, a in enumerate(assets) if not a.id]
+        to_update = [i for i, a in enumerate(assets) if a.id]
+        return self._bulk_sync(assets, to_create, to_update, batch_size, force=force, concurrency=concurrency)
+
+    def _bulk_sync(self, assets, to_create, to_update, batch_size=None, force=False, concurrency=None):
+        batch_size = batch_size or self.settings.get(CONF_BULK_SIZE_KEY, None) or self.DEFAULT_BULK_SIZE
+        if not self.get_client(key='asset', client_cls=Asset).bulk_supported:
+            # sync one by one concurrently
+            batch_size = 1
+        results = [None] * len(assets)
+        if not force and not self._force_write:
+            # assets written with the same payload last time are not written again
+            unchanged = [i for i in to_update
+                         if self._payloads.diff(assets[i].id, self.to_jumpserver(assets[i])) == {}]
+            for i in unchanged:
+                results[i] = assets[i]
+            if unchanged:
+                self._count_write('skipped', len(unchanged))
+                to_update = [i for i in to_update if results[i] is None]
+        batches = []
+        for indexes, create in ((to_create, True), (to_update, False)):
+            for n in range(0, len(indexes), batch_size):
+                batches.append((indexes[n:n + batch_size], create))
+        synced = self._executor.map(
+            lambda b: self._bulk_sync_batch([assets[i] for i in b[0]], create=b[1], force=force), batches,
+            concurrency=concurrency)
+        for (batch, _), res in zip(batches, synced):
+            for i, a in zip(batch, res or []):
+                results[i] = a
+        return results
+
+    def _bulk_sync_batch(self, assets, create, force=False):
+        """
+        Sync one batch of linked assets.
+
+        :param assets:
+        :param create: create or update
+        :param force: update assets without checking payload store
+        :return: synced assets in the same order, None if failed
+        """
+        client = self.get_client(key='asset', client_cls=Asset)
+        res = None
+        data = []
+        if client.bulk_supported and len(assets) > 1:
+            data = [self.to_jumpserver(a) for a in assets]
+            logging.info('{} {} assets in bulk'.format('Create' if create else 'Update', len(assets)))
+            res = client.bulk_post_resources(data=data) if create else client.bulk_put_resources(data=data)
+        if res is None:
+            # bulk rejected, sync one by one
+            if create:
+                return [self.create_asset(asset=a) for a in assets]
+            return [self.update_asset(asset_id=a.id, asset=a, force=force) for a in assets]
+        # map returned ids back to assets
+        ids = {}
+        for r in res:
+            if 'id' in r:
+                ids[r.get('number') or r.get('hostname')] = r['id']
+                self._mirror_put(r)
+        synced = []
+        for a, d in zip(assets, data):
+            aid = ids.get(a.number or a.hostname)
+            if aid:
+                a.set_attr('id', aid)
+                self._payloads.put(aid, d)
+                synced.append(a)
+            else:
+                logging.error('Asset {} not found in bulk response'.format(a))
+                synced.append(None)
+        return synced
+
     def delete_asset(self, asset_id):
         """
         Delete Jumpserver asset.
@@ -250,20 +503,78 @@ class AssetAgent:
         """
         logging.info('Delete asset {}'.format(asset_id))
         client = self.get_client(key='asset', client_cls=Asset)
-        return client.delete_resource(res_id=asset_id)
+        res = client.delete_resource(res_id=asset_id)
+        if res:
+            # payload of deleted asset must not be compared with asset created again
+            self._payloads.delete(asset_id)
+            if self._mirror:
+                self._mirror.delete(asset_id)
+        return res
 
-    def list_assets(self):
+    def list_assets(self, page_size=None):
         """
-        List Jumpserver assets.
+        List Jumpserver assets page by page.
 
+        :param page_size: assets per page, use configured page size if None
         :return: assets generator
         """
         client = self.get_client(key='asset', client_cls=Asset)
-        for res in client.list_resources():
+        for res in client.iter_resources(page_size=page_size):
             a = self.from_jumpserver(res)
             if a:
                 yield a
 
+    def fingerprint(self, asset):
+        """
+        Get fingerprint of linked asset fields synced to Jumpserver.
+
+        :param InstanceAsset asset:
+        :return: str
+        """
+        data = []
+        for f in self.FINGERPRINT_FIELDS:
+            v = getattr(asset, f)
+            if isinstance(v, (list, tuple)):
+                v = sorted(str(i) for i in v)
+            data.append(v or None)
+        return hashlib.sha1(json.dumps(data).encode('utf-8')).hexdigest()
+
+    def select_assets(self, numbers=None, meta=None):
+        """
+        Select Jumpserver assets by numbers and meta data in comment, from mirror if enabled.
+
+        :param numbers: asset numbers
+        :param dict meta: meta data in comment, e.g. {'account': 'account1'}
+        :return: assets generator
+        """
+        if self._mirror:
+            self.sync_mirror()
+            fields = {k: v for k, v in (meta or {}).items() if k in AssetMirror.INDEXED_FIELDS}
+            assets = (self.from_jumpserver(r) for r in self._mirror.select(numbers=numbers, **fields))
+        else:
+            assets = self.list_assets()
+        numbers = set(numbers) if numbers else None
+        for a in assets:
+            if numbers is not None and a.number not in numbers:
+                continue
+            if meta:
+                comment = a.extract_comment() or {}
+                if any(k not in comment or comment[k] != v for k, v in meta.items()):
+                    continue
+            yield a
+
+    def sync_mirror(self, force=False):
+        """
+        Reconcile mirror with Jumpserver assets if mirror is stale.
+
+        :param force: reconcile even if not stale
+        :return: number of reconciled assets, None if not reconciled
+        """
+        if not self._mirror or not (force or self._mirror.is_stale()):
+            return None
+        client = self.get_client(key='asset', client_cls=Asset)
+        return self._mirror.reconcile(self._mirror_row(r) for r in client.iter_resources() if 'id' in r)
+
     def check_assets_alive(self, asset_id, timeout=30, interval=3, show_output=False):
         """
         Check asset is alive or not.
@@ -275,8 +586,21 @@ class AssetAgent:
         :param show_output:
         :return:
         """
+        return self.submit_asset_alive(asset_id=asset_id, timeout=timeout, interval=interval,
+                                       show_output=show_output).result()
+
+    def submit_asset_alive(self, asset_id, timeout=30, interval=3, show_output=False):
+        """
+        Start task to check asset alive, the task is tracked by task monitor together with others.
+
+        :param asset_id:
+        :param timeout:
+        :param interval:
+        :param show_output:
+        :return: Future of whether asset is alive
+        """
         cli = self.get_client(key='asset', client_cls=Asset)
-        return cli.is_alive(asset_id=asset_id, timeout=timeout, interval=interval, show_output=show_output)
+        return cli.submit_alive(asset_id=asset_id, timeout=timeout, interval=interval, show_output=show_output)
 
     def push_system_users(self, asset_id, system_users=None):
         """
@@ -287,19 +611,8 @@ class AssetAgent:
         :return:
         """
         cli = self.get_client('system_user', SystemUser)
-        if system_users:
-            # push specified system_users
-            if isinstance(system_users, str):
-                system_users = system_users.split(',')
-            ids = []
-            for u in system_users:
-                ids.append(self.get_system_user_id(u))
-            system_users = ids
-        else:
-            # push all exists system_users
-            system_users = [u['id'] for u in cli.list_resources()]
         task_ids = []
-        for uid in system_users:
+        for uid in self.get_system_user_ids(system_users):
             res = cli.push(uid=uid, asset_id=asset_id)
             if 'task' in res:
                 task_ids.append(res['task'])
@@ -320,33 +633,84 @@ class AssetAgent:
         :param force_push:
         :return:
         """
+        return self.push_check_assets(
+            asset_ids=[asset_id],
+            system_users=system_users,
+            timeout=timeout,
+            interval=interval,
+            show_output=show_output,
+            max_tries=max_tries,
+            force_push=force_push
+        )
+
+    def push_check_assets(self, asset_ids, system_users=None, timeout=30, interval=3, show_output=False,
+                          max_tries=3, force_push=False):
+        """
+        Push and check specified system_user or all to many assets.
+        Tasks of each round are started together and waited together, then system_users not connective are pushed
+        again in next round.
+
+        :param asset_ids:
+        :param system_users:
+        :param timeout:
+        :param interval:
+        :param show_output:
+        :param max_tries:
+        :param force_push: push without checking first
+        :return: dict of (asset_id, uid) to whether system_user is connective
+        """
         cli = self.get_client('system_user', SystemUser)
-        if system_users:
-            # push specified system_users
-            if isinstance(system_users, str):
-                system_users = system_users.split(',')
-            ids = []
-            for u in system_users:
-                ids.append(self.get_system_user_id(u))
-            system_users = ids
-        else:
-            # push all exists system_users
-            system_users = [u['id'] for u in cli.list_resources()]
-        for uid in system_users:
-            res = cli.push_checked(
-                uid=uid,
-                asset_id=asset_id,
-                timeout=timeout,
-                interval=interval,
-                show_output=show_output,
-                max_tries=max_tries,
-                force_push=force_push
-            )
+        kwargs = {'timeout': timeout, 'interval': interval, 'show_output': show_output}
+        pending = [(a, u) for a in asset_ids for u in self.get_system_user_ids(system_users)]
+        results = {}
+        check_first = not force_push
+        tries = 0
+        while pending and tries < max_tries:
+            if check_first:
+                checks = [(p, cli.submit_check(uid=p[1], asset_id=p[0], **kwargs)) for p in pending]
+                for p, f in checks:
+                    if f.result() is True:
+                        results[p] = True
+                pending = [p for p in pending if p not in results]
+                if not pending:
+                    break
+            # checked again after pushed, no need to check before next push
+            check_first = False
+            pushes = [cli.submit_push(uid=p[1], asset_id=p[0], **kwargs) for p in pending]
+            for f in pushes:
+                f.result()
+            checks = [(p, cli.submit_check(uid=p[1], asset_id=p[0], **kwargs)) for p in pending]
+            for p, f in checks:
+                res = f.result()
+                if res is not False:
+                    # None if system_user can not be pushed to asset, do not try again
+                    results[p] = res is True
+            pending = [p for p in pending if p not in results]
+            tries += 1
+        for p in pending:
+            logging.error('Push system_user {} failed to asset {} because reach max tries {}'
+                          .format(p[1], p[0], max_tries))
+            results[p] = False
+        for (asset_id, uid), res in results.items():
             uname = self.get_system_user_name(uid)
             if res:
                 logging.info('Successfully pushed system user {} to asset {}'.format(uname, asset_id))
             else:
                 logging.error('Failed to push {} to asset {}'.format(uname, asset_id))
+        return results
+
+    def get_system_user_ids(self, system_users=None):
+        """
+        Get ids of specified system_users or all.
+
+        :param system_users: list or comma separated names, all system_users if empty
+        :return: list of ids
+        """
+        if system_users:
+            if isinstance(system_users, str):
+                system_users = system_users.split(',')
+            return [self.get_system_user_id(u) for u in system_users]
+        return [u['id'] for u in self._get_resource_list(key='system_user', client_cls=SystemUser)]
 
     def get_asset_id(self, asset):
         """
@@ -355,6 +719,10 @@ class AssetAgent:
         :param asset:
         :return: asset id
         """
+        if self._mirror:
+            self.sync_mirror()
+            res = self._mirror.get(asset.id) if asset.id else self._mirror.find(hostname=asset.hostname)
+            return res['id'] if res else None
         client = self.get_client(key='asset', client_cls=Asset)
         if asset.id:
             res = client.get_resource(res_id=asset.id)
@@ -368,6 +736,20 @@ class AssetAgent:
             else:
                 return None
 
+    def to_jumpserver(self, asset):
+        """
+        Get Jumpserver asset data from InstanceAsset.
+
+        :param InstanceAsset asset:
+        :return: dict
+        """
+        d = asset.to_dict()
+        for k, v in self._attr_maps.items():
+            if k in d:
+                d[v] = d[k]
+                del d[k]
+        return d
+
     def from_jumpserver(self, asset):
         """
         Get InstanceAsset from Jumpserver asset.
@@ -377,11 +759,21 @@ class AssetAgent:
         """
         if not asset:
             return None
+        # resources may be shared by other callers, do not modify
+        asset = dict(asset)
         for k, v in self._attr_maps.items():
             asset[k] = asset[v]
             del asset[v]
         return InstanceAsset(**asset)
 
+    def _mirror_row(self, res):
+        meta = InstanceAsset(comment=res.get('comment')).extract_comment() or {}
+        return res, meta.get('account'), meta.get('region')
+
+    def _mirror_put(self, res):
+        if self._mirror and res and 'id' in res:
+            self._mirror.put(*self._mirror_row(res))
+
     def get_client(self, key, client_cls):
         """
         Get Jumpserver client by key.
@@ -390,51 +782,35 @@ class AssetAgent:
         :param client_cls:
         :return: client
         """
-        if key in self._client_cache:
-            client = self._client_cache[key]
-        else:
-            client = client_cls(self.settings)
-            self._client_cache[key] = client
+        client = self._client_cache.get(key)
+        if client is None:
+            with self._lock:
+                client = self._client_cache.get(key)
+                if client is None:
+                    client = client_cls(self.settings)
+                    self._client_cache[key] = client
         return client
 
     def get_system_user_id(self, name):
         if not name:
             return None
-        res = self._get_resource_list(key='system_user', client_cls=SystemUser)
-        for r in res:
-            if r['name'] == name:
-                return r['id']
-        return None
+        return self._get_resource_index(key='system_user', client_cls=SystemUser).get_id(name)
 
     def get_admin_user_id(self, name):
         if not name:
             return None
-        res = self._get_resource_list(key='admin_user', client_cls=AdminUser)
-        for r in res:
-            if r['name'] == name:
-                return r['id']
-        return None
+        return self._get_resource_index(key='admin_user', client_cls=AdminUser).get_id(name)
 
     def get_domain_id(self, name):
         if not name:
             return None
-        res = self._get_resource_list(key='domain', client_cls=Domain)
-        for r in res:
-            if r['name'] == name:
-                return r['id']
-        return None
+        return self._get_resource_index(key='domain', client_cls=Domain).get_id(name)
 
     def get_label_id(self, label):
         if not label:
             return None
-        if not isinstance(label, LabelTag):
-            label = LabelTag.create_tag(label)
-        res = self._get_resource_list(key='label', client_cls=Label)
-        for r in res:
-            rlabel = LabelTag.create_tag(r)
-            if rlabel == label:
-                return r['id']
-        return None
+        return self._get_resource_index(key='label', client_cls=Label,
+                                        name_func=label_index_key).get_id(label_index_key(label))
 
     def get_node_id(self, name):
         if not name:
@@ -444,20 +820,20 @@ class AssetAgent:
         return nid
 
     def get_system_user_name(self, res_id):
-        res = self._get_resource_by_id(key='system_user', res_id=res_id, client_cls=SystemUser)
+        res = self._get_resource_index(key='system_user', client_cls=SystemUser).get(res_id)
         return res['name'] if res and 'name' in res else None
 
     def get_admin_user_name(self, res_id):
-        res = self._get_resource_by_id(key='admin_user', res_id=res_id, client_cls=AdminUser)
+        res = self._get_resource_index(key='admin_user', client_cls=AdminUser).get(res_id)
         return res['name'] if res and 'name' in res else None
 
     def get_domain_name(self, res_id):
-        res = self._get_resource_by_id(key='domain', res_id=res_id, client_cls=Domain)
+        res = self._get_resource_index(key='domain', client_cls=Domain).get(res_id)
         return res['name'] if res and 'name' in res else None
 
     def get_label_name(self, res_id):
-        res = self._get_resource_by_id(key='label', res_id=res_id, client_cls=Label)
-        return LabelTag.create_tag(res)
+        res = self._get_resource_index(key='label', client_cls=Label, name_func=label_index_key).get(res_id)
+        return LabelTag.create_tag(res) if res else None
 
     def get_node_path(self, res_id):
         if not res_id:
@@ -466,6 +842,21 @@ class AssetAgent:
         n = client.get_node_full_name(res_id)
         return n
 
+    def warm_resource(self, key):
+        """
+        Load reference resource into cache and index.
+
+        :param key: resource key in REFERENCE_RESOURCES
+        :return: number of resources
+        """
+        for k, client_cls, name_func in self.REFERENCE_RESOURCES:
+            if k != key:
+                continue
+            if client_cls is Node:
+                return len(self.get_client(key=key, client_cls=Node).get_tree().keys)
+            return len(self._get_resource_index(key=key, client_cls=client_cls, name_func=name_func).resources)
+        raise ValueError('Invalid reference resource {}'.format(key))
+
     def _get_resource_list(self, key, client_cls):
         """
         Get resource list.
@@ -476,30 +867,145 @@ class AssetAgent:
         """
         if not key:
             return []
-        if key in self._list_cache:
-            res = self._list_cache[key]
-        else:
-            client = self.get_client(key=key, client_cls=client_cls)
-            res = client.list_resources()
-            self._list_cache[key] = res
-        return res
+        return self._get_resource_index(key=key, client_cls=client_cls).resources
 
-    def _get_resource_by_id(self, key, res_id, client_cls):
+    def _get_resource_index(self, key, client_cls, name_func=None):
         """
-        Get resource by id.
+        Get resource index, rebuild it after cache ttl of resource.
 
         :param key: resource key
-        :param res_id: resource id
         :param client_cls: client class
-        :return: resource
+        :param name_func: function to get hashable name of resource
+        :return: ResourceIndex
+        """
+        index = self._index_cache.get(key)
+        if index is not None and not index.is_expired():
+            return index
+        with self._lock:
+            lock = self._index_locks.setdefault(key, threading.Lock())
+        # only one worker rebuilds index, others wait for it
+        with lock:
+            index = self._index_cache.get(key)
+            if index is None or index.is_expired():
+                client = self.get_client(key=key, client_cls=client_cls)
+                ttl = client.ttl
+                index = ResourceIndex(client.list_resources(), name_func=name_func,
+                                      expires_at=time.monotonic() + ttl if ttl else None)
+                self._index_cache[key] = index
+        return index
+
+    @property
+    def mirror(self):
+        return self._mirror
+
+    @property
+    def executor(self):
+        return self._executor
+
+    @property
+    def settings(self):
+        return self._settings
+
+
+class AsyncAssetAgent:
+    """
+    Asyncio version of AssetAgent, operations of assets run concurrently up to the connection pool size.
+    """
+
+    def __init__(self, settings, agent=None):
         """
-        if not key:
-            return None
-        if not res_id:
-            return None
-        client = self.get_client(key=key, client_cls=client_cls)
-        res = client.get_resource(res_id=res_id)
-        return res
+
+        :param settings:
+        :param AssetAgent agent: synchronized agent to wrap
+        """
+        self._settings = settings
+        self._agent = agent or AssetAgent(settings=settings)
+        self._runner = get_runner(settings)
+
+    async def sync_asset(self, asset):
+        """
+        Sync asset to Jumpserver, create if not exists or update if exists.
+
+        :param InstanceAsset asset:
+        :return: asset
+        """
+        return await self._runner.run(self._agent.sync_asset, asset)
+
+    async def delete_asset(self, asset_id):
+        """
+        Delete Jumpserver asset.
+
+        :param asset_id:
+        :return:
+        """
+        return await self._runner.run(self._agent.delete_asset, asset_id)
+
+    async def push_system_users(self, asset_id, system_users=None):
+        """
+        Push system_user to asset async.
+
+        :param asset_id:
+        :param system_users:
+        :return: task ids
+        """
+        return await self._runner.run(self._agent.push_system_users, asset_id, system_users=system_users)
+
+    async def preload(self):
+        """
+        Login and load all reference resources concurrently, log time of each resource.
+
+        :return: dict of resource key and seconds
+        """
+        async def timed(key, func, *args):
+            start = time.monotonic()
+            res = await self._runner.run(func, *args)
+            cost = time.monotonic() - start
+            logging.info('Preload {} in {:.3f}s, {} resources'.format(key, cost, res))
+            return key, cost
+
+        start = time.monotonic()
+        # login first so that all requests share one token
+        token = await self._runner.run(self._agent.get_client(key='asset', client_cls=Asset).get_token)
+        costs = {'token': time.monotonic() - start}
+        logging.info('Preload token in {:.3f}s'.format(costs['token']))
+        if not token:
+            raise JumpserverError('Failed to login into Jumpserver')
+        tasks = [timed(k, self._agent.warm_resource, k) for k, _, _ in AssetAgent.REFERENCE_RESOURCES]
+        if self._agent.mirror:
+            tasks.append(timed('asset mirror', lambda: self._agent.sync_mirror() or self._agent.mirror.count()))
+        costs.update(await asyncio.gather(*tasks))
+        logging.info('Preload finished in {:.3f}s'.format(time.monotonic() - start))
+        return costs
+
+    async def delete_assets(self, asset_ids):
+        """
+        Delete assets concurrently.
+
+        :param asset_ids:
+        :return: results in the same order
+        """
+        return await asyncio.gather(*[self.delete_asset(aid) for aid in asset_ids])
+
+    async def push_assets(self, assets, system_users=None):
+        """
+        Push system_users to assets concurrently.
+
+        :param assets:
+        :param system_users:
+        :return: task ids of each asset
+        """
+        async def push(a):
+            if system_users:
+                logging.info('Push system users {} to asset {}'.format(system_users, a))
+            else:
+                logging.info('Push all system users to asset {}'.format(a))
+            return await self.push_system_users(asset_id=a.id, system_users=system_users)
+
+        return await asyncio.gather(*[push(a) for a in assets])
+
+    @property
+    def agent(self):
+        return self._agent
 
     @property
     def settings(self):
@@ -0,0 +1,423 @@
+import json
+import logging
+import socket
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+from diskcache import Cache
+from jumpserver_sync.utils import JumpserverError, CacheBackendError, CONF_CACHE_DIR_KEY, CONF_CACHE_TTL_KEY, \
+    CONF_CACHE_MEMORY_SIZE_KEY, CONF_CACHE_BACKEND_KEY, CONF_CACHE_URL_KEY, CONF_CACHE_PREFIX_KEY
+
+
+class LRUCache:
+    """
+    Bounded in-memory cache with expire time for each key.
+    """
+
+    def __init__(self, max_size=1024):
+        """
+
+        :param max_size: max keys in cache
+        """
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expire_at = item
+            if expire_at is not None and expire_at <= time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, expire_at=None):
+        with self._lock:
+            self._data[key] = (value, expire_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DiskBackend:
+    """
+    Cache backend on local directory by diskcache, shared by processes on the same host.
+    """
+
+    def __init__(self, directory):
+        """
+
+        :param directory: cache directory
+        """
+        self.directory = directory
+        self._cache = Cache(directory)
+
+    def get(self, key):
+        """
+        Get value and its expire time.
+
+        :param key:
+        :return: tuple of value and expire timestamp, value is _missing if not found
+        """
+        return self._cache.get(key, default=_missing, expire_time=True)
+
+    def set(self, key, value, expire=None):
+        self._cache.set(key, value, expire=expire or None)
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+    def incr(self, key, delta=1):
+        return self._cache.incr(key, delta=delta, default=0)
+
+    def clear(self):
+        self._cache.clear()
+
+    def close(self):
+        self._cache.close()
+
+
+class RespClient:
+    """
+    Minimal client of Redis serialization protocol (RESP).
+    """
+
+    def __init__(self, host='127.0.0.1', port=6379, db=0, password=None, timeout=5):
+        """
+
+        :param host:
+        :param port:
+        :param db: database number
+        :param password:
+        :param timeout: socket timeout seconds
+        """
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def execute(self, *args):
+        """
+        Execute one command.
+
+        :param args: command and arguments
+        :return: reply
+        """
+        return self.pipeline([args])[0]
+
+    def pipeline(self, commands):
+        """
+        Send commands in one round trip, reconnect and retry once if connection is lost.
+
+        :param commands: list of command arguments
+        :return: list of replies
+        """
+        with self._lock:
+            try:
+                return self._pipeline(commands)
+            except (OSError, EOFError):
+                self._disconnect()
+                return self._pipeline(commands)
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+    def _pipeline(self, commands):
+        if self._sock is None:
+            self._connect()
+        try:
+            self._sock.sendall(b''.join(self._encode(c) for c in commands))
+            replies = [self._read() for _ in commands]
+        except (OSError, EOFError):
+            self._disconnect()
+            raise
+        for r in replies:
+            if isinstance(r, CacheBackendError):
+                raise r
+        return replies
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._file = self._sock.makefile('rb')
+        commands = []
+        if self.password:
+            commands.append(('AUTH', self.password))
+        if self.db:
+            commands.append(('SELECT', self.db))
+        if commands:
+            self._sock.sendall(b''.join(self._encode(c) for c in commands))
+            for _ in commands:
+                r = self._read()
+                if isinstance(r, CacheBackendError):
+                    self._disconnect()
+                    raise r
+
+    def _disconnect(self):
+        if self._sock is not None:
+            try:
+                self._file.close()
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._file = None
+
+    @staticmethod
+    def _encode(args):
+        parts = [b'*' + str(len(args)).encode() + b'\r\n']
+        for a in args:
+            if not isinstance(a, bytes):
+                a = str(a).encode('utf-8')
+            parts.append(b'$' + str(len(a)).encode() + b'\r\n' + a + b'\r\n')
+        return b''.join(parts)
+
+    def _read(self):
+        line = self._file.readline()
+        if not line.endswith(b'\r\n'):
+            raise EOFError('Connection closed by {}:{}'.format(self.host, self.port))
+        kind, data = line[:1], line[1:-2]
+        if kind == b'+':
+            return data.decode('utf-8')
+        if kind == b'-':
+            return CacheBackendError(data.decode('utf-8'))
+        if kind == b':':
+            return int(data)
+        if kind == b'$':
+            n = int(data)
+            if n < 0:
+                return None
+            value = self._file.read(n + 2)
+            if len(value) != n + 2:
+                raise EOFError('Connection closed by {}:{}'.format(self.host, self.port))
+            return value[:-2]
+        if kind == b'*':
+            n = int(data)
+            return None if n < 0 else [self._read() for _ in range(n)]
+        raise CacheBackendError('Invalid reply {}'.format(line))
+
+
+class RedisBackend:
+    """
+    Cache backend on Redis protocol server, shared by processes on all hosts.
+    Values are encoded as JSON, errors are logged and treated as cache miss.
+    """
+
+    DEFAULT_PREFIX = 'jumpserver_sync:'
+
+    def __init__(self, client, prefix=None):
+        """
+
+        :param RespClient client:
+        :param prefix: key prefix
+        """
+        self.client = client
+        self.prefix = self.DEFAULT_PREFIX if prefix is None else prefix
+
+    @classmethod
+    def from_url(cls, url, prefix=None):
+        """
+        Create backend by url, e.g. redis://:password@127.0.0.1:6379/0.
+
+        :param url:
+        :param prefix: key prefix
+        :return: RedisBackend
+        """
+        u = urlparse(url)
+        if u.scheme != 'redis':
+            raise JumpserverError('Invalid redis url {}'.format(url))
+        db = u.path.strip('/')
+        client = RespClient(host=u.hostname or '127.0.0.1', port=u.port or 6379, db=int(db) if db else 0,
+                            password=u.password)
+        return cls(client=client, prefix=prefix)
+
+    def get(self, key):
+        k = self.prefix + key
+        try:
+            value, pttl = self.client.pipeline([('GET', k), ('PTTL', k)])
+        except (OSError, EOFError, CacheBackendError) as e:
+            logging.warning('Failed to get cache {}: {}'.format(key, e))
+            return _missing, None
+        if value is None:
+            return _missing, None
+        return json.loads(value.decode('utf-8')), time.time() + pttl / 1000 if pttl > 0 else None
+
+    def set(self, key, value, expire=None):
+        args = ['SET', self.prefix + key, json.dumps(value)]
+        if expire:
+            args += ['PX', max(int(expire * 1000), 1)]
+        self._execute(key, *args)
+
+    def delete(self, key):
+        self._execute(key, 'DEL', self.prefix + key)
+
+    def incr(self, key, delta=1):
+        return self._execute(key, 'INCRBY', self.prefix + key, delta)
+
+    def clear(self):
+        cursor = '0'
+        while True:
+            res = self._execute('*', 'SCAN', cursor, 'MATCH', self.prefix + '*', 'COUNT', 500)
+            if not res:
+                return
+            cursor, keys = res[0].decode('utf-8'), res[1]
+            if keys:
+                self._execute('*', 'DEL', *keys)
+            if cursor == '0':
+                return
+
+    def close(self):
+        self.client.close()
+
+    def _execute(self, key, *args):
+        try:
+            return self.client.execute(*args)
+        except (OSError, EOFError, CacheBackendError) as e:
+            logging.warning('Failed to {} cache {}: {}'.format(args[0], key, e))
+            return None
+
+
+class TieredCache:
+    """
+    Long-lived cache owned by process, bounded in-memory LRU in front of a shared backend.
+    """
+
+    def __init__(self, directory=None, memory_size=1024, ttl=60, backend=None):
+        """
+
+        :param directory: diskcache directory, only memory is used if None
+        :param memory_size: max keys in memory
+        :param ttl: default expire seconds
+        :param backend: shared backend, DiskBackend on directory if None
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.memory = LRUCache(max_size=memory_size)
+        if backend is None and directory:
+            backend = DiskBackend(directory)
+        self.backend = backend
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get value from memory, or from backend and keep it in memory until expired.
+
+        :param key:
+        :param default:
+        :return: value
+        """
+        val = self.memory.get(key, default=_missing)
+        if val is not _missing:
+            return val
+        if self.backend is None:
+            return default
+        val, expire_at = self.backend.get(key)
+        if val is _missing:
+            return default
+        if expire_at is None:
+            # keys never expire, e.g. list versions, are changed by other processes, always read from backend
+            return val
+        self.memory.set(key, val, expire_at=expire_at)
+        return val
+
+    def set(self, key, value, expire=None):
+        """
+        Set value in memory and backend, value never expire is only kept in backend if any.
+
+        :param key:
+        :param value:
+        :param expire: expire seconds, use default ttl if None, never expire if 0
+        :return:
+        """
+        expire = self.ttl if expire is None else expire
+        if expire or self.backend is None:
+            self.memory.set(key, value, expire_at=time.time() + expire if expire else None)
+        else:
+            self.memory.delete(key)
+        if self.backend is not None:
+            self.backend.set(key, value, expire=expire or None)
+
+    def delete(self, key):
+        self.memory.delete(key)
+        if self.backend is not None:
+            self.backend.delete(key)
+
+    def incr(self, key, delta=1):
+        """
+        Increase counter atomically in backend.
+
+        :param key:
+        :param delta:
+        :return: new value
+        """
+        if self.backend is not None:
+            self.memory.delete(key)
+            return self.backend.incr(key, delta=delta)
+        with self._lock:
+            val = self.memory.get(key, 0) + delta
+            self.memory.set(key, val)
+            return val
+
+    def clear(self):
+        self.memory.clear()
+        if self.backend is not None:
+            self.backend.clear()
+
+    def close(self):
+        if self.backend is not None:
+            self.backend.close()
+
+
+_missing = object()
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(settings):
+    """
+    Get process-wide cache for cache backend configured in settings.
+
+    :param settings:
+    :return: TieredCache
+    """
+    backend = settings.get(CONF_CACHE_BACKEND_KEY, None) or 'disk'
+    if backend == 'memory':
+        key = (backend, )
+    elif backend == 'disk':
+        key = (backend, settings.get(CONF_CACHE_DIR_KEY, '.jumpserver_dir'))
+    elif backend == 'redis':
+        url = settings.get(CONF_CACHE_URL_KEY, None)
+        if not url:
+            raise JumpserverError('Invalid cache url {}'.format(url))
+        key = (backend, url, settings.get(CONF_CACHE_PREFIX_KEY, None))
+    else:
+        raise JumpserverError('Invalid cache backend {}'.format(backend))
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = TieredCache(
+                directory=key[1] if backend == 'disk' else None,
+                memory_size=settings.get(CONF_CACHE_MEMORY_SIZE_KEY, None) or 1024,
+                ttl=settings.get(CONF_CACHE_TTL_KEY, 60),
+                backend=RedisBackend.from_url(key[1], prefix=key[2]) if backend == 'redis' else None
+            )
+        return _caches[key]
@@ -0,0 +1,97 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from jumpserver_sync.utils import CONF_CONCURRENCY_KEY
+
+
+class ConcurrentExecutor:
+    """
+    Run function for each item by a bounded worker pool.
+    Results are kept in the same order as items, errors are collected instead of stopping other items.
+    """
+
+    DEFAULT_CONCURRENCY = 1
+
+    def __init__(self, concurrency=None, name='item'):
+        """
+
+        :param concurrency: max workers, run in current thread if 1
+        :param name: item name in logs
+        """
+        self.concurrency = max(concurrency or self.DEFAULT_CONCURRENCY, 1)
+        self.name = name
+        self._lock = threading.Lock()
+        self.errors = []
+
+    def map(self, func, items, concurrency=None):
+        """
+        Call func for each item.
+
+        :param func: function with one item argument
+        :param items: iterable of items
+        :param concurrency: max workers of this call, default is concurrency of executor
+        :return: results in the same order, None for failed items
+        """
+        items = list(items)
+        results = [None] * len(items)
+        concurrency = min(concurrency or self.concurrency, self.concurrency)
+        if concurrency == 1 or len(items) < 2:
+            for i, item in enumerate(items):
+                results[i] = self._call(func, item)
+            return results
+        pool = ThreadPoolExecutor(max_workers=min(concurrency, len(items)))
+        futures = {}
+        try:
+            for i, item in enumerate(items):
+                futures[pool.submit(self._call, func, item)] = i
+            pending = set(futures)
+            while pending:
+                # wait with timeout so that KeyboardInterrupt is handled in time
+                done, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                for f in done:
+                    results[futures[f]] = f.result()
+        except KeyboardInterrupt:
+            cancelled = len([f for f in futures if f.cancel()])
+            logging.warning('Interrupted, {} {}s cancelled, waiting for running ones to finish'.format(
+                cancelled, self.name))
+            raise
+        finally:
+            pool.shutdown(wait=True)
+        return results
+
+    def report_errors(self):
+        """
+        Log collected errors grouped by error message, and clear them.
+
+        :return: list of (item, exception)
+        """
+        with self._lock:
+            errors = self.errors
+            self.errors = []
+        groups = {}
+        for _, e in errors:
+            msg = '{}: {}'.format(type(e).__name__, e)
+            groups[msg] = groups.get(msg, 0) + 1
+        for msg, n in sorted(groups.items(), key=lambda x: -x[1]):
+            logging.error('{} {}s failed with {}'.format(n, self.name, msg))
+        return errors
+
+    def _call(self, func, item):
+        try:
+            return func(item)
+        except Exception as e:
+            logging.debug('Failed to process {} {}: {}'.format(self.name, item, e))
+            with self._lock:
+                self.errors.append((item, e))
+            return None
+
+
+def get_executor(settings, name='item'):
+    """
+    Get executor by concurrency configured in settings.
+
+    :param settings:
+    :param name: item name in logs
+    :return: ConcurrentExecutor
+    """
+    return ConcurrentExecutor(concurrency=settings.get(CONF_CONCURRENCY_KEY, None), name=name)
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from jumpserver_sync.utils import CONF_CACHE_DIR_KEY, CONF_BASE_URL_KEY, CONF_PROVIDER_KEY, CONF_PROFILE_KEY, \
+    CONF_ALL_PROFILES_KEY, CONF_INSTANCE_IDS_KEY, CONF_PUSH_KEY, CONF_TEST_ASSET_KEY, CONF_PUSH_CHECK_KEY, \
+    CONF_SHARD_KEY
+
+
+class SyncJournal:
+    """
+    Progress journal of one sync plan, records assets completed so that an interrupted sync can be resumed.
+    The first line is the plan fingerprint, each following line is the number and digest of one completed asset.
+    Assets are skipped on resume only if they are not changed in provider since completed.
+    """
+
+    DIGEST_SIZE = 16
+    # journals not written for this long are removed
+    MAX_AGE = 7 * 86400
+
+    def __init__(self, path, plan):
+        """
+
+        :param path: journal file, nothing is recorded if None
+        :param plan: plan fingerprint
+        """
+        self.path = path
+        self.plan = plan
+        self._completed = {}
+        self._digests = {}
+        self._file = None
+        self._lock = threading.Lock()
+
+    def open(self, resume=False):
+        """
+        Load completed assets if resume and plan is not changed, otherwise start a new journal.
+
+        :param resume:
+        :return: self
+        """
+        if self.path is None:
+            return self
+        if resume:
+            self._completed = self._load()
+            if self._completed:
+                logging.info('Resume sync, {} assets completed before are skipped if not changed'.format(
+                    len(self._completed)))
+        # rewrite journal, so that duplicated and partly written lines are dropped
+        self._file = open(self.path, 'w', encoding='utf-8')
+        self._write({'plan': self.plan})
+        for number, digest in self._completed.items():
+            self._write([number, digest])
+        return self
+
+    def is_completed(self, asset):
+        """
+        Check whether asset is completed and not changed since then.
+
+        :param asset: InstanceAsset selected by provider
+        :return: bool
+        """
+        digest = self.digest(asset)
+        with self._lock:
+            self._digests[asset.number] = digest
+            return self._completed.get(asset.number) == digest
+
+    def complete(self, asset):
+        """
+        Record asset as completed.
+
+        :param asset:
+        :return:
+        """
+        with self._lock:
+            digest = self._digests.pop(asset.number, None)
+            if digest is None:
+                return
+            self._completed[asset.number] = digest
+            self._write([asset.number, digest])
+
+    def finish(self):
+        """
+        Remove journal after all assets are completed.
+
+        :return:
+        """
+        self.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def digest(self, asset):
+        """
+        Digest of asset fields produced by provider.
+
+        :param asset: InstanceAsset
+        :return: str
+        """
+        data = {}
+        for k, v in asset.to_dict().items():
+            if isinstance(v, (list, tuple)):
+                v = sorted(str(i) for i in v)
+            data[k] = v
+        digest = hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        return digest[:self.DIGEST_SIZE]
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        completed = {}
+        with open(self.path, encoding='utf-8') as f:
+            for i, line in enumerate(f):
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # last line may be partly written if killed
+                    continue
+                if i == 0:
+                    if not isinstance(rec, dict) or rec.get('plan') != self.plan:
+                        logging.info('Sync plan is changed, start over')
+                        return {}
+                    continue
+                completed[rec[0]] = rec[1]
+        return completed
+
+    def _write(self, rec):
+        if self._file is None:
+            return
+        self._file.write(json.dumps(rec, separators=(',', ':')) + '\n')
+        self._file.flush()
+
+    def __len__(self):
+        return len(self._completed)
+
+
+def plan_fingerprint(settings, name):
+    """
+    Fingerprint of sync plan by workflow and settings that decide what is synced.
+
+    :param settings:
+    :param name: workflow name
+    :return: str
+    """
+    ins = settings.get(CONF_INSTANCE_IDS_KEY, None)
+    plan = [
+        name,
+        settings.get(CONF_BASE_URL_KEY, None),
+        settings.get(CONF_PROVIDER_KEY, None),
+        settings.get(CONF_PROFILE_KEY, None),
+        settings.get(CONF_ALL_PROFILES_KEY, False),
+        sorted(ins.split(',')) if ins else None,
+        settings.get(CONF_SHARD_KEY, None),
+        settings.get(CONF_PUSH_KEY, False),
+        settings.get(CONF_TEST_ASSET_KEY, False),
+        settings.get(CONF_PUSH_CHECK_KEY, False),
+    ]
+    return hashlib.sha1(json.dumps(plan).encode('utf-8')).hexdigest()
+
+
+def get_journal(settings, name, resume=False):
+    """
+    Open journal for sync plan in cache directory.
+
+    :param settings:
+    :param name: workflow name
+    :param resume: load completed assets
+    :return: SyncJournal
+    """
+    plan = plan_fingerprint(settings, name)
+    cache_dir = settings.get(CONF_CACHE_DIR_KEY, '.jumpserver_dir') or '.'
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, 'journal-{}.jsonl'.format(plan[:SyncJournal.DIGEST_SIZE]))
+    remove_stale_journals(cache_dir, keep=path)
+    return SyncJournal(path=path, plan=plan).open(resume=resume)
+
+
+def remove_stale_journals(cache_dir, keep=None, max_age=None):
+    """
+    Remove journals of interrupted syncs which are not resumed for a long time.
+
+    :param cache_dir:
+    :param keep: journal file to keep
+    :param max_age: seconds since last written
+    :return: number of removed journals
+    """
+    max_age = SyncJournal.MAX_AGE if max_age is None else max_age
+    now = time.time()
+    n = 0
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if not (name.startswith('journal-') and name.endswith('.jsonl')) or path == keep:
+            continue
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+                n += 1
+        except OSError as e:
+            logging.warning('Failed to remove journal {}: {}'.format(path, e))
+    return n
@@ -0,0 +1,66 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from jumpserver_sync.jumpserver.transport import get_transport
+
+
+class AsyncRunner:
+    """
+    Run blocking client calls in a thread pool, one worker for each connection of the transport pool.
+    """
+
+    def __init__(self, pool_size):
+        """
+
+        :param pool_size: connection pool size of transport
+        """
+        self.pool_size = pool_size
+        self._executor = ThreadPoolExecutor(max_workers=pool_size)
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run func in thread pool.
+
+        :param func: blocking function
+        :param args:
+        :param kwargs:
+        :return: func result
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+_runners = {}
+_runners_lock = threading.Lock()
+
+
+def get_runner(settings):
+    """
+    Get shared runner sized by the pool of Jumpserver transport configured in settings.
+
+    :param settings:
+    :return: AsyncRunner
+    """
+    pool_size = get_transport(settings).pool_size
+    with _runners_lock:
+        if pool_size not in _runners:
+            _runners[pool_size] = AsyncRunner(pool_size=pool_size)
+        return _runners[pool_size]
+
+
+def run_coroutine(coro):
+    """
+    Run coroutine in a new event loop until complete.
+
+    :param coro:
+    :return: coroutine result
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
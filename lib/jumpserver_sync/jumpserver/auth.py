@@ -0,0 +1,167 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from jumpserver_sync.utils import JumpserverAuthError, CONF_BASE_URL_KEY, CONF_LOGIN_URL_KEY, \
+    CONF_USER_KEY, CONF_PWD_KEY, CONF_TOKEN_TTL_KEY, CONF_TOKEN_REFRESH_KEY
+from jumpserver_sync.jumpserver.transport import get_transport
+from jumpserver_sync.jumpserver.codec import loads
+from jumpserver_sync.cache import get_cache
+
+
+class TokenManager:
+    """
+    Keep Jumpserver token in memory and refresh it before expired.
+    Token is also saved in cache to share between processes.
+    """
+
+    CACHE_TOKEN_KEY = 'jms_token'
+    DATE_EXPIRED_FORMAT = '%Y/%m/%d %H:%M:%S %z'
+    DEFAULT_TOKEN_TTL = 3600
+    DEFAULT_REFRESH_BEFORE = 60
+
+    def __init__(self, settings):
+        """
+
+        :param settings:
+        """
+        self.settings = settings
+        self.base_url = self.settings.get(CONF_BASE_URL_KEY) or ''
+        self.transport = get_transport(self.settings)
+        self.token_ttl = self.settings.get(CONF_TOKEN_TTL_KEY, None) or self.DEFAULT_TOKEN_TTL
+        self.refresh_before = self.settings.get(CONF_TOKEN_REFRESH_KEY, None)
+        if self.refresh_before is None:
+            self.refresh_before = self.DEFAULT_REFRESH_BEFORE
+        self.cache = get_cache(self.settings)
+        self._lock = threading.Lock()
+        self._token = None
+        self._issued_at = 0
+        self._expires_at = 0
+
+    def get_token(self):
+        """
+        Get valid token, login if token is not available or will be expired soon.
+
+        :return: token
+        """
+        token = self._token
+        if token and self.is_valid():
+            return token
+        with self._lock:
+            if self._token and self.is_valid():
+                return self._token
+            if not self._load_shared():
+                self._login()
+            return self._token
+
+    def invalidate(self, token=None):
+        """
+        Invalidate token, e.g. when server responds 401.
+
+        :param token: only invalidate if current token is the same one
+        :return:
+        """
+        with self._lock:
+            if token is not None and token != self._token:
+                # already refreshed by others
+                return
+            self._token = None
+            self._issued_at = 0
+            self._expires_at = 0
+            shared = self.cache.get(self.CACHE_TOKEN_KEY)
+            if isinstance(shared, dict) and (token is None or shared.get('token') == token):
+                self.cache.delete(self.CACHE_TOKEN_KEY)
+
+    def is_valid(self, now=None):
+        """
+        Check whether token is valid and not expired soon.
+
+        :param now:
+        :return: bool
+        """
+        now = now or time.time()
+        return self._token is not None and now < self._expires_at - self.refresh_before
+
+    @property
+    def issued_at(self):
+        return self._issued_at
+
+    @property
+    def expires_at(self):
+        return self._expires_at
+
+    def _load_shared(self):
+        """
+        Load token shared by other processes.
+
+        :return: bool
+        """
+        shared = self.cache.get(self.CACHE_TOKEN_KEY)
+        if not isinstance(shared, dict) or 'token' not in shared:
+            return False
+        self._set_token(token=shared['token'], issued_at=shared['issued_at'], expires_at=shared['expires_at'])
+        return self.is_valid()
+
+    def _login(self):
+        login_url = self.settings.get(CONF_LOGIN_URL_KEY)
+        if not login_url:
+            raise JumpserverAuthError('Invalid login url {}'.format(login_url))
+        user = self.settings.get(CONF_USER_KEY)
+        pwd = self.settings.get(CONF_PWD_KEY)
+        logging.debug('Login into Jumpserver by user {}'.format(user))
+        issued_at = time.time()
+        res = self.transport.request(
+            method='post',
+            url=self.base_url.rstrip('/') + login_url,
+            json={'username': user, 'password': pwd}
+        )
+        if res.status_code != 200:
+            logging.error('Login failed {}'.format(res.text))
+            self._set_token(token=None, issued_at=0, expires_at=0)
+            return
+        res = loads(res.content)
+        token = res['token'] if 'token' in res else None
+        if not token:
+            self._set_token(token=None, issued_at=0, expires_at=0)
+            return
+        expires_at = issued_at + self.token_ttl
+        server_expires_at = self._parse_date_expired(res.get('date_expired'))
+        if server_expires_at:
+            expires_at = min(expires_at, server_expires_at)
+        self._set_token(token=token, issued_at=issued_at, expires_at=expires_at)
+        self.cache.set(
+            self.CACHE_TOKEN_KEY,
+            {'token': token, 'issued_at': issued_at, 'expires_at': expires_at},
+            expire=max(expires_at - issued_at, 1)
+        )
+
+    def _set_token(self, token, issued_at, expires_at):
+        self._issued_at = issued_at
+        self._expires_at = expires_at
+        self._token = token
+
+    def _parse_date_expired(self, date_expired):
+        if not date_expired:
+            return None
+        try:
+            return datetime.strptime(date_expired, self.DATE_EXPIRED_FORMAT).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_token_manager(settings):
+    """
+    Get shared token manager for Jumpserver and user configured in settings.
+
+    :param settings:
+    :return: TokenManager
+    """
+    key = (settings.get(CONF_BASE_URL_KEY) or '', settings.get(CONF_USER_KEY))
+    with _managers_lock:
+        if key not in _managers:
+            _managers[key] = TokenManager(settings=settings)
+        return _managers[key]
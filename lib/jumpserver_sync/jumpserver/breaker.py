@@ -0,0 +1,161 @@
+import logging
+import threading
+import time
+from jumpserver_sync.utils import CONF_BASE_URL_KEY, CONF_BREAKER_THRESHOLD_KEY, CONF_BREAKER_COOLDOWN_KEY
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for Jumpserver.
+    Open after consecutive failures, let one probe request through after cool-down (half-open),
+    and close again only if the probe succeeds.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    DEFAULT_THRESHOLD = 5
+    DEFAULT_COOLDOWN = 30
+
+    def __init__(self, name, threshold=None, cooldown=None):
+        """
+
+        :param name: breaker name
+        :param threshold: consecutive failures to open
+        :param cooldown: seconds to wait before probe
+        """
+        self.name = name
+        self.threshold = threshold or self.DEFAULT_THRESHOLD
+        self.cooldown = cooldown if cooldown is not None else self.DEFAULT_COOLDOWN
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        # thread of the probe request, only its result decides half-open state
+        self._probe = None
+        self._stats = {
+            'opened': 0,
+            'half_opened': 0,
+            'closed': 0,
+            'rejected': 0,
+            'failures': 0
+        }
+
+    def allow(self):
+        """
+        Check whether request is allowed, half-open the breaker if cool-down is reached.
+
+        :return: bool
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                self._transit(self.HALF_OPEN)
+            if self._state == self.HALF_OPEN and self._probe is None:
+                # let one probe request through
+                self._probe = threading.get_ident()
+                return True
+            self._stats['rejected'] += 1
+            return False
+
+    def record(self, success):
+        """
+        Record request result, called by the thread which is allowed to send the request.
+        While half-open, results of requests started before opened are ignored.
+
+        :param success: True if succeeded, False if failed, None if unknown
+        :return:
+        """
+        with self._lock:
+            probe = self._probe is not None and self._probe == threading.get_ident()
+            if probe:
+                self._probe = None
+            if success is None:
+                return
+            if success:
+                self._failures = 0
+                if self._state == self.HALF_OPEN and probe:
+                    self._transit(self.CLOSED)
+                return
+            self._failures += 1
+            self._stats['failures'] += 1
+            if (self._state == self.HALF_OPEN and probe) or \
+                    (self._state == self.CLOSED and self._failures >= self.threshold):
+                self._opened_at = time.monotonic()
+                self._transit(self.OPEN)
+
+    def remaining(self):
+        """
+        Seconds to wait before probe.
+
+        :return: seconds, 0 if closed or ready to probe
+        """
+        with self._lock:
+            if self._state != self.OPEN:
+                return 0
+            return max(self.cooldown - (time.monotonic() - self._opened_at), 0)
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['state'] = self._state
+            return s
+
+    def _transit(self, state):
+        if state == self._state:
+            return
+        if state == self.OPEN:
+            logging.warning('Circuit breaker {} opened after {} failures, pause for {}s'.format(
+                self.name, self._failures, self.cooldown))
+            self._stats['opened'] += 1
+        elif state == self.HALF_OPEN:
+            logging.info('Circuit breaker {} half-opened, probing'.format(self.name))
+            self._stats['half_opened'] += 1
+        else:
+            logging.info('Circuit breaker {} closed'.format(self.name))
+            self._stats['closed'] += 1
+        self._state = state
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(settings):
+    """
+    Get shared circuit breaker for Jumpserver configured in settings.
+
+    :param settings:
+    :return: CircuitBreaker
+    """
+    base_url = settings.get(CONF_BASE_URL_KEY) or ''
+    with _breakers_lock:
+        if base_url not in _breakers:
+            _breakers[base_url] = CircuitBreaker(
+                name=base_url,
+                threshold=settings.get(CONF_BREAKER_THRESHOLD_KEY, None),
+                cooldown=settings.get(CONF_BREAKER_COOLDOWN_KEY, None)
+            )
+        return _breakers[base_url]
+
+
+def report_breaker_stats():
+    """
+    Log circuit breaker stats.
+
+    :return:
+    """
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    for b in breakers:
+        s = b.stats
+        if s['opened'] or s['failures']:
+            logging.info('Circuit breaker {} is {}: opened {} times, {} failures, {} requests rejected'.format(
+                b.name, s['state'], s['opened'], s['failures'], s['rejected']))
@@ -1,11 +1,24 @@
+import collections
+import heapq
+import itertools
 import logging
-import requests
+import threading
 import time
 import re
+from concurrent.futures import ThreadPoolExecutor, Future
+from requests.exceptions import RequestException
 from hsettings import Settings
-from diskcache import Cache
-from jumpserver_sync.utils import JumpserverAuthError, CONF_BASE_URL_KEY, CONF_CACHE_DIR_KEY, \
-    CONF_CACHE_TTL_KEY, CONF_LOGIN_URL_KEY, CONF_USER_KEY, CONF_PWD_KEY
+from jumpserver_sync.utils import JumpserverError, JumpserverAuthError, JumpserverCircuitOpenError, CONF_BASE_URL_KEY, \
+    CONF_CACHE_TTL_KEY, CONF_CACHE_TTLS_KEY, CONF_PAGE_SIZE_KEY, CONF_PREFETCH_KEY, CONF_RATE_LIMIT_KEY, CONF_RATE_BURST_KEY, \
+    CONF_MAX_RETRIES_KEY, CONF_BACKOFF_FACTOR_KEY, CONF_BACKOFF_MAX_KEY, CONF_RETRY_AFTER_MAX_KEY, \
+    CONF_CONCURRENCY_KEY, CONF_CHECK_CONCURRENCY_KEY
+from jumpserver_sync.jumpserver.transport import get_transport
+from jumpserver_sync.jumpserver.policy import get_policy
+from jumpserver_sync.jumpserver.breaker import get_breaker
+from jumpserver_sync.jumpserver.codec import dumps, loads, iter_json_array
+from jumpserver_sync.jumpserver.singleflight import SingleFlight, flight_key
+from jumpserver_sync.jumpserver.auth import get_token_manager
+from jumpserver_sync.cache import get_cache
 
 
 class RestfulResource:
@@ -16,6 +29,22 @@ class RestfulResource:
     base_url = ''
     resource = ''
 
+    # server rejects list payload
+    BULK_UNSUPPORTED_STATUSES = (404, 405, 415, 501)
+    BULK_UNSUPPORTED_FLAG = 'Expected a dictionary'
+    bulk_supported = True
+
+    STREAM_CHUNK_SIZE = 64 * 1024
+
+    # request policy, use settings if None
+    rate_limit = None
+    rate_burst = None
+    max_retries = None
+    backoff_factor = None
+    backoff_max = None
+    retry_after_max = None
+    retry_statuses = None
+
     def __init__(self, settings=None, **kwargs):
         """
 
@@ -24,23 +53,143 @@ class RestfulResource:
         """
         self.settings = settings or Settings()
         self.base_url = self.settings.get(CONF_BASE_URL_KEY) or ''
-
-    def list_resources(self, **kwargs):
+        self.transport = get_transport(self.settings)
+        self.policy = get_policy(
+            base_url=self.base_url,
+            rate_limit=self._policy_conf('rate_limit', CONF_RATE_LIMIT_KEY, 0),
+            burst=self._policy_conf('rate_burst', CONF_RATE_BURST_KEY, None),
+            max_retries=self._policy_conf('max_retries', CONF_MAX_RETRIES_KEY, 3),
+            backoff_factor=self._policy_conf('backoff_factor', CONF_BACKOFF_FACTOR_KEY, 0.5),
+            backoff_max=self._policy_conf('backoff_max', CONF_BACKOFF_MAX_KEY, 30),
+            retry_after_max=self._policy_conf('retry_after_max', CONF_RETRY_AFTER_MAX_KEY, 300),
+            retry_statuses=self.retry_statuses
+        )
+        self.breaker = get_breaker(self.settings)
+
+    def list_resources(self, headers=None, **kwargs):
         """
         List resources.
 
+        :param headers:
         :param kwargs:
         :return: list of resources
         """
         if not self.resource:
             raise ValueError('Invalid resource')
-        res = self.send_request(url=self.resource, method='get', **kwargs)
+        res = self.send_request(url=self.resource, method='get', headers=headers, **kwargs)
         if res.status_code == 200:
-            return res.json()
+            return loads(res.content)
         else:
             logging.error(res.text)
             return []
 
+    def iter_pages(self, page_size=None, prefetch=None, params=None, **kwargs):
+        """
+        List resources page by page with limit/offset parameters.
+
+        :param page_size: resources per page, list all in one page if 0
+        :param prefetch: fetch next page in background while current page is consumed
+        :param params: query params
+        :param kwargs:
+        :return: generator of resource list
+        """
+        if not self.resource:
+            raise ValueError('Invalid resource')
+        if page_size is None:
+            page_size = self.settings.get(CONF_PAGE_SIZE_KEY, 0)
+        if not page_size:
+            yield self.list_resources(params=params, **kwargs)
+            return
+        if prefetch is None:
+            prefetch = self.settings.get(CONF_PREFETCH_KEY, False)
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            offset = 0
+            page, has_next = self._fetch_page(limit=page_size, offset=offset, params=params, **kwargs)
+            while True:
+                offset += page_size
+                future = None
+                if has_next and executor:
+                    future = executor.submit(self._fetch_page, limit=page_size, offset=offset, params=params,
+                                             **kwargs)
+                if page:
+                    yield page
+                if not has_next:
+                    break
+                if future:
+                    page, has_next = future.result()
+                else:
+                    page, has_next = self._fetch_page(limit=page_size, offset=offset, params=params, **kwargs)
+        finally:
+            if executor:
+                executor.shutdown(wait=False)
+
+    def iter_resources(self, page_size=None, prefetch=None, params=None, **kwargs):
+        """
+        List resources lazily, only one page is kept in memory.
+        If page_size is 0, all resources are listed in one response and decoded incrementally.
+
+        :param page_size: resources per page, stream all resources in one response if 0
+        :param prefetch: fetch next page in background
+        :param params: query params
+        :param kwargs:
+        :return: generator of resources
+        """
+        if page_size is None:
+            page_size = self.settings.get(CONF_PAGE_SIZE_KEY, 0)
+        if not page_size:
+            # decode items incrementally from one response
+            for r in self._stream_resources(params=params, **kwargs):
+                yield r
+            return
+        for page in self.iter_pages(page_size=page_size, prefetch=prefetch, params=params, **kwargs):
+            for r in page:
+                yield r
+
+    def _stream_resources(self, params=None, headers=None, **kwargs):
+        """
+        List resources and yield them as they are decoded from response body.
+
+        :param params: query params
+        :param headers:
+        :param kwargs:
+        :return: generator of resources
+        """
+        res = self.send_request(url=self.resource, method='get', params=params, headers=headers, stream=True,
+                                **kwargs)
+        try:
+            if res.status_code != 200:
+                logging.error(res.text)
+                return
+            for r in iter_json_array(res.iter_content(chunk_size=self.STREAM_CHUNK_SIZE)):
+                yield r
+        finally:
+            res.close()
+
+    def _fetch_page(self, limit, offset, params=None, headers=None, **kwargs):
+        """
+        Fetch one page of resources.
+
+        :param limit:
+        :param offset:
+        :param params: query params
+        :param kwargs:
+        :return: tuple of resource list and whether has next page
+        """
+        p = dict(params) if params else {}
+        p['limit'] = limit
+        p['offset'] = offset
+        res = self.send_request(url=self.resource, method='get', params=p, headers=headers, **kwargs)
+        if res.status_code != 200:
+            logging.error(res.text)
+            return [], False
+        data = loads(res.content)
+        if isinstance(data, list):
+            # pagination not supported, all resources returned
+            return data, False
+        results = data.get('results', [])
+        return results, bool(data.get('next')) and len(results) > 0
+
     def get_resource(self, res_id, **kwargs):
         """
         Get resources.
@@ -51,7 +200,7 @@ class RestfulResource:
         """
         res = self.send_request(url=self.resource.rstrip('/') + '/' + res_id, method='get', **kwargs)
         if res.status_code == 200:
-            return res.json()
+            return loads(res.content)
         else:
             logging.error(res.text)
             return {}
@@ -66,7 +215,7 @@ class RestfulResource:
         """
         res = self.send_request(url=self.resource, method='post', json=data, **kwargs)
         if res.status_code == 201:
-            return res.json()
+            return loads(res.content)
         else:
             logging.error(res.text)
             return {}
@@ -82,7 +231,23 @@ class RestfulResource:
         """
         res = self.send_request(url=self.resource.rstrip('/') + '/' + res_id, method='put', json=data, **kwargs)
         if res.status_code == 200:
-            return res.json()
+            return loads(res.content)
+        else:
+            logging.error(res.text)
+            return {}
+
+    def patch_resource(self, res_id, data, **kwargs):
+        """
+        Update fields of resource.
+
+        :param res_id: resource id
+        :param data: changed fields
+        :param kwargs:
+        :return: resource
+        """
+        res = self.send_request(url=self.resource.rstrip('/') + '/' + res_id, method='patch', json=data, **kwargs)
+        if res.status_code == 200:
+            return loads(res.content)
         else:
             logging.error(res.text)
             return {}
@@ -102,6 +267,39 @@ class RestfulResource:
             logging.error(res.text)
             return False
 
+    def bulk_post_resources(self, data, **kwargs):
+        """
+        Create resources in bulk.
+
+        :param data: list of resource data
+        :param kwargs:
+        :return: list of resources, or None if failed
+        """
+        res = self.send_request(url=self.resource, method='post', json=data, **kwargs)
+        return self._bulk_result(res, 201)
+
+    def bulk_put_resources(self, data, **kwargs):
+        """
+        Update resources in bulk, each resource data must contain id.
+
+        :param data: list of resource data
+        :param kwargs:
+        :return: list of resources, or None if failed
+        """
+        res = self.send_request(url=self.resource, method='put', json=data, **kwargs)
+        return self._bulk_result(res, 200)
+
+    def _bulk_result(self, res, status_code):
+        if res.status_code == status_code:
+            data = loads(res.content)
+            if isinstance(data, list):
+                return data
+            self.bulk_supported = False
+        elif res.status_code in self.BULK_UNSUPPORTED_STATUSES or self.BULK_UNSUPPORTED_FLAG in res.text:
+            self.bulk_supported = False
+        logging.error(res.text)
+        return None
+
     def build_request(self, url, method='get', headers=None, params=None, data=None, json=None):
         """
         Build request.
@@ -128,7 +326,7 @@ class RestfulResource:
             p['json'] = json
         return p
 
-    def send_request(self, url, method='get', headers=None, params=None, data=None, json=None):
+    def send_request(self, url, method='get', headers=None, params=None, data=None, json=None, stream=False):
         """
 
         Send request.
@@ -139,36 +337,109 @@ class RestfulResource:
         :param params:
         :param data:
         :param json:
+        :param stream: do not read response body immediately
         :return: Response
         :rtype: requests.Response
         """
-        p = self.build_request(url=url, method=method, headers=headers, params=params, data=data, json=json)
-        return requests.request(**p)
+        if not self.breaker.allow():
+            raise JumpserverCircuitOpenError('Circuit to Jumpserver {} is open'.format(self.base_url))
+        success = None
+        try:
+            p = self.build_request(url=url, method=method, headers=headers, params=params, data=data, json=json)
+            if 'json' in p:
+                # encode body by fast codec
+                p['data'] = dumps(p.pop('json'))
+                h = dict(p['headers']) if 'headers' in p else {}
+                h['Content-Type'] = 'application/json'
+                p['headers'] = h
+            res = self.policy.send(lambda: self.transport.request(stream=stream, **p), method=method)
+            success = res.status_code < 500
+            return res
+        except RequestException:
+            success = False
+            raise
+        finally:
+            self.breaker.record(success)
+
+    def ping(self):
+        """
+        Check whether Jumpserver is available by listing one resource.
+
+        :return: bool
+        """
+        try:
+            res = self.send_request(url=self.resource, method='get', params={'limit': 1})
+            return res.status_code == 200
+        except (RequestException, JumpserverError) as e:
+            logging.warning('Jumpserver is not available: {}'.format(e))
+            return False
+
+    def _policy_conf(self, attr, key, default):
+        val = getattr(self, attr)
+        if val is None:
+            val = self.settings.get(key, None)
+        return default if val is None else val
 
 
 class CachedResource(RestfulResource):
+    """
+    Resource with two-tier cache (in-process LRU and diskcache) shared by all clients in process,
+    concurrent identical GET requests share one in-flight request and its result.
+    """
+
+    flight = SingleFlight()
+
+    # cache namespace and default ttl seconds, override by cache.ttls.<cache_name>
+    cache_name = ''
+    cache_ttl = None
+    # cache list results, invalidated by version when resource is changed
+    cache_list = True
 
     def __init__(self, settings=None, **kwargs):
         super().__init__(settings=settings, **kwargs)
-        self._cache_dir = self.settings.get(CONF_CACHE_DIR_KEY, '.jumpserver_dir')
-        self._cache_ttl = self.settings.get(CONF_CACHE_TTL_KEY, 60)
+        self.cache = get_cache(self.settings)
+        self._cache_name = self.cache_name or self.resource
+        self._cache_ttl = self.settings.get(CONF_CACHE_TTLS_KEY + '.' + self._cache_name, None)
+        if self._cache_ttl is None:
+            self._cache_ttl = self.cache_ttl
+        if self._cache_ttl is None:
+            self._cache_ttl = self.settings.get(CONF_CACHE_TTL_KEY, 60)
+
+    @property
+    def ttl(self):
+        return self._cache_ttl
+
+    def cache_key(self, key):
+        return '{}:{}'.format(self._cache_name, key)
 
     def get_cache(self, key, default=None):
-        if self._cache_dir:
-            with Cache(self._cache_dir) as ref:
-                return ref.get(key=key, default=default)
-        else:
+        if not self._cache_ttl:
             return default
+        return self.cache.get(self.cache_key(key), default=default)
 
     def set_cache(self, key, value):
-        if self._cache_dir:
-            with Cache(self._cache_dir) as ref:
-                ref.set(key=key, value=value, expire=self._cache_ttl)
+        """
+        Set cache for resource, delete it if value is None.
+
+        :param key:
+        :param value:
+        :return:
+        """
+        if value is None:
+            self.cache.delete(self.cache_key(key))
+        elif self._cache_ttl:
+            self.cache.set(self.cache_key(key), value, expire=self._cache_ttl)
 
     def clear_cache(self):
-        if self._cache_dir:
-            with Cache(self._cache_dir) as ref:
-                ref.clear()
+        self.cache.clear()
+
+    def invalidate_list_cache(self):
+        """
+        Invalidate all cached list results of resource by increasing version.
+
+        :return:
+        """
+        self.cache.incr(self.cache_key('version'))
 
     def get_resource_from_cache(self, res_id, **kwargs):
         """
@@ -180,47 +451,98 @@ class CachedResource(RestfulResource):
         """
         val = self.get_cache(key=res_id)
         if not val:
-            res = self.send_request(url=self.resource + '/' + res_id + '/', method='get', **kwargs)
-            if res.status_code == 200:
-                val = res.json()
-                self.set_cache(key=res_id, value=val)
-                return val
-            else:
-                logging.error(res.text)
-                return {}
+            key = flight_key(self.base_url, self.resource, 'get', res_id, **kwargs)
+            return self.flight.do(key, lambda: self._fetch_resource(res_id, **kwargs))
         return val
 
+    def _fetch_resource(self, res_id, **kwargs):
+        res = self.send_request(url=self.resource + '/' + res_id + '/', method='get', **kwargs)
+        if res.status_code == 200:
+            val = loads(res.content)
+            self.set_cache(key=res_id, value=val)
+            return val
+        else:
+            logging.error(res.text)
+            return {}
+
     def get_resource(self, res_id, **kwargs):
         return self.get_resource_from_cache(res_id, **kwargs)
 
+    def list_resources(self, **kwargs):
+        key = flight_key(self.base_url, self.resource, 'list', **kwargs)
+        if not self.cache_list or not self._cache_ttl:
+            return self.flight.do(key, lambda: super(CachedResource, self).list_resources(**kwargs))
+        list_key = 'list:{}:{}'.format(self.cache.get(self.cache_key('version'), 0), key)
+        val = self.get_cache(key=list_key)
+        if val is None:
+            val = self.flight.do(key, lambda: super(CachedResource, self).list_resources(**kwargs))
+            if val:
+                self.set_cache(key=list_key, value=val)
+        return val
+
+    def post_resource(self, data, **kwargs):
+        res = super().post_resource(data, **kwargs)
+        self.invalidate_list_cache()
+        return res
+
+    def put_resource(self, res_id, data, **kwargs):
+        res = super().put_resource(res_id, data, **kwargs)
+        self.set_cache(key=res_id, value=None)
+        self.invalidate_list_cache()
+        return res
+
+    def patch_resource(self, res_id, data, **kwargs):
+        res = super().patch_resource(res_id, data, **kwargs)
+        self.set_cache(key=res_id, value=None)
+        self.invalidate_list_cache()
+        return res
+
     def delete_resource(self, res_id, **kwargs):
         res = super().delete_resource(res_id, **kwargs)
         self.set_cache(key=res_id, value=None)
+        self.invalidate_list_cache()
+        return res
+
+    def bulk_post_resources(self, data, **kwargs):
+        res = super().bulk_post_resources(data, **kwargs)
+        self.invalidate_list_cache()
+        return res
+
+    def bulk_put_resources(self, data, **kwargs):
+        res = super().bulk_put_resources(data, **kwargs)
+        for d in data:
+            if 'id' in d:
+                self.set_cache(key=d['id'], value=None)
+        self.invalidate_list_cache()
         return res
 
 
 class JumpserverClient(CachedResource):
 
-    CACHE_TOKEN_KEY = 'jms_token'
+    def __init__(self, settings=None, **kwargs):
+        super().__init__(settings=settings, **kwargs)
+        self.token_manager = get_token_manager(self.settings)
 
     def get_token(self):
-        login_url = self.settings.get(CONF_LOGIN_URL_KEY)
-        if not login_url:
-            raise JumpserverAuthError('Invalid login url {}'.format(login_url))
-        token = self.get_cache(self.CACHE_TOKEN_KEY)
-        if token is None:
-            user = self.settings.get(CONF_USER_KEY)
-            pwd = self.settings.get(CONF_PWD_KEY)
-            logging.debug('Login into Jumpserver by user {}'.format(user))
-            res = requests.post(url=self.base_url.rstrip('/') + login_url, json={'username': user, 'password': pwd})
-            if res.status_code == 200:
-                res = res.json()
-                token = res['token'] if 'token' in res else None
-                if token:
-                    self.set_cache(key=self.CACHE_TOKEN_KEY, value=token)
-            else:
-                logging.error('Login failed {}'.format(res.json()))
-        return token
+        """
+        Get token from memory, login if expired.
+
+        :return: token
+        """
+        return self.token_manager.get_token()
+
+    def send_request(self, url, method='get', headers=None, params=None, data=None, json=None, stream=False):
+        res = super().send_request(url=url, method=method, headers=headers, params=params, data=data, json=json,
+                                   stream=stream)
+        if res.status_code == 401:
+            # token expired in server, login and retry once
+            auth = res.request.headers.get('Authorization', '') if res.request is not None else ''
+            logging.warning('Token rejected by Jumpserver, login again')
+            self.token_manager.invalidate(token=auth[len('Bearer '):] if auth.startswith('Bearer ') else None)
+            res.close()
+            res = super().send_request(url=url, method=method, headers=headers, params=params, data=data, json=json,
+                                       stream=stream)
+        return res
 
     def build_request(self, url, method='get', headers=None, params=None, data=None, json=None):
         token = self.get_token()
@@ -250,6 +572,8 @@ class SystemUser(JumpserverClient):
     ERROR_FLAG = 'ObjectDoesNotExist'
 
     resource = 'api/assets/v1/system-user'
+    cache_name = 'system_user'
+    cache_ttl = 600
 
     def push(self, uid, asset_id=None):
         """
@@ -265,7 +589,7 @@ class SystemUser(JumpserverClient):
             url = '/'.join([self.resource, uid, 'push'])
         res = self.send_request(url=url, method='get')
         if res.status_code == 200:
-            return res.json()
+            return loads(res.content)
         else:
             logging.error(res.text)
             return {}
@@ -281,7 +605,7 @@ class SystemUser(JumpserverClient):
         url = '/'.join([self.resource, uid, 'asset', asset_id, 'test'])
         res = self.send_request(url=url, method='get')
         if res.status_code == 200:
-            return res.json()
+            return loads(res.content)
         else:
             logging.error(res.text)
             return {}
@@ -297,21 +621,71 @@ class SystemUser(JumpserverClient):
         :param show_output:
         :return:
         """
+        return self.submit_check(uid=uid, asset_id=asset_id, timeout=timeout, interval=interval,
+                                 show_output=show_output).result()
+
+    def submit_check(self, uid, asset_id, timeout=30, interval=3, show_output=False):
+        """
+        Start task to test system_user connectivity to assets and track it by task monitor.
+
+        :param uid:
+        :param asset_id:
+        :param timeout:
+        :param interval:
+        :param show_output:
+        :return: Future of True if connective, None if system_user can not be pushed to asset, otherwise False
+        """
         task = self.test(uid=uid, asset_id=asset_id)
         task_id = task['task'] if 'task' in task else None
-        if task_id:
-            celery = Celery(settings=self.settings)
-            time.sleep(3)  # sleep some time for job to start
-            res = celery.is_task_finished(task_id=task_id, timeout=timeout, interval=interval, show_output=show_output)
-            if res:
-                if self.PASSED_FLAG in celery.output_log or re.search(self.PASSED_PATTERN, celery.output_log):
-                    return True
-                elif self.ERROR_FLAG in celery.output_log:
-                    return None  # skip because can not push system_user to asset
-            return False
-        else:
+        if not task_id:
             logging.warning('Failed to check system_user {} to asset {} connective'.format(uid, asset_id))
+            return completed_future(False)
+        future = get_task_monitor(self.settings).submit(
+            task_id=task_id, timeout=timeout, interval=interval, show_output=show_output, markers=self.markers())
+        return map_future(future, self.check_result)
+
+    def submit_push(self, uid, asset_id, timeout=30, interval=3, show_output=False):
+        """
+        Start task to push system_user to assets and track it by task monitor.
+
+        :param uid:
+        :param asset_id:
+        :param timeout:
+        :param interval:
+        :param show_output:
+        :return: Future of whether push task is finished
+        """
+        task = self.push(uid=uid, asset_id=asset_id)
+        task_id = task['task'] if 'task' in task else None
+        if not task_id:
+            logging.warning('Failed to push system_user {} to asset {}'.format(uid, asset_id))
+            return completed_future(False)
+        future = get_task_monitor(self.settings).submit(
+            task_id=task_id, timeout=timeout, interval=interval, show_output=show_output)
+        return map_future(future, lambda task_log: task_log.finished)
+
+    @classmethod
+    def markers(cls):
+        return {
+            'passed': [cls.PASSED_FLAG, re.compile(cls.PASSED_PATTERN)],
+            'error': [cls.ERROR_FLAG]
+        }
+
+    @classmethod
+    def check_result(cls, task_log):
+        """
+        Result of test task by markers matched in its log.
+
+        :param TaskLog task_log:
+        :return: True if connective, None if system_user can not be pushed to asset, otherwise False
+        """
+        if not task_log.finished:
             return False
+        if task_log.is_matched('passed'):
+            return True
+        elif task_log.is_matched('error'):
+            return None  # skip because can not push system_user to asset
+        return False
 
     def push_checked(self, uid, asset_id, timeout=30, interval=3, show_output=False, max_tries=3, force_push=False):
         """
@@ -331,10 +705,9 @@ class SystemUser(JumpserverClient):
             if force_push or not self.is_checked(
                     uid=uid, asset_id=asset_id, timeout=timeout, interval=interval, show_output=show_output):
                 force_push = False
-                task = self.push(uid=uid, asset_id=asset_id)
-                task_id = task['task'] if 'task' in task else None
-                if task_id:
-                    time.sleep(3)  # sleep some time for job to start
+                pushed = self.submit_push(uid=uid, asset_id=asset_id, timeout=timeout, interval=interval,
+                                          show_output=show_output).result()
+                if pushed:
                     check = self.is_checked(
                         uid=uid,
                         asset_id=asset_id,
@@ -346,8 +719,6 @@ class SystemUser(JumpserverClient):
                         return True
                     elif check is None:
                         break
-                else:
-                    logging.warning('Failed to push system_user {} to asset {}'.format(uid, asset_id))
             else:
                 return True
             tries += 1
@@ -359,25 +730,106 @@ class SystemUser(JumpserverClient):
 class AdminUser(JumpserverClient):
 
     resource = 'api/assets/v1/admin-user'
+    cache_name = 'admin_user'
+    cache_ttl = 3600
 
 
 class Domain(JumpserverClient):
 
     resource = 'api/assets/v1/domain'
+    cache_name = 'domain'
+    cache_ttl = 3600
 
 
 class Label(JumpserverClient):
 
     resource = 'api/assets/v1/labels'
+    cache_name = 'label'
+    cache_ttl = 600
+
+
+class NodeTree:
+    """
+    Index of node list, a trie keyed by node value of each layer and a map of node key to node.
+    """
+
+    def __init__(self, nodes, key_sep=':', expires_at=None):
+        """
+
+        :param nodes: node list
+        :param key_sep: separator of node key
+        :param expires_at: time to refresh tree, never expired if None
+        """
+        self.key_sep = key_sep
+        self.expires_at = expires_at
+        self.keys = {}
+        self.ids = {}
+        self.root = {}
+        self._children = {}
+        for node in sorted(nodes, key=lambda n: len(n['key'].split(key_sep))):
+            key = node['key']
+            if key in self.keys:
+                continue
+            if key_sep in key:
+                parent_key = key[:key.rindex(key_sep)]
+                if parent_key not in self.keys:
+                    continue
+                children = self._children[parent_key]
+            else:
+                children = self.root
+            self.keys[key] = node
+            self.ids[node['id']] = node
+            self._children[key] = {}
+            # keep the first one for duplicated values
+            children.setdefault(node['value'], key)
+
+    def find(self, values):
+        """
+        Find node by values of each layer.
+
+        :param values: list of node value
+        :return: node or None
+        """
+        children = self.root
+        key = None
+        for v in values:
+            key = children.get(v)
+            if key is None:
+                return None
+            children = self._children[key]
+        return self.keys[key] if key else None
+
+    def path(self, node_id):
+        """
+        Get node values from root to node.
+
+        :param node_id:
+        :return: list of node value or None
+        """
+        node = self.ids.get(node_id)
+        if not node:
+            return None
+        parts = node['key'].split(self.key_sep)
+        return [self.keys[self.key_sep.join(parts[:i])]['value'] for i in range(1, len(parts) + 1)]
+
+    def is_expired(self, now=None):
+        return self.expires_at is not None and (now or time.monotonic()) >= self.expires_at
 
 
 class Node(JumpserverClient):
 
     resource = 'api/assets/v1/nodes'
+    cache_name = 'node'
+    cache_ttl = 600
 
     NODE_KEY_SEP = ':'
     NODE_PATH_SEP = '/'
 
+    def __init__(self, settings=None, **kwargs):
+        super().__init__(settings=settings, **kwargs)
+        self._tree = None
+        self._tree_lock = threading.Lock()
+
     def get_node_id(self, node):
         """
         Get node id by node name (e.g. Default/ops/prod).
@@ -388,26 +840,8 @@ class Node(JumpserverClient):
         node_list = node.split(self.NODE_PATH_SEP)
         if len(node_list) < 1:
             return None
-        nodes = self.list_resources()
-        layer = 1
-        max_layer = len(node_list)
-        parent_key = ''
-        for n in node_list:
-            for node in nodes:
-                # check key
-                if parent_key and not node['key'].startswith(parent_key):
-                    continue
-                keys = node['key'].split(self.NODE_KEY_SEP)
-                if len(keys) != layer:
-                    continue
-                # found and go to next layer
-                if node['value'] == n:
-                    if layer == max_layer:
-                        return node['id']
-                    parent_key = node['key']
-                    layer += 1
-                    break
-        return None
+        n = self.get_tree().find(node_list)
+        return n['id'] if n else None
 
     def get_node_full_name(self, node_id):
         """
@@ -416,24 +850,49 @@ class Node(JumpserverClient):
         :param node_id:
         :return: full node name
         """
-        node = self.get_resource(res_id=node_id)
-        if not node:
+        values = self.get_tree().path(node_id)
+        if not values:
             return None
-        values = [node['value']]
-        key = node['key']
-        nodes = self.list_resources()
-        layer = len(key.split(self.NODE_KEY_SEP))
-        for i in range(layer, 1, -1):
-            if len(key.split(self.NODE_KEY_SEP)) != i:
-                return None
-            parent_key = key[:key.rindex(self.NODE_KEY_SEP)]
-            for node in nodes:
-                if node['key'] == parent_key:
-                    key = node['key']
-                    values.insert(0, node['value'])
-                    break
         return self.NODE_PATH_SEP.join(values)
 
+    def get_tree(self):
+        """
+        Get node tree built from one node listing, rebuild it after cache ttl or if nodes are changed.
+
+        :return: NodeTree
+        """
+        tree = self._tree
+        if tree is not None and not tree.is_expired():
+            return tree
+        with self._tree_lock:
+            tree = self._tree
+            if tree is None or tree.is_expired():
+                ttl = self.ttl
+                tree = NodeTree(self.list_resources(), key_sep=self.NODE_KEY_SEP,
+                                expires_at=time.monotonic() + ttl if ttl else None)
+                self._tree = tree
+        return tree
+
+    def post_resource(self, data, **kwargs):
+        res = super().post_resource(data, **kwargs)
+        self._tree = None
+        return res
+
+    def put_resource(self, res_id, data, **kwargs):
+        res = super().put_resource(res_id, data, **kwargs)
+        self._tree = None
+        return res
+
+    def patch_resource(self, res_id, data, **kwargs):
+        res = super().patch_resource(res_id, data, **kwargs)
+        self._tree = None
+        return res
+
+    def delete_resource(self, res_id, **kwargs):
+        res = super().delete_resource(res_id, **kwargs)
+        self._tree = None
+        return res
+
 
 class Asset(JumpserverClient):
 
@@ -441,6 +900,9 @@ class Asset(JumpserverClient):
     PASSED_PATTERN = r'\sok:\s'
 
     resource = 'api/assets/v1/assets'
+    cache_name = 'asset'
+    cache_ttl = 5
+    cache_list = False
 
     def test(self, asset_id):
         """
@@ -452,7 +914,7 @@ class Asset(JumpserverClient):
         url = '/'.join([self.resource, asset_id, 'alive'])
         res = self.send_request(url=url, method='get')
         if res.status_code == 200:
-            return res.json()
+            return loads(res.content)
         else:
             logging.error(res.text)
             return {}
@@ -466,34 +928,79 @@ class Asset(JumpserverClient):
         :param show_output:
         :return:
         """
+        return self.submit_alive(asset_id=asset_id, timeout=timeout, interval=interval,
+                                 show_output=show_output).result()
+
+    def submit_alive(self, asset_id, timeout=30, interval=3, show_output=False):
+        """
+        Start task to test asset alive and track it by task monitor.
+
+        :param asset_id:
+        :param timeout:
+        :param interval:
+        :param show_output:
+        :return: Future of whether asset is alive
+        """
         task = self.test(asset_id=asset_id)
         task_id = task['task'] if 'task' in task else None
-        if task_id:
-            celery = Celery(settings=self.settings)
-            time.sleep(3)  # sleep some time for job to start
-            res = celery.is_task_finished(task_id=task_id, timeout=timeout, interval=interval, show_output=show_output)
-            if res and (self.PASSED_FLAG in celery.output_log or re.search(self.PASSED_PATTERN, celery.output_log)):
-                return True
-            return False
-        else:
+        if not task_id:
             logging.warning('Failed to check asset {} alive'.format(asset_id))
-            return False
+            return completed_future(False)
+        future = get_task_monitor(self.settings).submit(
+            task_id=task_id, timeout=timeout, interval=interval, show_output=show_output, markers=self.markers())
+        return map_future(future, self.check_result)
+
+    @classmethod
+    def markers(cls):
+        return {'passed': [cls.PASSED_FLAG, re.compile(cls.PASSED_PATTERN)]}
+
+    @classmethod
+    def check_result(cls, task_log):
+        """
+        Result of alive task by markers matched in its log.
+
+        :param TaskLog task_log:
+        :return: bool
+        """
+        return task_log.finished and task_log.is_matched('passed')
 
 
 class Celery(JumpserverClient):
 
     FINISH_FLAG = 'Task finished'
     FINISH_FLAG2 = '任务结束'
+    # Jumpserver keeps read offset of mark for 5 seconds
+    MARK_TTL = 4
 
     resource = 'api/ops/v1/celery/task'
+    cache_name = 'celery'
+    cache_list = False
 
-    output_log = ''
+    def __init__(self, settings=None, **kwargs):
+        super().__init__(settings=settings, **kwargs)
+        self.task_log = None
+
+    @property
+    def output_log(self):
+        """
+        Output kept for last task checked by is_task_finished.
+
+        :return: str
+        """
+        return self.task_log.output if self.task_log is not None else ''
+
+    def log(self, task_id, mark=None):
+        """
+        Read task log.
 
-    def log(self, task_id):
+        :param task_id:
+        :param mark: mark returned by last read, only output after last read is returned
+        :return: dict of data, mark and end
+        """
         url = '/'.join([self.resource, task_id, 'log'])
-        res = self.send_request(url=url, method='get')
+        res = self.send_request(url=url, method='get', params={'mark': mark} if mark else None)
         if res.status_code == 200:
-            return res.json()
+            return loads(res.content)
         else:
             logging.error(res.text)
             return {}
@@ -502,7 +1009,7 @@ class Celery(JumpserverClient):
         url = '/'.join([self.resource, task_id, 'result'])
         res = self.send_request(url=url, method='get')
         if res.status_code == 200:
-            return res.json()
+            return loads(res.content)
         else:
             logging.error(res.text)
             return {}
@@ -520,14 +1027,341 @@ class Celery(JumpserverClient):
         n = 0
         if show_output:
             logging.info('Output for task {}'.format(task_id))
+        self.task_log = self.new_task_log(task_id)
         while n < timeout / interval:
-            res = self.log(task_id)
-            if 'data' in res:
-                self.output_log = res['data']
-                if show_output:
-                    logging.info(res['data'])
-                if self.FINISH_FLAG in res['data'][-20:] or self.FINISH_FLAG2 in res['data'][-20:]:
-                    return True
+            if self.read_log(self.task_log, show_output=show_output):
+                return True
             time.sleep(interval)
             n += 1
         return False
+
+    def read_log(self, task_log, show_output=False):
+        """
+        Read output of task since last read.
+        Mark of last read is not used if it may be expired, then whole output is read and the part already
+        consumed is dropped.
+
+        :param TaskLog task_log:
+        :param show_output: log new output
+        :return: whether task is finished
+        """
+        mark = task_log.mark if time.monotonic() - task_log.read_at < self.MARK_TTL else None
+        res = self.log(task_log.task_id, mark=mark)
+        if 'mark' not in res:
+            # waiting for task to start, log is not created yet
+            return task_log.finished
+        chunk = task_log.feed(res.get('data') or '', mark=res['mark'], end=res.get('end', False), whole=mark is None)
+        if show_output and chunk:
+            logging.info(chunk)
+        return task_log.finished
+
+    @classmethod
+    def new_task_log(cls, task_id, markers=None):
+        """
+        Create task log matching finish flags and markers.
+
+        :param task_id:
+        :param markers: dict of marker name to list of str or compiled patterns
+        :return: TaskLog
+        """
+        markers = dict(markers or {})
+        markers[TaskLog.FINISHED] = [cls.FINISH_FLAG, cls.FINISH_FLAG2]
+        return TaskLog(task_id=task_id, markers=markers)
+
+
+class TaskLog:
+    """
+    Output of one Celery task read incrementally.
+    Only the last max_size characters are kept, markers are matched on each new chunk together with
+    the tail of previous output, so that markers split by two reads are found.
+    """
+
+    FINISHED = 'finished'
+    DEFAULT_MAX_SIZE = 65536
+    # overlap kept for regex markers
+    MIN_OVERLAP = 64
+
+    def __init__(self, task_id, markers=None, max_size=None):
+        """
+
+        :param task_id:
+        :param markers: dict of marker name to list of str or compiled patterns
+        :param max_size: max characters of output to keep
+        """
+        self.task_id = task_id
+        self.markers = markers or {}
+        self.max_size = max_size or self.DEFAULT_MAX_SIZE
+        self.mark = None
+        self.read_at = 0
+        self.matched = set()
+        self.end = False
+        self.read_size = 0
+        self._chunks = collections.deque()
+        self._size = 0
+        self._tail = ''
+        self._overlap = max([self.MIN_OVERLAP] + [len(m) for ms in self.markers.values() for m in ms
+                                                  if isinstance(m, str)])
+
+    def feed(self, data, mark=None, end=False, whole=False):
+        """
+        Add output read from log api.
+
+        :param data: output since mark of last read, or whole output if whole
+        :param mark: mark returned by api
+        :param end: api reports task is ended
+        :param whole: data is whole output, only the part not consumed yet is added
+        :return: new output
+        """
+        if whole:
+            data = data[self.read_size:]
+        self.mark = mark
+        self.read_at = time.monotonic()
+        self.end = self.end or bool(end)
+        if not data:
+            return data
+        self.read_size += len(data)
+        text = self._tail + data
+        for name, patterns in self.markers.items():
+            if name not in self.matched and any(self._search(m, text) for m in patterns):
+                self.matched.add(name)
+        self._tail = text[-self._overlap:]
+        self._chunks.append(data)
+        self._size += len(data)
+        while self._size - len(self._chunks[0]) >= self.max_size:
+            self._size -= len(self._chunks.popleft())
+        if self._size > self.max_size:
+            self._chunks[0] = self._chunks[0][self._size - self.max_size:]
+            self._size = self.max_size
+        return data
+
+    @property
+    def finished(self):
+        return self.end or self.FINISHED in self.matched
+
+    @property
+    def truncated(self):
+        return self.read_size > self._size
+
+    @property
+    def output(self):
+        """
+        Kept output, the beginning is dropped if longer than max_size.
+
+        :return: str
+        """
+        return ''.join(self._chunks)
+
+    def is_matched(self, name):
+        return name in self.matched
+
+    @staticmethod
+    def _search(marker, text):
+        if isinstance(marker, str):
+            return marker in text
+        return marker.search(text) is not None
+
+
+class TaskMonitor:
+    """
+    Track many Celery tasks by one scheduler thread, due polls are sent by a bounded worker pool.
+    Each task is polled soon after submitted and then less often up to its interval,
+    its future is completed as soon as the task is finished or timeout.
+    """
+
+    INITIAL_DELAY = 0.5
+    BACKOFF = 2
+    DEFAULT_CONCURRENCY = 4
+
+    def __init__(self, celery, name='', concurrency=None):
+        """
+
+        :param Celery celery: client to read task logs
+        :param name: monitor name in logs
+        :param concurrency: max polls sent at the same time
+        """
+        self.celery = celery
+        self.name = name
+        self.concurrency = max(concurrency or self.DEFAULT_CONCURRENCY, 1)
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pool = None
+        # tasks being polled
+        self._polling = 0
+        self.stats = {
+            'submitted': 0,
+            'finished': 0,
+            'timeout': 0,
+            'polls': 0
+        }
+
+    def submit(self, task_id, timeout=30, interval=3, show_output=False, callback=None, markers=None):
+        """
+        Track task until finished or timeout.
+
+        :param task_id:
+        :param timeout: total wait seconds
+        :param interval: max interval seconds for two poll
+        :param show_output: log new output of each poll
+        :param callback: function called with the future when completed
+        :param markers: dict of marker name to list of str or compiled patterns to match in output
+        :return: Future of TaskLog, which is not finished if timeout
+        """
+        future = Future()
+        future.set_running_or_notify_cancel()
+        if callback is not None:
+            future.add_done_callback(callback)
+        now = time.monotonic()
+        task = {
+            'log': self.celery.new_task_log(task_id, markers=markers),
+            'future': future,
+            'deadline': now + (timeout or 0),
+            'interval': max(interval or self.INITIAL_DELAY, self.INITIAL_DELAY),
+            'delay': self.INITIAL_DELAY,
+            'show_output': show_output
+        }
+        if show_output:
+            logging.info('Output for task {}'.format(task_id))
+        with self._cond:
+            self.stats['submitted'] += 1
+            self._schedule(task, now + self.INITIAL_DELAY)
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.concurrency)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='task-monitor', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap) + self._polling
+
+    def _schedule(self, task, at):
+        heapq.heappush(self._heap, (min(at, task['deadline']), next(self._seq), task))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap and not self._polling:
+                        # exit when idle, started again by next submit
+                        self._thread = None
+                        return
+                    if not self._heap:
+                        # woken up when polling task is rescheduled or completed
+                        self._cond.wait()
+                        continue
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                now = time.monotonic()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    due.append(heapq.heappop(self._heap)[2])
+                self._polling += len(due)
+                pool = self._pool
+            for task in due:
+                # each task is rescheduled when its own poll completes
+                pool.submit(self._poll, task)
+
+    def _poll(self, task):
+        try:
+            self._poll_task(task)
+        finally:
+            with self._cond:
+                self._polling -= 1
+                self._cond.notify()
+
+    def _poll_task(self, task):
+        task_log = task['log']
+        try:
+            finished = self.celery.read_log(task_log, show_output=task['show_output'])
+        except Exception as e:
+            logging.debug('Failed to read log of task {}: {}'.format(task_log.task_id, e))
+            finished = False
+        now = time.monotonic()
+        if finished or now >= task['deadline']:
+            with self._cond:
+                self.stats['polls'] += 1
+                self.stats['finished' if finished else 'timeout'] += 1
+            if not finished:
+                logging.warning('Task {} not finished in time'.format(task_log.task_id))
+            task['future'].set_result(task_log)
+            return
+        task['delay'] = min(task['delay'] * self.BACKOFF, task['interval'])
+        with self._cond:
+            self.stats['polls'] += 1
+            self._schedule(task, now + task['delay'])
+
+
+def completed_future(value):
+    """
+    Future already completed with value.
+
+    :param value:
+    :return: Future
+    """
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def map_future(future, func):
+    """
+    Future completed with func applied to result of another future.
+
+    :param future:
+    :param func: function with one result argument
+    :return: Future
+    """
+    mapped = Future()
+    mapped.set_running_or_notify_cancel()
+
+    def done(f):
+        try:
+            mapped.set_result(func(f.result()))
+        except Exception as e:
+            mapped.set_exception(e)
+
+    future.add_done_callback(done)
+    return mapped
+
+
+_monitors = {}
+_monitors_lock = threading.Lock()
+
+
+def get_task_monitor(settings):
+    """
+    Get shared task monitor for Jumpserver configured in settings.
+
+    :param settings:
+    :return: TaskMonitor
+    """
+    base_url = settings.get(CONF_BASE_URL_KEY) or ''
+    with _monitors_lock:
+        if base_url not in _monitors:
+            _monitors[base_url] = TaskMonitor(
+                celery=Celery(settings=settings),
+                name=base_url,
+                concurrency=settings.get(CONF_CHECK_CONCURRENCY_KEY, None) or settings.get(CONF_CONCURRENCY_KEY, None)
+            )
+        return _monitors[base_url]
+
+
+def report_task_stats():
+    """
+    Log task monitor stats.
+
+    :return:
+    """
+    with _monitors_lock:
+        monitors = list(_monitors.values())
+    for m in monitors:
+        s = m.stats
+        if s['submitted']:
+            logging.info('Tasks of {}: {} submitted, {} finished, {} timeout, {} polls'.format(
+                m.name, s['submitted'], s['finished'], s['timeout'], s['polls']))
@@ -0,0 +1,106 @@
+import codecs
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+_decoder = json.JSONDecoder()
+_whitespace = ' \t\n\r'
+
+
+def dumps(obj):
+    """
+    Encode object to JSON bytes, use orjson if installed.
+
+    :param obj:
+    :return: bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def loads(data):
+    """
+    Decode JSON bytes or string, use orjson if installed.
+
+    :param data:
+    :return: object
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+def iter_json_array(chunks):
+    """
+    Decode JSON array incrementally, items are yielded as soon as they are parsed.
+
+    :param chunks: iterable of bytes
+    :return: generator of items
+    """
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    started = False
+    for chunk in chunks:
+        buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
+        for item, pos, started, finished in _scan_array(buf, pos, started, final=False):
+            if finished:
+                return
+            yield item
+    buf = buf[pos:] + utf8.decode(b'', final=True)
+    for item, pos, started, finished in _scan_array(buf, 0, started, final=True):
+        if finished:
+            return
+        yield item
+    raise ValueError('Incomplete JSON array')
+
+
+def _scan_array(buf, pos, started, final):
+    """
+    Scan complete items in buffer.
+
+    :param buf: buffer
+    :param pos: start position
+    :param started: whether array begin is scanned
+    :param final: no more data
+    :return: generator of (item, next position, started, finished)
+    """
+    size = len(buf)
+    while True:
+        while pos < size and buf[pos] in _whitespace:
+            pos += 1
+        if pos >= size:
+            return
+        c = buf[pos]
+        if not started:
+            if c != '[':
+                raise ValueError('Not a JSON array')
+            started = True
+            pos += 1
+            continue
+        if c == ',':
+            pos += 1
+            continue
+        if c == ']':
+            yield None, pos + 1, started, True
+            return
+        try:
+            item, end = _decoder.raw_decode(buf, pos)
+        except ValueError:
+            if final:
+                raise
+            # incomplete item, wait for more data
+            return
+        if end >= size and not final:
+            # number may be truncated at the end of buffer
+            return
+        pos = end
+        yield item, pos, started, False
@@ -0,0 +1,235 @@
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from requests.exceptions import ConnectionError, ConnectTimeout, Timeout
+
+
+class TokenBucket:
+    """
+    Token bucket to limit requests per second.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+
+        :param rate: tokens added per second
+        :param burst: max tokens in bucket
+        """
+        self.rate = float(rate)
+        self.capacity = float(burst or max(rate, 1))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, wait if bucket is empty.
+
+        :return: waited seconds
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class RequestPolicy:
+    """
+    Throttle requests and retry with exponential backoff on retryable statuses and connection errors.
+    """
+
+    RETRY_STATUSES = (429, 502, 503, 504)
+    # statuses and errors meaning request is not processed, safe to retry for non idempotent methods
+    NOT_PROCESSED_STATUSES = (429, 503)
+    IDEMPOTENT_METHODS = ('get', 'head', 'options', 'put', 'delete')
+
+    def __init__(self, rate_limit=0, burst=None, max_retries=3, backoff_factor=0.5, backoff_max=30,
+                 retry_after_max=300, retry_statuses=None):
+        """
+
+        :param rate_limit: max requests per second, 0 for unlimited
+        :param burst: max burst requests
+        :param max_retries: max retries for one request
+        :param backoff_factor: backoff seconds for first retry, doubled for each retry
+        :param backoff_max: max backoff seconds
+        :param retry_after_max: max seconds to wait by Retry-After header, not retry if server asks for longer
+        :param retry_statuses: statuses to retry
+        """
+        self.bucket = TokenBucket(rate=rate_limit, burst=burst) if rate_limit else None
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.retry_after_max = retry_after_max
+        self.retry_statuses = tuple(retry_statuses or self.RETRY_STATUSES)
+        self._lock = threading.Lock()
+        self._stats = {
+            'requests': 0,
+            'throttled': 0,
+            'throttle_wait': 0.0,
+            'retries': 0,
+            'retry_wait': 0.0,
+            'failures': 0
+        }
+
+    def send(self, func, method='get'):
+        """
+        Send request by func with throttle and retry.
+
+        :param func: function to send request and return response
+        :param method: http method
+        :return: Response
+        :rtype: requests.Response
+        """
+        method = method.lower()
+        attempt = 0
+        while True:
+            self._throttle()
+            self._incr('requests')
+            try:
+                res = func()
+            except (ConnectionError, Timeout) as e:
+                # read errors may happen after request is processed
+                if not self._can_retry(attempt, method, error=e):
+                    self._incr('failures')
+                    raise
+                wait = self.backoff(attempt)
+                logging.warning('Request failed ({}), retry in {:.2f}s'.format(e, wait))
+            else:
+                if res.status_code not in self.retry_statuses:
+                    return res
+                if not self._can_retry(attempt, method, status=res.status_code):
+                    self._incr('failures')
+                    return res
+                retry_after = self.retry_after(res)
+                if retry_after > self.retry_after_max:
+                    logging.warning('Jumpserver responds {}, not retry because asked to retry after {:.2f}s'
+                                    .format(res.status_code, retry_after))
+                    self._incr('failures')
+                    return res
+                # backoff is limited by backoff_max, Retry-After is always waited in full
+                wait = max(self.backoff(attempt), retry_after)
+                logging.warning('Jumpserver responds {}, retry in {:.2f}s'.format(res.status_code, wait))
+                if hasattr(res, 'close'):
+                    # release connection of streamed response
+                    res.close()
+            self._incr('retries')
+            self._incr('retry_wait', wait)
+            time.sleep(wait)
+            attempt += 1
+
+    def backoff(self, attempt):
+        """
+        Exponential backoff seconds with full jitter.
+
+        :param attempt: retry attempt starts from 0
+        :return: seconds
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_factor * (2 ** attempt)))
+
+    @classmethod
+    def retry_after(cls, res):
+        """
+        Seconds to wait by Retry-After header.
+
+        :param res: Response
+        :return: seconds
+        """
+        val = res.headers.get('Retry-After') if res.headers else None
+        if not val:
+            return 0
+        try:
+            return max(float(val), 0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(val).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return 0
+
+    @property
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _can_retry(self, attempt, method, status=None, error=None):
+        if attempt >= self.max_retries:
+            return False
+        if method in self.IDEMPOTENT_METHODS:
+            return True
+        if status is not None:
+            return status in self.NOT_PROCESSED_STATUSES
+        return isinstance(error, ConnectTimeout)
+
+    def _throttle(self):
+        if self.bucket:
+            wait = self.bucket.acquire()
+            if wait > 0:
+                self._incr('throttled')
+                self._incr('throttle_wait', wait)
+
+    def _incr(self, key, value=1):
+        with self._lock:
+            self._stats[key] += value
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def get_policy(base_url, rate_limit=0, burst=None, max_retries=3, backoff_factor=0.5, backoff_max=30,
+               retry_after_max=300, retry_statuses=None):
+    """
+    Get shared request policy, resources with same configuration share one rate limit.
+
+    :param base_url: Jumpserver base url
+    :param rate_limit:
+    :param burst:
+    :param max_retries:
+    :param backoff_factor:
+    :param backoff_max:
+    :param retry_after_max:
+    :param retry_statuses:
+    :return: RequestPolicy
+    """
+    key = (base_url, rate_limit, burst, max_retries, backoff_factor, backoff_max, retry_after_max,
+           tuple(retry_statuses) if retry_statuses else None)
+    with _policies_lock:
+        if key not in _policies:
+            _policies[key] = RequestPolicy(rate_limit=rate_limit, burst=burst, max_retries=max_retries,
+                                           backoff_factor=backoff_factor, backoff_max=backoff_max,
+                                           retry_after_max=retry_after_max, retry_statuses=retry_statuses)
+        return _policies[key]
+
+
+def policy_stats():
+    """
+    Aggregated stats of all request policies.
+
+    :return: dict
+    """
+    total = {}
+    with _policies_lock:
+        policies = list(_policies.values())
+    for p in policies:
+        for k, v in p.stats.items():
+            total[k] = total.get(k, 0) + v
+    return total
+
+
+def report_policy_stats():
+    """
+    Log retry and throttle stats.
+
+    :return:
+    """
+    s = policy_stats()
+    if s.get('retries') or s.get('throttled') or s.get('failures'):
+        logging.info('Jumpserver requests {}: {} throttled ({:.2f}s), {} retries ({:.2f}s), {} failures'.format(
+            s['requests'], s['throttled'], s['throttle_wait'], s['retries'], s['retry_wait'], s['failures']))
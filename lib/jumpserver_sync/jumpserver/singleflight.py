@@ -0,0 +1,109 @@
+import asyncio
+import json
+import threading
+import weakref
+
+
+def flight_key(*args, **kwargs):
+    """
+    Build hashable key for call arguments.
+
+    :param args:
+    :param kwargs:
+    :return: str
+    """
+    return json.dumps([args, kwargs], sort_keys=True, default=str)
+
+
+class _Call:
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Share one in-flight call and its result among threads calling with the same key.
+    Results are shared, callers should not modify them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+
+    def do(self, key, func):
+        """
+        Call func, or wait for the result of in-flight call with the same key.
+
+        :param key:
+        :param func: function without arguments
+        :return: func result
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.shared += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+class AsyncSingleFlight:
+    """
+    Share one in-flight coroutine and its result among tasks of the same event loop calling with the same key.
+    """
+
+    def __init__(self):
+        self._calls = weakref.WeakKeyDictionary()
+        self.shared = 0
+
+    async def do(self, key, func):
+        """
+        Await func, or wait for the result of in-flight call with the same key.
+
+        :param key:
+        :param func: coroutine function without arguments
+        :return: func result
+        """
+        loop = asyncio.get_event_loop()
+        calls = self._calls.setdefault(loop, {})
+        fut = calls.get(key)
+        if fut is not None:
+            self.shared += 1
+            return await asyncio.shield(fut)
+        fut = loop.create_future()
+        calls[key] = fut
+        try:
+            res = await func()
+            fut.set_result(res)
+            return res
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            # mark exception retrieved in case no one is waiting
+            fut.exception()
+            raise
+        finally:
+            del calls[key]
@@ -0,0 +1,127 @@
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from jumpserver_sync.utils import CONF_BASE_URL_KEY, CONF_POOL_SIZE_KEY, CONF_KEEP_ALIVE_KEY, CONF_TIMEOUT_KEY
+
+
+class HttpTransport:
+    """
+    Pooled keep-alive HTTP transport, shared by all clients of the same Jumpserver.
+    """
+
+    DEFAULT_POOL_SIZE = 10
+
+    def __init__(self, base_url, pool_size=None, keep_alive=True, timeout=None):
+        """
+
+        :param base_url: Jumpserver base url
+        :param pool_size: max connections kept alive in pool
+        :param keep_alive: reuse connections or not
+        :param timeout: seconds to wait for connect and response
+        """
+        self.base_url = base_url
+        self.pool_size = pool_size or self.DEFAULT_POOL_SIZE
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self._session = requests.Session()
+        self._session.mount('http://', self._adapter)
+        self._session.mount('https://', self._adapter)
+        if not keep_alive:
+            self._session.headers['Connection'] = 'close'
+
+    def request(self, method, url, **kwargs):
+        """
+        Send request through pooled session.
+
+        :param method:
+        :param url:
+        :param kwargs: other arguments for requests
+        :return: Response
+        :rtype: requests.Response
+        """
+        with self._lock:
+            self._requests += 1
+        if self.timeout and 'timeout' not in kwargs:
+            kwargs['timeout'] = self.timeout
+        return self._session.request(method=method, url=url, **kwargs)
+
+    def stats(self):
+        """
+        Connection reuse stats.
+
+        :return: dict
+        """
+        with self._lock:
+            num = self._requests
+        if self.keep_alive:
+            connections = 0
+            pools = self._adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+        else:
+            # every request opens a new connection
+            connections = num
+        return {
+            'requests': num,
+            'connections': connections,
+            'reused': max(num - connections, 0)
+        }
+
+    def close(self):
+        self._session.close()
+
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport(settings):
+    """
+    Get shared transport for Jumpserver configured in settings.
+
+    :param settings:
+    :return: HttpTransport
+    """
+    base_url = settings.get(CONF_BASE_URL_KEY) or ''
+    with _transports_lock:
+        if base_url not in _transports:
+            _transports[base_url] = HttpTransport(
+                base_url=base_url,
+                pool_size=settings.get(CONF_POOL_SIZE_KEY, None),
+                keep_alive=settings.get(CONF_KEEP_ALIVE_KEY, True),
+                timeout=settings.get(CONF_TIMEOUT_KEY, None)
+            )
+        return _transports[base_url]
+
+
+def report_transport_stats():
+    """
+    Log connection reuse stats of all transports.
+
+    :return:
+    """
+    with _transports_lock:
+        transports = list(_transports.values())
+    for t in transports:
+        s = t.stats()
+        if s['requests'] > 0:
+            logging.info('Jumpserver {}: {} requests over {} connections, {} reused'.format(
+                t.base_url, s['requests'], s['connections'], s['reused']))
+
+
+def close_transports():
+    """
+    Close all transports.
+
+    :return:
+    """
+    with _transports_lock:
+        for t in _transports.values():
+            t.close()
+        _transports.clear()
@@ -0,0 +1,248 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from jumpserver_sync.utils import CONF_CACHE_DIR_KEY, CONF_MIRROR_KEY, CONF_MIRROR_PATH_KEY, CONF_MIRROR_RECONCILE_KEY
+from jumpserver_sync.jumpserver.codec import dumps, loads
+
+
+class AssetMirror:
+    """
+    Local SQLite mirror of Jumpserver assets, indexed by number, hostname, ip, account and region.
+    Written through by our own changes, and reconciled with Jumpserver periodically.
+    """
+
+    DEFAULT_FILE = 'assets.sqlite3'
+    DEFAULT_RECONCILE_INTERVAL = 3600
+    SELECT_BATCH = 500
+
+    INDEXED_FIELDS = ('number', 'hostname', 'ip', 'account', 'region')
+
+    def __init__(self, path, reconcile_interval=None):
+        """
+
+        :param path: database file, or :memory:
+        :param reconcile_interval: seconds to reconcile with Jumpserver
+        """
+        self.path = path
+        self.reconcile_interval = reconcile_interval if reconcile_interval is not None \
+            else self.DEFAULT_RECONCILE_INTERVAL
+        self._lock = threading.Lock()
+        self._reconcile_lock = threading.Lock()
+        # changes are also written to staging table while reconciling, ids of changed assets are kept
+        # so that listed rows older than changes are skipped
+        self._staging = False
+        self._changed = set()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._conn:
+            self._create_table('assets')
+            for f in self.INDEXED_FIELDS:
+                self._conn.execute('CREATE INDEX IF NOT EXISTS idx_assets_{0} ON assets ({0})'.format(f))
+            self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def is_stale(self, now=None):
+        """
+        Check whether mirror should be reconciled.
+
+        :param now:
+        :return: bool
+        """
+        reconciled_at = self.reconciled_at
+        if reconciled_at is None:
+            return True
+        if not self.reconcile_interval:
+            return False
+        return (now or time.time()) - reconciled_at >= self.reconcile_interval
+
+    @property
+    def reconciled_at(self):
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM meta WHERE key = ?', ('reconciled_at', )).fetchone()
+        return float(row[0]) if row else None
+
+    def reconcile(self, rows):
+        """
+        Replace all assets in mirror.
+        Rows are written to a staging table in batches while listed, and swapped into assets at the end,
+        so that lock is only held shortly and mirror is readable while listing.
+
+        :param rows: iterable of (asset, account, region)
+        :return: number of assets
+        """
+        with self._reconcile_lock:
+            with self._lock, self._conn:
+                self._conn.execute('DROP TABLE IF EXISTS assets_staging')
+                self._create_table('assets_staging')
+                self._staging = True
+                self._changed = set()
+            n = 0
+            try:
+                batch = []
+                for row in rows:
+                    batch.append(row)
+                    if len(batch) >= self.SELECT_BATCH:
+                        n += self._stage(batch)
+                        batch = []
+                n += self._stage(batch)
+                with self._lock, self._conn:
+                    self._conn.execute('DELETE FROM assets')
+                    self._conn.execute('INSERT INTO assets SELECT * FROM assets_staging')
+                    self._conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                                       ('reconciled_at', str(time.time())))
+            finally:
+                with self._lock, self._conn:
+                    self._staging = False
+                    self._changed = set()
+                    self._conn.execute('DROP TABLE IF EXISTS assets_staging')
+        logging.info('Reconciled {} assets to mirror {}'.format(n, self.path))
+        return n
+
+    def _stage(self, rows):
+        with self._lock, self._conn:
+            for asset, account, region in rows:
+                if asset['id'] not in self._changed:
+                    self._put(asset, account, region, table='assets_staging')
+        return len(rows)
+
+    def put(self, asset, account=None, region=None):
+        """
+        Insert or update asset.
+
+        :param asset: Jumpserver asset
+        :param account:
+        :param region:
+        :return:
+        """
+        if not asset or 'id' not in asset:
+            return
+        with self._lock, self._conn:
+            self._put(asset, account, region)
+            if self._staging:
+                self._put(asset, account, region, table='assets_staging')
+                self._changed.add(asset['id'])
+
+    def delete(self, asset_id):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM assets WHERE id = ?', (asset_id, ))
+            if self._staging:
+                self._conn.execute('DELETE FROM assets_staging WHERE id = ?', (asset_id, ))
+                self._changed.add(asset_id)
+
+    def get(self, asset_id):
+        """
+        Get asset by id.
+
+        :param asset_id:
+        :return: Jumpserver asset or None
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT data FROM assets WHERE id = ?', (asset_id, )).fetchone()
+        return loads(row[0]) if row else None
+
+    def find(self, **kwargs):
+        """
+        Find first asset by indexed fields, e.g. find(hostname='host').
+
+        :param kwargs: indexed field and value
+        :return: Jumpserver asset or None
+        """
+        where, params = self._where(kwargs)
+        with self._lock:
+            row = self._conn.execute('SELECT data FROM assets{} ORDER BY rowid LIMIT 1'.format(where),
+                                     params).fetchone()
+        return loads(row[0]) if row else None
+
+    def select(self, numbers=None, **kwargs):
+        """
+        Select assets by numbers and indexed fields lazily.
+
+        :param numbers: asset numbers
+        :param kwargs: indexed field and value
+        :return: generator of Jumpserver assets
+        """
+        if numbers is not None:
+            numbers = list(numbers)
+            for n in range(0, len(numbers), self.SELECT_BATCH):
+                batch = numbers[n:n + self.SELECT_BATCH]
+                where, params = self._where(kwargs)
+                where += (' AND' if where else ' WHERE') + ' number IN ({})'.format(','.join('?' * len(batch)))
+                for a in self._select(where, params + list(batch)):
+                    yield a
+            return
+        where, params = self._where(kwargs)
+        for a in self._select(where, params):
+            yield a
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM assets').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _select(self, where, params):
+        # page by rowid, lock is not held while assets are consumed
+        last = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    'SELECT rowid, data FROM assets{} ORDER BY rowid LIMIT {}'.format(
+                        (where + ' AND' if where else ' WHERE') + ' rowid > ?', self.SELECT_BATCH),
+                    params + [last]
+                ).fetchall()
+            for rowid, data in rows:
+                last = rowid
+                yield loads(data)
+            if len(rows) < self.SELECT_BATCH:
+                return
+
+    def _where(self, fields):
+        conds = []
+        params = []
+        for k, v in fields.items():
+            if k not in self.INDEXED_FIELDS:
+                raise ValueError('Field {} is not indexed'.format(k))
+            conds.append('{} = ?'.format(k))
+            params.append(v)
+        return (' WHERE ' + ' AND '.join(conds)) if conds else '', params
+
+    def _put(self, asset, account, region, table='assets'):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO {} (id, number, hostname, ip, account, region, data) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)'.format(table),
+            (asset['id'], asset.get('number'), asset.get('hostname'), asset.get('ip'), account, region,
+             dumps(asset))
+        )
+
+    def _create_table(self, table):
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS {} (id TEXT PRIMARY KEY, number TEXT, hostname TEXT, ip TEXT, '
+            'account TEXT, region TEXT, data BLOB NOT NULL)'.format(table)
+        )
+
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def get_mirror(settings):
+    """
+    Get shared asset mirror configured in settings.
+
+    :param settings:
+    :return: AssetMirror, or None if mirror is disabled
+    """
+    if not settings.get(CONF_MIRROR_KEY, False):
+        return None
+    path = settings.get(CONF_MIRROR_PATH_KEY, None)
+    if not path:
+        cache_dir = settings.get(CONF_CACHE_DIR_KEY, '.jumpserver_dir') or '.'
+        os.makedirs(cache_dir, exist_ok=True)
+        path = os.path.join(cache_dir, AssetMirror.DEFAULT_FILE)
+    with _mirrors_lock:
+        if path not in _mirrors:
+            _mirrors[path] = AssetMirror(path=path,
+                                         reconcile_interval=settings.get(CONF_MIRROR_RECONCILE_KEY, None))
+        return _mirrors[path]
@@ -0,0 +1,108 @@
+import hashlib
+import json
+from jumpserver_sync.cache import get_cache
+from jumpserver_sync.utils import CONF_PAYLOAD_TTL_KEY, CONF_BASE_URL_KEY
+
+
+class PayloadStore:
+    """
+    Last payload successfully written to Jumpserver for each asset id, kept in the shared cache.
+    Used to skip writes of unchanged assets and to send only changed fields.
+    """
+
+    DEFAULT_TTL = 86400
+
+    def __init__(self, cache, ttl=None, scope=''):
+        """
+
+        :param cache: TieredCache
+        :param ttl: seconds to keep payload, assets are fully written again after expired, never expire if 0
+        :param scope: Jumpserver base url, so that Jumpservers sharing the cache do not overwrite payloads
+        """
+        self.cache = cache
+        self.ttl = self.DEFAULT_TTL if ttl is None else ttl
+        self.scope = scope or ''
+
+    def get(self, asset_id):
+        """
+        Get last written payload.
+
+        :param asset_id: Jumpserver asset id
+        :return: tuple of digest and payload, or None if not found
+        """
+        if not asset_id:
+            return None
+        val = self.cache.get(self.key(asset_id))
+        return tuple(val) if val else None
+
+    def put(self, asset_id, payload):
+        """
+        Record payload written for asset.
+
+        :param asset_id: Jumpserver asset id
+        :param payload: Jumpserver asset data
+        :return:
+        """
+        if not asset_id:
+            return
+        payload = self.normalize(payload)
+        self.cache.set(self.key(asset_id), [self.digest(payload), payload], expire=self.ttl or 0)
+
+    def delete(self, asset_id):
+        if asset_id:
+            self.cache.delete(self.key(asset_id))
+
+    def diff(self, asset_id, payload):
+        """
+        Fields changed since last written.
+
+        :param asset_id: Jumpserver asset id
+        :param payload: Jumpserver asset data
+        :return: dict of changed fields, empty if unchanged, or None if unknown or fields are removed
+        """
+        last = self.get(asset_id)
+        if last is None:
+            return None
+        digest, old = last
+        new = self.normalize(payload)
+        if digest == self.digest(new):
+            return {}
+        if any(k not in new for k in old):
+            # fields can not be removed by partial update
+            return None
+        return {k: payload[k] for k, v in new.items() if old.get(k) != v}
+
+    def key(self, asset_id):
+        return 'payload:{}:{}'.format(self.scope, asset_id)
+
+    @staticmethod
+    def normalize(payload):
+        """
+        Payload without id, and lists are sorted so that order is not compared.
+
+        :param payload:
+        :return: dict
+        """
+        data = {}
+        for k, v in payload.items():
+            if k == 'id':
+                continue
+            if isinstance(v, (list, tuple)):
+                v = sorted(str(i) for i in v)
+            data[k] = v
+        return data
+
+    @staticmethod
+    def digest(payload):
+        return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def get_payload_store(settings):
+    """
+    Get payload store on the shared cache configured in settings.
+
+    :param settings:
+    :return: PayloadStore
+    """
+    return PayloadStore(cache=get_cache(settings), ttl=settings.get(CONF_PAYLOAD_TTL_KEY, None),
+                        scope=settings.get(CONF_BASE_URL_KEY, None))
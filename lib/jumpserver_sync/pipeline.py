@@ -0,0 +1,287 @@
+import logging
+import queue
+import threading
+import time
+from jumpserver_sync.utils import CONF_QUEUE_SIZE_KEY
+
+
+class Stage:
+    """
+    One stage of pipeline, items are processed by its own workers.
+    """
+
+    BATCH_WAIT = 0.5
+
+    def __init__(self, name, func, concurrency=1, batch_size=None, expand=False):
+        """
+
+        :param name: stage name in logs
+        :param func: function with one item argument, or list of items if batch_size is set,
+            return None to drop the item
+        :param concurrency: number of workers
+        :param batch_size: max items to process together, wait at most BATCH_WAIT seconds for a full batch
+        :param expand: func returns iterable of items to pass to next stage
+        """
+        self.name = name
+        self.func = func
+        self.concurrency = max(concurrency or 1, 1)
+        self.batch_size = batch_size
+        self.expand = expand or bool(batch_size)
+        self._lock = threading.Lock()
+        self.errors = []
+        self.stats = {
+            'in': 0,
+            'out': 0,
+            'failed': 0,
+            'busy': 0.0
+        }
+
+    def process(self, items):
+        """
+        Call func for items.
+
+        :param items: one item, or list of items if batch_size is set
+        :return: list of output items
+        """
+        start = time.monotonic()
+        try:
+            res = self.func(items)
+        except Exception as e:
+            logging.debug('Failed to process {} in stage {}: {}'.format(items, self.name, e))
+            with self._lock:
+                self.errors.append((items, e))
+                self.stats['failed'] += len(items) if self.batch_size else 1
+            res = None
+        outputs = [r for r in (res or []) if r is not None] if self.expand else ([] if res is None else [res])
+        with self._lock:
+            self.stats['in'] += len(items) if self.batch_size else 1
+            self.stats['out'] += len(outputs)
+            self.stats['busy'] += time.monotonic() - start
+        return outputs
+
+    def report(self):
+        """
+        Log stage stats and errors grouped by error message, and clear errors.
+
+        :return: list of (item, exception)
+        """
+        with self._lock:
+            errors = self.errors
+            self.errors = []
+            s = dict(self.stats)
+        logging.info('Stage {}: {} in, {} out, {} failed, busy {:.2f}s by {} workers'.format(
+            self.name, s['in'], s['out'], s['failed'], s['busy'], self.concurrency))
+        groups = {}
+        for _, e in errors:
+            msg = '{}: {}'.format(type(e).__name__, e)
+            groups[msg] = groups.get(msg, 0) + 1
+        for msg, n in sorted(groups.items(), key=lambda x: -x[1]):
+            logging.error('{} items failed in stage {} with {}'.format(n, self.name, msg))
+        return errors
+
+
+class Pipeline:
+    """
+    Stream items from source through stages connected by bounded queues.
+    Stages run concurrently, so that memory is bounded by queue sizes and slow stages apply backpressure.
+    """
+
+    DEFAULT_QUEUE_SIZE = 100
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, source, stages, queue_size=None):
+        """
+
+        :param source: iterable of items, consumed in a background thread
+        :param stages: list of Stage
+        :param queue_size: max items waiting before each stage
+        """
+        self.source = source
+        self.stages = stages
+        self.queue_size = queue_size or self.DEFAULT_QUEUE_SIZE
+        self._stop = threading.Event()
+        self.source_errors = []
+
+    def run(self):
+        """
+        Start stages and yield outputs of the last stage in completion order.
+        Stop all stages if interrupted, running items are finished.
+
+        :return: output generator
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(queues[0], ), name='pipeline-source', daemon=True)]
+        for i, stage in enumerate(self.stages):
+            remaining = [stage.concurrency]
+            lock = threading.Lock()
+            for n in range(stage.concurrency):
+                threads.append(threading.Thread(
+                    target=self._work, args=(stage, queues[i], queues[i + 1], remaining, lock),
+                    name='pipeline-{}-{}'.format(stage.name, n), daemon=True
+                ))
+        for t in threads:
+            t.start()
+        try:
+            while True:
+                try:
+                    item = queues[-1].get(timeout=self.POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+                if item is _end:
+                    break
+                yield item
+        except (KeyboardInterrupt, GeneratorExit):
+            self._stop.set()
+            logging.warning('Pipeline stopped, waiting for running items to finish')
+            raise
+        finally:
+            self._stop.set()
+            for t in threads:
+                t.join()
+
+    def report(self):
+        """
+        Log stats of all stages.
+
+        :return:
+        """
+        for e in self.source_errors:
+            logging.error('Failed to read pipeline source: {}'.format(e))
+        for stage in self.stages:
+            stage.report()
+
+    def _feed(self, out_q):
+        try:
+            for item in self.source:
+                if not self._put(out_q, item):
+                    return
+        except Exception as e:
+            self.source_errors.append(e)
+        self._put(out_q, _end)
+
+    def _work(self, stage, in_q, out_q, remaining, lock):
+        try:
+            self._consume(stage, in_q, out_q)
+        finally:
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self._put(out_q, _end)
+
+    def _consume(self, stage, in_q, out_q):
+        batch = []
+        while not self._stop.is_set():
+            try:
+                item = in_q.get(timeout=stage.BATCH_WAIT if batch else self.POLL_INTERVAL)
+            except queue.Empty:
+                if batch:
+                    # flush partial batch while upstream is slow
+                    if not self._emit(stage, batch, out_q):
+                        return
+                    batch = []
+                continue
+            if item is _end:
+                # let sibling workers see the end too
+                in_q.put(item)
+                break
+            if stage.batch_size:
+                batch.append(item)
+                if len(batch) >= stage.batch_size:
+                    if not self._emit(stage, batch, out_q):
+                        return
+                    batch = []
+            elif not self._emit(stage, item, out_q):
+                return
+        if batch and not self._stop.is_set():
+            self._emit(stage, batch, out_q)
+
+    def _emit(self, stage, items, out_q):
+        for r in stage.process(items):
+            if not self._put(out_q, r):
+                return False
+        return True
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=self.POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+_end = object()
+
+
+def merge_sources(sources, queue_size=None):
+    """
+    Consume sources concurrently and yield their items in arrival order.
+    Error of any source is raised after items of other sources are consumed.
+
+    :param sources: list of iterables
+    :param queue_size: max items waiting to be consumed
+    :return: item generator
+    """
+    sources = list(sources)
+    if len(sources) == 1:
+        for item in sources[0]:
+            yield item
+        return
+    q = queue.Queue(maxsize=queue_size or Pipeline.DEFAULT_QUEUE_SIZE)
+    stop = threading.Event()
+    errors = []
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=Pipeline.POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def feed(source):
+        try:
+            for item in source:
+                if not put(item):
+                    return
+        except Exception as e:
+            logging.error('Failed to read source: {}'.format(e))
+            errors.append(e)
+        put(_end)
+
+    threads = [threading.Thread(target=feed, args=(s, ), name='source-{}'.format(i), daemon=True)
+               for i, s in enumerate(sources)]
+    for t in threads:
+        t.start()
+    remaining = len(threads)
+    try:
+        while remaining:
+            try:
+                item = q.get(timeout=Pipeline.POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if item is _end:
+                remaining -= 1
+                continue
+            yield item
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+
+
+def get_pipeline(settings, source, stages):
+    """
+    Get pipeline by queue size configured in settings.
+
+    :param settings:
+    :param source: iterable of items
+    :param stages: list of Stage
+    :return: Pipeline
+    """
+    return Pipeline(source=source, stages=stages, queue_size=settings.get(CONF_QUEUE_SIZE_KEY, None))
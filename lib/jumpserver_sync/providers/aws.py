@@ -24,8 +24,7 @@ class AwsAssetsProvider(AssetsProvider):
         self._session = None
         self._region = self.profile.config['region_name'] if 'region_name' in self.profile.config else None
 
-    def list_assets(self, asset_ids=None, **kwargs):
-        limit = kwargs['limit'] if 'limit' in kwargs else None
+    def iter_instances(self, asset_ids=None):
         ec2 = self.session.resource('ec2')
         if asset_ids:
             # provide instances id list
@@ -35,38 +34,19 @@ class AwsAssetsProvider(AssetsProvider):
         else:
             # list all instances
             ins_list = ec2.instances.all()
-        generated = 0
         try:
             for instance in ins_list:
                 # only running instance
                 if instance.state['Name'] != 'running':
                     continue
                 # create asset
-                asset = self.create_asset_from_resource(
+                yield self.create_asset_from_resource(
                     instance=instance,
                     account=self.profile.profile_name,
                     region=self._region
                 )
-                # check is ignored
-                if self.is_ignored(asset):
-                    logging.info('Ignore instance {} because user add ignore tag or no Name tag!'.format(asset))
-                    continue
-                # select asset
-                selected = False
-                for selector in self.get_tag_selectors():
-                    a = selector.select(asset)
-                    if a is not None:
-                        selected = True
-                        logging.info('Generate instance asset {}'.format(a))
-                        generated += 1
-                        yield a
-                if not selected:
-                    logging.info('Instance asset {} did not match any selector, skip'.format(asset))
-                if limit and generated >= limit:
-                    break
         except ClientError as e:
             logging.error(str(e))
-        logging.info('Generated {} instances'.format(generated))
 
     @classmethod
     def create_asset_from_resource(cls, instance, account, region):
@@ -1,6 +1,7 @@
+import logging
 import re
-from jumpserver_sync.utils import JumpserverError, object_format, import_string, Profile, CONF_PROFILES_KEY, \
-    CONF_TAG_SELECTORS_KEY, CONF_PROFILE_KEY, CONF_PROVIDERS_KEY
+from jumpserver_sync.utils import JumpserverError, object_format, import_string, Profile, Shard, CONF_PROFILES_KEY, \
+    CONF_TAG_SELECTORS_KEY, CONF_PROFILE_KEY, CONF_PROVIDERS_KEY, CONF_SHARD_KEY
 from jumpserver_sync.jumpserver import LabelTag
 
 
@@ -179,6 +180,7 @@ class AssetsProvider(BaseProvider):
     def __init__(self, settings, provider_type, provider_name):
         super().__init__(settings, provider_type, provider_name)
         self._selectors = []
+        self._shard = Shard.parse(self.settings.get(CONF_SHARD_KEY, None))
 
     def get_tag_selectors(self):
         """
@@ -196,13 +198,61 @@ class AssetsProvider(BaseProvider):
 
     def list_assets(self, asset_ids=None, **kwargs):
         """
-        List assets.
+        List selected assets.
 
         :param asset_ids: asset id or id list
-        :param kwargs:
+        :param kwargs: limit
         :return: asset generator
         """
-        pass
+        limit = kwargs['limit'] if 'limit' in kwargs else None
+        generated = 0
+        for asset in self.iter_instances(asset_ids=asset_ids):
+            for a in self.select_asset(asset):
+                generated += 1
+                yield a
+            if limit and generated >= limit:
+                break
+        logging.info('Generated {} instances'.format(generated))
+
+    def iter_instances(self, asset_ids=None):
+        """
+        List instances from provider as assets without selection.
+
+        :param asset_ids: asset id or id list
+        :return: asset generator
+        """
+        return iter(())
+
+    def select_asset(self, asset):
+        """
+        Select and update asset by tag selectors.
+
+        :param asset:
+        :return: list of selected assets, empty if ignored, not matched or in other shards
+        """
+        if not self.in_shard(asset):
+            return []
+        if self.is_ignored(asset):
+            logging.info('Ignore instance {} because user add ignore tag or no Name tag!'.format(asset))
+            return []
+        selected = []
+        for selector in self.get_tag_selectors():
+            a = selector.select(asset)
+            if a is not None:
+                logging.info('Generate instance asset {}'.format(a))
+                selected.append(a)
+        if not selected:
+            logging.info('Instance asset {} did not match any selector, skip'.format(asset))
+        return selected
+
+    def in_shard(self, asset):
+        """
+        Check whether asset is in the shard handled by this worker.
+
+        :param asset:
+        :return: bool
+        """
+        return self._shard is None or self._shard.contains(asset.number)
 
     def is_ignored(self, asset):
         """
@@ -1,3 +1,4 @@
+import zlib
 from importlib import import_module
 
 
@@ -5,8 +6,34 @@ CONF_BASE_URL_KEY = 'jumpserver.base_url'
 CONF_USER_KEY = 'jumpserver.user'
 CONF_PWD_KEY = 'jumpserver.password'
 CONF_LOGIN_URL_KEY = 'jumpserver.login_url'
+CONF_TOKEN_TTL_KEY = 'jumpserver.token_ttl'
+CONF_TOKEN_REFRESH_KEY = 'jumpserver.token_refresh_before'
+CONF_POOL_SIZE_KEY = 'jumpserver.pool_size'
+CONF_KEEP_ALIVE_KEY = 'jumpserver.keep_alive'
+CONF_TIMEOUT_KEY = 'jumpserver.timeout'
+CONF_PAGE_SIZE_KEY = 'jumpserver.page_size'
+CONF_PREFETCH_KEY = 'jumpserver.prefetch'
+CONF_BULK_SIZE_KEY = 'jumpserver.bulk_size'
+CONF_RATE_LIMIT_KEY = 'jumpserver.rate_limit'
+CONF_RATE_BURST_KEY = 'jumpserver.rate_burst'
+CONF_MAX_RETRIES_KEY = 'jumpserver.max_retries'
+CONF_BACKOFF_FACTOR_KEY = 'jumpserver.backoff_factor'
+CONF_BACKOFF_MAX_KEY = 'jumpserver.backoff_max'
+CONF_RETRY_AFTER_MAX_KEY = 'jumpserver.retry_after_max'
+CONF_BREAKER_THRESHOLD_KEY = 'jumpserver.breaker_threshold'
+CONF_BREAKER_COOLDOWN_KEY = 'jumpserver.breaker_cooldown'
 CONF_CACHE_DIR_KEY = 'cache.dir'
 CONF_CACHE_TTL_KEY = 'cache.ttl'
+CONF_CACHE_TTLS_KEY = 'cache.ttls'
+CONF_CACHE_MEMORY_SIZE_KEY = 'cache.memory_size'
+CONF_CACHE_MISS_TTL_KEY = 'cache.miss_ttl'
+CONF_PAYLOAD_TTL_KEY = 'cache.payload_ttl'
+CONF_CACHE_BACKEND_KEY = 'cache.backend'
+CONF_CACHE_URL_KEY = 'cache.url'
+CONF_CACHE_PREFIX_KEY = 'cache.prefix'
+CONF_MIRROR_KEY = 'cache.mirror'
+CONF_MIRROR_PATH_KEY = 'cache.mirror_path'
+CONF_MIRROR_RECONCILE_KEY = 'cache.mirror_reconcile_interval'
 CONF_LOG_LEVEL_KEY = 'log.log_level'
 CONF_LOG_FORMATTER_KEY = 'log.log_formatter'
 CONF_PROFILES_KEY = 'profiles'
@@ -14,6 +41,7 @@ CONF_PROVIDERS_KEY = 'provider_cls'
 CONF_TAG_SELECTORS_KEY = 'tag_selectors'
 CONF_PROVIDER_KEY = 'app.provider'
 CONF_PROFILE_KEY = 'app.profile'
+CONF_ALL_PROFILES_KEY = 'app.all_profiles'
 CONF_TEST_ASSET_KEY = 'app.test_asset'
 CONF_PUSH_KEY = 'app.push'
 CONF_PUSH_CHECK_KEY = 'app.push_check'
@@ -28,6 +56,13 @@ CONF_INSTANCE_ALL_KEY = 'app.instance_all'
 CONF_LISTEN_PROVIDER_KEY = 'app.listen_provider'
 CONF_LISTEN_CONF_KEY = 'listening'
 CONF_LISTEN_INTERVAL_KEY = 'app.listen_interval'
+CONF_PRELOAD_KEY = 'app.preload'
+CONF_CONCURRENCY_KEY = 'app.concurrency'
+CONF_CHECK_CONCURRENCY_KEY = 'app.check_concurrency'
+CONF_QUEUE_SIZE_KEY = 'app.queue_size'
+CONF_RESUME_KEY = 'app.resume'
+CONF_SHARD_KEY = 'app.shard'
+CONF_FORCE_WRITE_KEY = 'app.force_write'
 
 
 class JumpserverError(Exception):
@@ -38,6 +73,14 @@ class JumpserverAuthError(JumpserverError):
     pass
 
 
+class JumpserverCircuitOpenError(JumpserverError):
+    pass
+
+
+class CacheBackendError(Exception):
+    pass
+
+
 def import_string(dotted_path):
     """
     Import a dotted module path and return the attribute/class designated by the
@@ -108,3 +151,50 @@ class Profile:
             )
         else:
             raise JumpserverError('Invalid profile {}'.format(profile_name))
+
+
+class Shard:
+    """
+    Partition of instances by stable hash of instance id, shard index is counted from 0.
+    """
+
+    def __init__(self, index, count):
+        """
+
+        :param index: shard index
+        :param count: number of shards
+        """
+        if count < 1 or not 0 <= index < count:
+            raise JumpserverError('Invalid shard {}/{}'.format(index, count))
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def parse(cls, value):
+        """
+        Parse shard like 0/4.
+
+        :param value:
+        :return: Shard or None if not sharded
+        """
+        if not value:
+            return None
+        try:
+            index, count = (int(v) for v in str(value).split('/'))
+        except ValueError:
+            raise JumpserverError('Invalid shard {}, should be like 0/4'.format(value))
+        return Shard(index=index, count=count)
+
+    def contains(self, key):
+        """
+        Check whether instance id is in this shard.
+
+        :param key: instance id
+        :return: bool
+        """
+        if not key:
+            return False
+        return zlib.crc32(str(key).encode('utf-8')) % self.count == self.index
+
+    def __str__(self):
+        return '{}/{}'.format(self.index, self.count)
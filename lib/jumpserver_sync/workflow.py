@@ -1,6 +1,15 @@
+import itertools
 import logging
 import time
-from jumpserver_sync.assets import AssetAgent
+from jumpserver_sync.assets import AssetAgent, AsyncAssetAgent
+from jumpserver_sync.executor import ConcurrentExecutor
+from jumpserver_sync.jumpserver.async_clients import run_coroutine
+from jumpserver_sync.jumpserver.transport import report_transport_stats
+from jumpserver_sync.jumpserver.policy import report_policy_stats
+from jumpserver_sync.jumpserver.breaker import get_breaker, report_breaker_stats
+from jumpserver_sync.jumpserver.clients import Asset, report_task_stats
+from jumpserver_sync.pipeline import Stage, get_pipeline, merge_sources
+from jumpserver_sync.journal import SyncJournal, get_journal
 from jumpserver_sync.providers.base import get_provider, AssetsProvider, TaskProvider
 from jumpserver_sync.utils import *
 
@@ -13,6 +22,7 @@ class Workflow:
     def __init__(self, settings):
         self._settings = settings
         self._agent = AssetAgent(settings=settings)
+        self._async_agent = AsyncAssetAgent(settings=settings, agent=self._agent)
 
     def run(self):
         """
@@ -21,11 +31,26 @@ class Workflow:
         :return:
         """
         try:
+            self.preload()
             return self.run_without_exception()
         except JumpserverError as e1:
             logging.error(e1)
         except ImportError as e2:
             logging.error(e2)
+        finally:
+            self.report()
+
+    def run_task(self):
+        """
+        Run workflow for a listened task, exceptions are raised so that the task is not finished.
+        Resources are preloaded once by the listener, not for each task.
+
+        :return:
+        """
+        try:
+            return self.run_without_exception()
+        finally:
+            self.report_task()
 
     def run_without_exception(self):
         """
@@ -35,6 +60,37 @@ class Workflow:
         """
         pass
 
+    def preload(self):
+        """
+        Preload reference resources before run if required.
+
+        :return:
+        """
+        if self.settings.get(CONF_PRELOAD_KEY, False) is True:
+            run_coroutine(self.async_agent.preload())
+
+    def report(self):
+        """
+        Report stats at the end of run.
+
+        :return:
+        """
+        self.report_task()
+        report_transport_stats()
+        report_policy_stats()
+        report_breaker_stats()
+        report_task_stats()
+
+    def report_task(self):
+        """
+        Report stats collected since last report, process-wide stats are left for the end of run.
+
+        :return:
+        """
+        self.agent.report_missing()
+        self.agent.report_writes()
+        self.agent.executor.report_errors()
+
     @property
     def settings(self):
         return self._settings
@@ -43,12 +99,30 @@ class Workflow:
     def agent(self):
         return self._agent
 
+    @property
+    def async_agent(self):
+        return self._async_agent
+
 
 class DumpSettings(Workflow):
 
     def run_without_exception(self):
         print(self.settings)
 
+    def report(self):
+        pass
+
+
+class CacheWarm(Workflow):
+    """
+    Login and load reference resources into cache.
+    """
+
+    def run_without_exception(self):
+        if self.settings.get(CONF_PRELOAD_KEY, False) is not True:
+            # not preloaded by run
+            run_coroutine(self.async_agent.preload())
+
 
 class AssetsSync(Workflow):
     """
@@ -59,120 +133,375 @@ class AssetsSync(Workflow):
     PROVIDER_TYPE = 'asset'
 
     def run_without_exception(self):
-        assets = self.sync_assets()
-        # test assets alive
-        if self.settings.get(CONF_TEST_ASSET_KEY, False) is True and len(assets) > 0:
-            self.check_assets_alive(assets)
-        # check system_user connect
-        if self.settings.get(CONF_PUSH_CHECK_KEY, False) is True and len(assets) > 0:
-            self.check_system_users_connective(assets)
+        # stream assets through all stages, so that synced assets are checked while others are still syncing
+        providers = self.get_asset_providers()
+        journal = self.open_journal()
+        select = self.select_stage(providers)
+        resume = Stage('resume', lambda a: None if journal.is_completed(a) else a)
+        stages = [select, resume] + self.sync_stages() + self.push_stages() + self.check_stages()
+        try:
+            n = self.run_pipeline(self.iter_instances(providers), stages, journal=journal)
+        finally:
+            journal.close()
+        skipped = resume.stats['in'] - resume.stats['out']
+        logging.info('Synced {} assets, skipped {} assets completed before'.format(n, skipped))
+        if n + skipped == select.stats['out']:
+            # all selected assets are completed, nothing to resume
+            journal.finish()
 
     def sync_assets(self):
         """
         Get and sync assets to Jumpserver.
 
-        :return: assets to sync
+        :return: synced assets
         """
-        assets = []
-        ins = self.settings.get(CONF_INSTANCE_IDS_KEY).split(',') \
-            if self.settings.get(CONF_INSTANCE_IDS_KEY, None) else None
+        providers = self.get_asset_providers()
+        stages = [self.select_stage(providers)] + self.sync_stages() + self.push_stages()
+        return self.run_pipeline(self.iter_instances(providers), stages, collect=True)
+
+    def open_journal(self):
+        """
+        Open progress journal of this sync, load completed assets if resume is required.
+        Journal is only recorded for syncs of all assets or if resume is required.
+
+        :return: SyncJournal
+        """
+        resume = self.settings.get(CONF_RESUME_KEY, False) is True
+        if not (resume or self.journaled):
+            return SyncJournal(path=None, plan=None).open()
+        return get_journal(self.settings, type(self).__name__, resume=resume)
+
+    @property
+    def journaled(self):
+        return self.settings.get(CONF_INSTANCE_ALL_KEY, False) is True
+
+    def get_asset_provider(self, settings=None):
+        """
+        Get assets provider configured in settings.
+
+        :param settings: settings of one profile, default is workflow settings
+        :return: AssetsProvider
+        """
+        settings = settings or self.settings
         provider = get_provider(
-            settings=self.settings,
+            settings=settings,
             provider_type=self.PROVIDER_TYPE,
-            provider_name=self.settings.get(CONF_PROVIDER_KEY, None)
+            provider_name=settings.get(CONF_PROVIDER_KEY, None)
         )
         if not isinstance(provider, AssetsProvider):
             raise JumpserverError('Invalid provider {}'.format(provider))
-        for a in provider.list_assets(asset_ids=ins):
-            a = self.agent.sync_asset(a)
-            if a:
-                assets.append(a)
-                # push system_user to assets
-                if self.settings.get(CONF_PUSH_KEY, False) is True:
-                    users = self.settings.get(CONF_PUSH_SYSTEM_USERS_KEY, None)
-                    if users:
-                        logging.info('Push system users {} to asset {}'.format(users, a))
-                        self.agent.push_system_users(asset_id=a.id, system_users=users)
-                    else:
-                        logging.info('Push all system users to asset {}'.format(a))
-                        self.agent.push_system_users(asset_id=a.id)
+        return provider
+
+    def get_asset_providers(self):
+        """
+        Get assets providers of all profiles to sync.
+
+        :return: dict of profile name and AssetsProvider
+        """
+        profiles = self.get_profiles()
+        if len(profiles) <= 1:
+            return {profiles[0] if profiles else None: self.get_asset_provider()}
+        return {p: self.get_asset_provider(self.profile_settings(p)) for p in profiles}
+
+    def get_profiles(self):
+        """
+        Profiles to sync, all configured profiles if --all-profiles, or comma separated --profile.
+
+        :return: list of profile names
+        """
+        if self.settings.get(CONF_ALL_PROFILES_KEY, False) is True:
+            return sorted(self.settings.get(CONF_PROFILES_KEY, None) or {})
+        profile = self.settings.get(CONF_PROFILE_KEY, None)
+        return [p.strip() for p in profile.split(',') if p.strip()] if profile else []
+
+    def profile_settings(self, profile):
+        """
+        Settings for one profile.
+
+        :param profile: profile name
+        :return: Settings
+        """
+        settings = self.settings.clone()
+        settings.set(CONF_PROFILE_KEY, profile)
+        return settings
+
+    @property
+    def shard(self):
+        """
+        Shard of instances handled by this worker.
+
+        :return: Shard or None if not sharded
+        """
+        return Shard.parse(self.settings.get(CONF_SHARD_KEY, None))
+
+    def get_asset_profile(self, asset):
+        """
+        Profile of Jumpserver asset from meta data in comment.
+
+        :param asset:
+        :return: profile name or None
+        """
+        return (asset.extract_comment() or {}).get(self.META_PROFILE_KEY)
+
+    def iter_instances(self, providers):
+        """
+        List instances of all providers concurrently.
+
+        :param providers: dict of profile name and AssetsProvider
+        :return: asset generator
+        """
+        ins = self.get_instance_ids()
+        return merge_sources([p.iter_instances(asset_ids=ins) for p in providers.values()],
+                             queue_size=self.settings.get(CONF_QUEUE_SIZE_KEY, None))
+
+    def select_stage(self, providers):
+        """
+        Stage to select instances by provider of their profile.
+
+        :param providers: dict of profile name and AssetsProvider
+        :return: Stage
+        """
+        default = next(iter(providers.values())) if len(providers) == 1 else None
+
+        def select(asset):
+            provider = default or providers[asset.account]
+            return provider.select_asset(asset)
+
+        return Stage('select', select, expand=True)
+
+    def get_instance_ids(self):
+        """
+        Instance ids specified in settings.
+
+        :return: list or None
+        """
+        return self.settings.get(CONF_INSTANCE_IDS_KEY).split(',') \
+            if self.settings.get(CONF_INSTANCE_IDS_KEY, None) else None
+
+    def sync_stages(self):
+        """
+        Stages to link and write selected assets.
+        Each write worker sends its requests one by one, so that concurrent requests are bounded by concurrency.
+
+        :return: list of Stage
+        """
+        concurrency = self.settings.get(CONF_CONCURRENCY_KEY, None)
+        bulk_size = self.settings.get(CONF_BULK_SIZE_KEY, None) or self.agent.DEFAULT_BULK_SIZE
+        return [
+            Stage('link', self.agent.prepare_asset, concurrency=concurrency),
+            Stage('write', lambda assets: self.agent.bulk_write_assets(assets, concurrency=1),
+                  concurrency=concurrency, batch_size=bulk_size),
+        ]
+
+    def push_stages(self):
+        """
+        Stage to push system_users to synced assets if required.
+
+        :return: list of Stage
+        """
+        if self.settings.get(CONF_PUSH_KEY, False) is not True:
+            return []
+        users = self.settings.get(CONF_PUSH_SYSTEM_USERS_KEY, None)
+
+        def push(asset):
+            self.agent.push_system_users(asset_id=asset.id, system_users=users)
+            return asset
+
+        return [Stage('push', push, concurrency=self.check_concurrency)]
+
+    def check_stages(self):
+        """
+        Stages to test assets alive and check system_users connective if required.
+
+        :return: list of Stage
+        """
+        # tasks of each batch are tracked together by task monitor
+        bulk_size = self.settings.get(CONF_BULK_SIZE_KEY, None) or self.agent.DEFAULT_BULK_SIZE
+        stages = []
+        if self.settings.get(CONF_TEST_ASSET_KEY, False) is True:
+            stages.append(Stage('test', self.check_assets_alive, concurrency=self.check_concurrency,
+                                batch_size=bulk_size))
+        if self.settings.get(CONF_PUSH_CHECK_KEY, False) is True:
+            stages.append(Stage('push_check', self.check_system_users_connective, concurrency=self.check_concurrency,
+                                batch_size=bulk_size))
+        return stages
+
+    def run_pipeline(self, source, stages, collect=False, journal=None):
+        """
+        Run assets through stages and report stats of stages.
+
+        :param source: iterable of assets
+        :param stages: list of Stage
+        :param collect: return outputs instead of number of outputs
+        :param journal: SyncJournal to record completed assets
+        :return: list of outputs or number of outputs
+        :raise JumpserverError: if source or any stage failed
+        """
+        pipeline = get_pipeline(self.settings, source=source, stages=stages)
+        outputs = []
+        n = 0
+        try:
+            for a in pipeline.run():
+                if journal is not None:
+                    journal.complete(a)
+                if collect:
+                    outputs.append(a)
+                n += 1
+        finally:
+            failed = len(pipeline.source_errors) + sum(len(s.errors) for s in stages)
+            pipeline.report()
+        if failed:
+            raise JumpserverError('Failed to sync assets, {} errors in pipeline after {} assets completed'
+                                  .format(failed, n))
+        return outputs if collect else n
+
+    def sync_many(self, assets):
+        """
+        Sync assets by bulk requests and push system_users concurrently if required.
+
+        :param assets:
+        :return: synced assets
+        """
+        if not assets:
+            return []
+        assets = [a for a in self.agent.bulk_sync_assets(assets) if a]
+        if assets and self.settings.get(CONF_PUSH_KEY, False) is True:
+            users = self.settings.get(CONF_PUSH_SYSTEM_USERS_KEY, None)
+            run_coroutine(self.async_agent.push_assets(assets, system_users=users))
         return assets
 
+    def update_many(self, assets):
+        """
+        Update assets with known id by bulk requests.
+        Payload store is not checked since assets are compared with Jumpserver already.
+
+        :param assets:
+        :return: updated assets
+        """
+        if not assets:
+            return []
+        return [a for a in self.agent.bulk_write_assets(assets, force=True) if a]
+
+    def delete_many(self, asset_ids):
+        """
+        Delete assets concurrently.
+
+        :param asset_ids:
+        :return: number of deleted assets
+        """
+        if not asset_ids:
+            return 0
+        res = run_coroutine(self.async_agent.delete_assets(asset_ids))
+        return len([r for r in res if r])
+
     def check_assets_alive(self, assets):
         """
-        Check whether assets is alive.
+        Check whether assets is alive, tasks are started together and waited together.
 
         :param assets:
-        :return:
+        :return: assets
         """
-        timeout = self.settings.get(CONF_CHECK_TIMEOUT_KEY)
-        interval = self.settings.get(CONF_CHECK_INTERVAL_KEY)
-        show_log = self.settings.get(CONF_SHOW_TASK_LOG_KEY)
         logging.info('Check assets alive ...')
-        for a in assets:
-            res = self.agent.check_assets_alive(asset_id=a.id, timeout=timeout, interval=interval, show_output=show_log)
-            if res is True:
-                logging.info('Asset {} is alive.'.format(a))
-            else:
-                logging.error('Asset {} is not alive!'.format(a))
+        futures = [(a, self.submit_asset_alive(a)) for a in assets]
+        for a, f in futures:
+            self.log_alive(a, f.result())
+        return [a for a, _ in futures]
+
+    def submit_asset_alive(self, asset):
+        """
+        Start task to check asset alive.
+
+        :param asset:
+        :return: Future of whether asset is alive
+        """
+        return self.agent.submit_asset_alive(
+            asset_id=asset.id,
+            timeout=self.settings.get(CONF_CHECK_TIMEOUT_KEY),
+            interval=self.settings.get(CONF_CHECK_INTERVAL_KEY),
+            show_output=self.settings.get(CONF_SHOW_TASK_LOG_KEY)
+        )
+
+    def iter_alive(self, assets):
+        """
+        Check assets alive lazily, tasks of each batch are started together and waited together.
+
+        :param assets: iterable of assets
+        :return: generator of asset and whether it is alive
+        """
+        it = iter(assets)
+        size = self.settings.get(CONF_BULK_SIZE_KEY, None) or self.agent.DEFAULT_BULK_SIZE
+        while True:
+            futures = [(a, self.submit_asset_alive(a)) for a in itertools.islice(it, size)]
+            if not futures:
+                return
+            for a, f in futures:
+                yield a, f.result()
+
+    @staticmethod
+    def log_alive(asset, alive):
+        if alive is True:
+            logging.info('Asset {} is alive.'.format(asset))
+        else:
+            logging.error('Asset {} is not alive!'.format(asset))
 
     def check_system_users_connective(self, assets):
         """
-        Check whether system users is pushed to assets.
+        Check whether system users is pushed to assets, tasks of all assets are started together in each round.
 
         :param assets:
-        :return:
+        :return: assets
         """
-        timeout = self.settings.get(CONF_CHECK_TIMEOUT_KEY)
-        interval = self.settings.get(CONF_CHECK_INTERVAL_KEY)
-        max_tries = self.settings.get(CONF_CHECK_MAX_TRIES_KEY)
-        show_log = self.settings.get(CONF_SHOW_TASK_LOG_KEY)
-        force_push = self.settings.get(CONF_FORCE_PUSH_KEY)
-        users = self.settings.get(CONF_PUSH_SYSTEM_USERS_KEY, None)
         logging.info('Push system_users to assets ...')
-        for a in assets:
-            self.agent.push_check_system_users(
-                asset_id=a.id,
-                system_users=users,
-                timeout=timeout,
-                interval=interval,
-                max_tries=max_tries,
-                show_output=show_log,
-                force_push=force_push
-            )
+        assets = list(assets)
+        self.agent.push_check_assets(
+            asset_ids=[a.id for a in assets],
+            system_users=self.settings.get(CONF_PUSH_SYSTEM_USERS_KEY, None),
+            timeout=self.settings.get(CONF_CHECK_TIMEOUT_KEY),
+            interval=self.settings.get(CONF_CHECK_INTERVAL_KEY),
+            max_tries=self.settings.get(CONF_CHECK_MAX_TRIES_KEY),
+            show_output=self.settings.get(CONF_SHOW_TASK_LOG_KEY),
+            force_push=self.settings.get(CONF_FORCE_PUSH_KEY)
+        )
+        return assets
+
+    @property
+    def check_concurrency(self):
+        return self.settings.get(CONF_CHECK_CONCURRENCY_KEY, None) or self.settings.get(CONF_CONCURRENCY_KEY, None)
 
 
 class AssetsCheckSync(AssetsSync):
 
+    def run_without_exception(self):
+        self.sync_assets()
+
     def sync_assets(self):
-        timeout = self.settings.get(CONF_CHECK_TIMEOUT_KEY)
-        interval = self.settings.get(CONF_CHECK_INTERVAL_KEY)
-        show_log = self.settings.get(CONF_SHOW_TASK_LOG_KEY)
-        profile = self.settings.get(CONF_PROFILE_KEY, None)
-        ins = self.settings.get(CONF_INSTANCE_IDS_KEY).split(',') \
-            if self.settings.get(CONF_INSTANCE_IDS_KEY, None) else None
-        jms_assets = []
-        # get all assets from Jumpserver by profile
-        for a in self.agent.list_assets():
-            if ins:
-                if a.number in ins:
-                    jms_assets.append(a)
-            else:
-                if profile:
-                    comment = a.extract_comment()
-                    if self.META_PROFILE_KEY in comment and comment[self.META_PROFILE_KEY] == profile:
-                        jms_assets.append(a)
-                else:
-                    jms_assets.append(a)
-        for a in jms_assets:
-            res = self.agent.check_assets_alive(asset_id=a.id, timeout=timeout, interval=interval, show_output=show_log)
+        for a, res in self.iter_alive(self.select_jms_assets()):
             if res:
                 logging.info('Instance {} alive'.format(a))
             else:
                 logging.warning('Instance {} not alive'.format(a))
 
+    def select_jms_assets(self):
+        """
+        Select assets from Jumpserver by instance ids or profile lazily.
 
-class AssetsCleanSync(AssetsSync):
+        :return: assets generator
+        """
+        profiles = self.get_profiles()
+        ins = self.get_instance_ids()
+        shard = self.shard
+        if ins:
+            assets = self.agent.select_assets(numbers=ins)
+        elif len(profiles) > 1:
+            assets = (a for a in self.agent.select_assets() if self.get_asset_profile(a) in profiles)
+        else:
+            assets = self.agent.select_assets(meta={self.META_PROFILE_KEY: profiles[0]} if profiles else None)
+        if shard is None:
+            return assets
+        return (a for a in assets if shard.contains(a.number))
+
+
+class AssetsCleanSync(AssetsCheckSync):
     """
     Clean assets in Jumpserver.
     If provide --profile option, will only delete assets from specified profile.
@@ -180,41 +509,16 @@ class AssetsCleanSync(AssetsSync):
     """
 
     def sync_assets(self):
-        jms_assets = []
-        del_assets = []
-        profile = self.settings.get(CONF_PROFILE_KEY, None)
-        ins = self.settings.get(CONF_INSTANCE_IDS_KEY).split(',') \
-            if self.settings.get(CONF_INSTANCE_IDS_KEY, None) else None
-        # get all assets from Jumpserver by profile
-        for a in self.agent.list_assets():
-            if ins:
-                if a.number in ins:
-                    del_assets.append(a)
-            else:
-                if profile:
-                    comment = a.extract_comment()
-                    if comment and self.META_PROFILE_KEY in comment and comment[self.META_PROFILE_KEY] == profile:
-                        jms_assets.append(a)
-                else:
-                    jms_assets.append(a)
-        # check assets alive if not specify --all
-        if self.settings.get(CONF_INSTANCE_ALL_KEY, False) is False:
-            timeout = self.settings.get(CONF_CHECK_TIMEOUT_KEY)
-            interval = self.settings.get(CONF_CHECK_INTERVAL_KEY)
-            show_log = self.settings.get(CONF_SHOW_TASK_LOG_KEY)
-            for a in jms_assets:
-                res = self.agent.check_assets_alive(asset_id=a.id, timeout=timeout, interval=interval,
-                                                    show_output=show_log)
-                if res is False:
-                    del_assets.append(a)
+        # only ids are kept, assets are deleted after listing so that pages are not shifted
+        check_alive = self.settings.get(CONF_INSTANCE_ALL_KEY, False) is False \
+            and not self.settings.get(CONF_INSTANCE_IDS_KEY, None)
+        if check_alive:
+            # check assets alive if not specify --all
+            del_assets = [a.id for a, res in self.iter_alive(self.select_jms_assets()) if res is False]
         else:
-            del_assets.extend(jms_assets)
+            del_assets = [a.id for a in self.select_jms_assets()]
         # assets to delete in Jumpserver
-        del_num = 0
-        for a in del_assets:
-            res = self.agent.delete_asset(a.id)
-            if res:
-                del_num += 1
+        del_num = self.delete_many(del_assets)
         logging.info('Delete {} assets'.format(del_num))
         return []
 
@@ -223,58 +527,101 @@ class AssetsSmartSync(AssetsSync):
     """
     Sync assets automatically.
     Add assets to Jumpserver if assets provided by provider not exists.
+    Update assets in Jumpserver if fields synced from provider are changed.
     Delete assets in Jumpserver if assets not exists in provider.
     """
 
+    @property
+    def journaled(self):
+        return True
+
+    def run_without_exception(self):
+        # assets to add and delete are known after all assets are listed, only checks are streamed
+        assets = self.sync_assets()
+        stages = self.check_stages()
+        if assets and stages:
+            self.run_pipeline(assets, stages)
+
     def sync_assets(self):
-        assets = []
-        profile = self.settings.get(CONF_PROFILE_KEY, None)
-        # get all assets from provider by profile
-        provider_assets_number = {}
-        provider_assets = []
-        provider = get_provider(
-            settings=self.settings,
-            provider_type=self.PROVIDER_TYPE,
-            provider_name=self.settings.get(CONF_PROVIDER_KEY, None)
-        )
-        if not isinstance(provider, AssetsProvider):
-            raise JumpserverError('Invalid provider {}'.format(provider))
-        for a in provider.list_assets():
-            provider_assets.append(a)
-            provider_assets_number[a.number] = len(provider_assets) - 1
-        # get all assets from Jumpserver by profile
-        jms_assets_number = {}
-        jms_assets = []
-        for a in self.agent.list_assets():
-            jms_assets.append(a)
-            comment = a.extract_comment()
-            if comment and self.META_PROFILE_KEY in comment and comment[self.META_PROFILE_KEY] == profile:
-                jms_assets_number[a.number] = len(jms_assets) - 1
-        # assets to add to Jumpserver
-        assets_to_add = [provider_assets[i] for n, i in provider_assets_number.items() if n not in jms_assets_number]
-        for a in assets_to_add:
-            a = self.agent.sync_asset(a)
-            if a:
-                assets.append(a)
-                # push system_user to assets
-                if self.settings.get(CONF_PUSH_KEY, False) is True:
-                    users = self.settings.get(CONF_PUSH_SYSTEM_USERS_KEY, None)
-                    if users:
-                        logging.info('Push system users {} to asset {}'.format(users, a))
-                        self.agent.push_system_users(asset_id=a.id, system_users=users)
-                    else:
-                        logging.info('Push all system users to asset {}'.format(a))
-                        self.agent.push_system_users(asset_id=a.id)
-        logging.info('Sync {} assets'.format(len(assets)))
-        # assets to delete in Jumpserver
-        del_num = 0
-        assets_to_del = [jms_assets[i] for n, i in jms_assets_number.items() if n not in provider_assets_number]
-        for a in assets_to_del:
-            res = self.agent.delete_asset(a.id)
-            if res:
-                del_num += 1
-        logging.info('Delete {} assets'.format(del_num))
-        return assets
+        journal = self.open_journal()
+        try:
+            return self._sync_assets(journal)
+        finally:
+            journal.close()
+
+    def _sync_assets(self, journal):
+        providers = self.get_asset_providers()
+        # get all assets from providers of all profiles concurrently
+        executor = ConcurrentExecutor(concurrency=len(providers), name='profile')
+        listed = executor.map(lambda p: list(p.list_assets()), list(providers.values()))
+        executor.report_errors()
+        provider_assets = {}
+        for profile, assets in zip(providers, listed):
+            if assets is None:
+                # assets of profile are not deleted if provider failed
+                logging.error('Skip profile {} because failed to list assets'.format(profile))
+                continue
+            provider_assets[profile] = {a.number: a for a in assets}
+        # get number to id and fingerprint map of Jumpserver assets, sliced by profile,
+        # assets are listed page by page or from mirror only once for all profiles
+        jms_assets = {p: {} for p in provider_assets}
+        shard = self.shard
+        if len(providers) == 1:
+            profile = next(iter(providers))
+            assets = ((profile, a) for a in self.agent.select_assets(meta={self.META_PROFILE_KEY: profile}))
+        else:
+            assets = ((self.get_asset_profile(a), a) for a in self.agent.select_assets())
+        for profile, a in assets:
+            # assets of other shards are neither updated nor deleted
+            if profile in jms_assets and (shard is None or shard.contains(a.number)):
+                jms_assets[profile][a.number] = (a.id, self.agent.fingerprint(a))
+        assets_to_add = []
+        assets_to_del = []
+        exists = []
+        skipped = 0
+        for profile, numbers in provider_assets.items():
+            jms_numbers = jms_assets[profile]
+            completed = set(n for n, a in numbers.items() if journal.is_completed(a))
+            # assets to add to Jumpserver
+            to_add = [a for n, a in numbers.items() if n not in jms_numbers]
+            # assets completed by interrupted sync are not linked and compared again
+            to_check = [a for n, a in numbers.items() if n in jms_numbers and n not in completed]
+            # assets to delete in Jumpserver
+            to_del = [aid for n, (aid, _) in jms_numbers.items() if n not in numbers]
+            skipped += len([n for n in numbers if n in jms_numbers and n in completed])
+            if len(provider_assets) > 1:
+                logging.info('Profile {}: {} assets in provider, {} to add, {} to check, {} to delete'.format(
+                    profile, len(numbers), len(to_add), len(to_check), len(to_del)))
+            assets_to_add += to_add
+            assets_to_del += to_del
+            exists += [(a, jms_numbers[a.number]) for a in to_check]
+        # assets changed in provider
+        assets_to_update = []
+        unchanged = 0
+        self.agent.executor.map(lambda x: x if self.agent.is_asset_linked(x) else self.agent.link_asset(x),
+                                [a for a, _ in exists])
+        for a, (aid, fingerprint) in exists:
+            if self.agent.fingerprint(a) == fingerprint:
+                unchanged += 1
+                journal.complete(a)
+            else:
+                a.set_attr('id', aid)
+                assets_to_update.append(a)
+        assets = self.sync_many(assets_to_add)
+        updated = self.update_many(assets_to_update)
+        del_num = self.delete_many(assets_to_del)
+        for a in assets + updated:
+            journal.complete(a)
+        logging.info('Added {} assets, updated {} assets, {} assets unchanged, deleted {} assets, '
+                     'skipped {} assets completed before'.format(len(assets), len(updated), unchanged, del_num,
+                                                                 skipped))
+        if len(provider_assets) == len(providers) and len(assets) == len(assets_to_add) \
+                and len(updated) == len(assets_to_update) and del_num == len(assets_to_del):
+            # all assets are completed, nothing to resume
+            journal.finish()
+        if len(provider_assets) < len(providers):
+            raise JumpserverError('Failed to list assets of {} profiles'.format(len(providers) - len(provider_assets)))
+        return assets + updated
 
 
 class AssetsListenSync(AssetsSync):
@@ -284,13 +631,41 @@ class AssetsListenSync(AssetsSync):
 
     PROVIDER_TYPE = 'task'
 
+    DEFAULT_PAUSE_INTERVAL = 3
+
     def run(self):
         listen_provider = self.settings.get(CONF_LISTEN_PROVIDER_KEY, None)
         listen_inv = self.settings.get(CONF_LISTEN_INTERVAL_KEY, None)
+        breaker = get_breaker(self.settings)
+        try:
+            self.preload()
+        except JumpserverError as e:
+            logging.error(e)
+        try:
+            self.listen(breaker, listen_provider, listen_inv)
+        finally:
+            self.report()
+
+    def listen(self, breaker, listen_provider=None, listen_inv=None):
+        """
+        Consume tasks until interrupted.
+
+        :param breaker: CircuitBreaker
+        :param listen_provider: provider name, all listening providers if None
+        :param listen_inv: seconds between two rounds
+        :return:
+        """
         while True:
+            if not self.is_jumpserver_available(breaker):
+                # pause consuming tasks while Jumpserver is down, tasks are kept in queue
+                time.sleep(max(min(breaker.remaining(), listen_inv or self.DEFAULT_PAUSE_INTERVAL), 0.1))
+                continue
             try:
                 for provider in self.get_task_provider(provider=listen_provider):
                     for task in provider.generate():
+                        if breaker.state == breaker.OPEN:
+                            logging.warning('Jumpserver is not available, skip task {}'.format(task))
+                            continue
                         if self.process_task(task=task):
                             provider.finish_task(task=task)
                         else:
@@ -304,14 +679,41 @@ class AssetsListenSync(AssetsSync):
             except ImportError as e2:
                 logging.error(e2)
 
+    def is_jumpserver_available(self, breaker):
+        """
+        Check circuit breaker, send probe request if cool-down is reached.
+
+        :param breaker: CircuitBreaker
+        :return: bool
+        """
+        if breaker.state == breaker.CLOSED:
+            return True
+        if breaker.remaining() > 0:
+            return False
+        return self.agent.get_client(key='asset', client_cls=Asset).ping()
+
     def process_task(self, task):
+        """
+        Run workflow for task.
+        Task is failed to be redelivered if workflow raises or Jumpserver requests failed while running,
+        including errors of single assets collected by workflow.
+
+        :param task:
+        :return: bool
+        """
+        breaker = get_breaker(task.task_settings)
+        failures = breaker.stats['failures']
         try:
             workflow_cls = import_string(task.workflow_cls)
             workflow = workflow_cls(settings=task.task_settings)
-            workflow.run()
-            return True
+            workflow.run_task()
         except Exception as e:
+            logging.error('Failed to process task {}: {}'.format(task, e))
+            return False
+        if breaker.state != breaker.CLOSED or breaker.stats['failures'] > failures:
+            logging.error('Jumpserver requests failed while processing task {}, task will be redelivered'.format(task))
             return False
+        return True
 
     def get_task_provider(self, provider=None):
         if provider:
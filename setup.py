@@ -34,6 +34,9 @@ static_setup_params = dict(
         'boto3',
         'pyyaml'
     ],
+    extras_require={
+        'fast': ['orjson']
+    },
     entry_points={
         'console_scripts': [
             'jumpserver_sync = jumpserver_sync.application:cli'
@@ -1,6 +1,14 @@
 import os
 import sys
 import random
+import asyncio
+import threading
+import time
+import json
+import re
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingTCPServer, StreamRequestHandler
 
 
 sys.path.insert(0, os.path.abspath('lib'))
@@ -8,9 +16,24 @@ sys.path.insert(0, os.path.abspath('lib'))
 import pytest
 from hsettings import Settings
 from jumpserver_sync.jumpserver import LabelTag
-from jumpserver_sync.jumpserver.clients import JumpserverClient, AdminUser, Domain, Node, Asset, Label, SystemUser
-from jumpserver_sync.assets import InstanceAsset, AssetAgent
-from jumpserver_sync.providers.base import CompiledTag, TagSelector, AssetsProvider, TaskProvider, get_provider
+from jumpserver_sync.jumpserver.clients import RestfulResource, CachedResource, JumpserverClient, AdminUser, Domain, Node, \
+    NodeTree, Asset, Label, SystemUser, Celery, TaskLog, TaskMonitor
+from jumpserver_sync.jumpserver.transport import HttpTransport
+from jumpserver_sync.jumpserver.auth import TokenManager
+from jumpserver_sync.jumpserver.policy import TokenBucket, RequestPolicy
+from jumpserver_sync.jumpserver.codec import dumps, loads, iter_json_array
+from jumpserver_sync.jumpserver.singleflight import SingleFlight, AsyncSingleFlight
+from jumpserver_sync.jumpserver.breaker import CircuitBreaker, get_breaker
+from jumpserver_sync.jumpserver.async_clients import AsyncRunner, get_runner, run_coroutine
+from jumpserver_sync.assets import InstanceAsset, AssetAgent, AsyncAssetAgent
+from jumpserver_sync.cache import LRUCache, TieredCache, RespClient, RedisBackend, get_cache
+from jumpserver_sync.mirror import AssetMirror
+from jumpserver_sync.workflow import AssetsSync, AssetsSmartSync, AssetsListenSync
+from jumpserver_sync.executor import ConcurrentExecutor
+from jumpserver_sync.pipeline import Stage, Pipeline
+from jumpserver_sync.journal import SyncJournal, remove_stale_journals
+from jumpserver_sync.payloads import PayloadStore, get_payload_store
+from jumpserver_sync.providers.base import CompiledTag, TagSelector, AssetsProvider, TaskProvider, Task, get_provider
 from jumpserver_sync.utils import *
 
 
@@ -31,6 +54,126 @@ aws_region_name = 'us-east-1'
 aws_sqs_url = 'https://sqs.us-east-1.amazonaws.com/006694404643/ops_test'
 
 
+class LocalHandler(BaseHTTPRequestHandler):
+    """
+    Local stand-in for Jumpserver API, replies with the response set on server.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.methods.append(self.command)
+        # request of current handler thread
+        self.server.local.method = self.command
+        self.server.headers.append(dict(self.headers))
+        status, body = self.server.reply(self.path) if callable(self.server.reply) else self.server.reply
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        self.server.local.body = json.loads(body.decode('utf-8')) if body else None
+        self.server.bodies.append((self.command, self.path, self.server.local.body))
+        self.do_GET()
+
+    do_PUT = do_POST
+    do_PATCH = do_POST
+    do_DELETE = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def work_dir(tmp_path_factory, monkeypatch):
+    # default cache directories are relative, keep them out of the repository
+    monkeypatch.chdir(str(tmp_path_factory.mktemp('work')))
+
+
+@pytest.fixture()
+def local_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), LocalHandler)
+    server.requests = []
+    server.methods = []
+    server.local = threading.local()
+    server.headers = []
+    server.bodies = []
+    server.reply = (200, '[]')
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class LocalRespHandler(StreamRequestHandler):
+    """
+    Local stand-in for Redis protocol server, supports commands used by cache backend.
+    """
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                n = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(n + 2)[:-2])
+            self.server.commands.append(args[0].decode())
+            self.wfile.write(self.reply(args[0].decode().upper(), args[1:]))
+
+    def reply(self, cmd, args):
+        data = self.server.data
+        now = time.time()
+        for k in [k for k, (_, exp) in data.items() if exp is not None and exp <= now]:
+            del data[k]
+        if cmd in ('AUTH', 'SELECT'):
+            return b'+OK\r\n' if cmd == 'SELECT' or args[0] == b'secret' else b'-ERR invalid password\r\n'
+        if cmd == 'GET':
+            v = data.get(args[0])
+            return b'$-1\r\n' if v is None else b'$' + str(len(v[0])).encode() + b'\r\n' + v[0] + b'\r\n'
+        if cmd == 'PTTL':
+            v = data.get(args[0])
+            ttl = -2 if v is None else (-1 if v[1] is None else int((v[1] - now) * 1000))
+            return ':{}\r\n'.format(ttl).encode()
+        if cmd == 'SET':
+            exp = now + int(args[3]) / 1000 if len(args) > 3 else None
+            data[args[0]] = (args[1], exp)
+            return b'+OK\r\n'
+        if cmd == 'DEL':
+            return ':{}\r\n'.format(len([data.pop(k) for k in args if k in data])).encode()
+        if cmd == 'INCRBY':
+            v = int(data.get(args[0], (b'0', None))[0]) + int(args[1])
+            data[args[0]] = (str(v).encode(), None)
+            return ':{}\r\n'.format(v).encode()
+        if cmd == 'SCAN':
+            prefix = args[2][:-1]
+            keys = [k for k in data if k.startswith(prefix)]
+            return b'*2\r\n$1\r\n0\r\n*' + str(len(keys)).encode() + b'\r\n' + \
+                b''.join(b'$' + str(len(k)).encode() + b'\r\n' + k + b'\r\n' for k in keys)
+        return b'-ERR unknown command\r\n'
+
+
+@pytest.fixture()
+def resp_server():
+    server = ThreadingTCPServer(('127.0.0.1', 0), LocalRespHandler)
+    server.daemon_threads = True
+    server.data = {}
+    server.commands = []
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
 class TestAsset:
 
     def test_instance_asset(self):
@@ -54,6 +197,1383 @@ class TestAsset:
         assert asset.extract_comment() == pairs
 
 
+class TestTransport:
+
+    def test_keep_alive(self, local_server):
+        url = 'http://127.0.0.1:{}/api/'.format(local_server.server_port)
+        transport = HttpTransport(base_url=url, pool_size=2)
+        for _ in range(5):
+            res = transport.request(method='get', url=url)
+            assert res.status_code == 200
+        s = transport.stats()
+        assert s['requests'] == 5
+        assert s['connections'] == 1
+        assert s['reused'] == 4
+        transport.close()
+
+    def test_no_keep_alive(self, local_server):
+        url = 'http://127.0.0.1:{}/api/'.format(local_server.server_port)
+        transport = HttpTransport(base_url=url, keep_alive=False)
+        for _ in range(3):
+            transport.request(method='get', url=url)
+        assert transport.stats()['connections'] == 3
+        transport.close()
+
+
+class TestPagination:
+
+    @staticmethod
+    def paged_reply(total):
+        def reply(path):
+            q = parse_qs(urlparse(path).query)
+            if 'limit' not in q:
+                return 200, json.dumps([{'id': str(i)} for i in range(total)])
+            limit = int(q['limit'][0])
+            offset = int(q['offset'][0])
+            results = [{'id': str(i)} for i in range(offset, min(offset + limit, total))]
+            nxt = 'next' if offset + limit < total else None
+            return 200, json.dumps({'count': total, 'next': nxt, 'previous': None, 'results': results})
+        return reply
+
+    @pytest.mark.parametrize('prefetch', [False, True])
+    def test_iter_pages(self, local_server, prefetch):
+        local_server.reply = self.paged_reply(25)
+        settings = Settings()
+        settings.set(CONF_BASE_URL_KEY, 'http://127.0.0.1:{}'.format(local_server.server_port))
+        cli = RestfulResource(settings=settings)
+        cli.resource = 'api/assets/v1/assets'
+        pages = list(cli.iter_pages(page_size=10, prefetch=prefetch))
+        assert [len(p) for p in pages] == [10, 10, 5]
+        assert [r['id'] for r in cli.iter_resources(page_size=10)] == [str(i) for i in range(25)]
+        assert len(local_server.requests) == 6
+        assert list(cli.iter_pages(page_size=0)) == [[{'id': str(i)} for i in range(25)]]
+
+
+class TestAsyncClient:
+
+    def test_runner_bounded(self):
+        runner = AsyncRunner(pool_size=3)
+        lock = threading.Lock()
+        state = {'running': 0, 'max': 0}
+
+        def work(i):
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            time.sleep(0.05)
+            with lock:
+                state['running'] -= 1
+            return i
+
+        async def main():
+            return await asyncio.gather(*[runner.run(work, i) for i in range(10)])
+
+        assert run_coroutine(main()) == list(range(10))
+        assert state['max'] == 3
+        runner.shutdown()
+
+    def test_runner_pool_size(self):
+        settings = Settings()
+        settings.set(CONF_BASE_URL_KEY, 'http://127.0.0.1:1')
+        settings.set(CONF_POOL_SIZE_KEY, 7)
+        runner = get_runner(settings)
+        assert runner.pool_size == 7
+        assert get_runner(settings) is runner
+
+
+class TestTokenManager:
+
+    @staticmethod
+    def create_settings(server, cache_dir):
+        settings = Settings()
+        settings.set(CONF_BASE_URL_KEY, 'http://127.0.0.1:{}'.format(server.server_port))
+        settings.set(CONF_LOGIN_URL_KEY, '/api/users/v1/auth/')
+        settings.set(CONF_USER_KEY, 'admin')
+        settings.set(CONF_PWD_KEY, 'admin')
+        settings.set(CONF_CACHE_DIR_KEY, str(cache_dir))
+        return settings
+
+    @staticmethod
+    def auth_reply(tokens):
+        def reply(path):
+            if path.startswith('/api/users/v1/auth'):
+                tokens.append('token{}'.format(len(tokens)))
+                return 200, json.dumps({'token': tokens[-1], 'keyword': 'Bearer'})
+            return 200, '[]'
+        return reply
+
+    def test_token_in_memory(self, local_server, tmp_path):
+        tokens = []
+        local_server.reply = self.auth_reply(tokens)
+        manager = TokenManager(settings=self.create_settings(local_server, tmp_path))
+        assert manager.get_token() == 'token0'
+        assert manager.get_token() == 'token0'
+        assert len(local_server.requests) == 1
+        assert manager.expires_at - manager.issued_at == TokenManager.DEFAULT_TOKEN_TTL
+        # shared by another process
+        manager2 = TokenManager(settings=self.create_settings(local_server, tmp_path))
+        assert manager2.get_token() == 'token0'
+        assert len(local_server.requests) == 1
+        # refresh before expired
+        manager._expires_at = time.time() + manager.refresh_before - 1
+        assert manager.is_valid() is False
+        manager.invalidate(token='token0')
+        assert manager.get_token() == 'token1'
+        # invalidate outdated token is ignored
+        manager.invalidate(token='token0')
+        assert manager.get_token() == 'token1'
+        assert len(local_server.requests) == 2
+
+    def test_retry_unauthorized(self, local_server, tmp_path):
+        tokens = []
+        login = self.auth_reply(tokens)
+
+        def reply(path):
+            if path.startswith('/api/assets'):
+                if local_server.headers[-1].get('Authorization') == 'Bearer token0':
+                    return 401, '{"detail": "expired"}'
+                return 200, '[]'
+            return login(path)
+
+        local_server.reply = reply
+        cli = JumpserverClient(settings=self.create_settings(local_server, tmp_path))
+        cli.resource = 'api/assets/v1/assets'
+        assert cli.list_resources() == []
+        assert tokens == ['token0', 'token1']
+        assert cli.get_token() == 'token1'
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class TestRequestPolicy:
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=50, burst=5)
+        start = time.monotonic()
+        for _ in range(10):
+            bucket.acquire()
+        # 5 from burst, 5 more need about 0.1s
+        assert time.monotonic() - start >= 0.09
+
+    def test_retry(self):
+        policy = RequestPolicy(max_retries=3, backoff_factor=0.01)
+        responses = [FakeResponse(503), FakeResponse(429, {'Retry-After': '0'}), FakeResponse(200)]
+        res = policy.send(lambda: responses.pop(0), method='get')
+        assert res.status_code == 200
+        assert policy.stats['retries'] == 2
+        assert policy.stats['requests'] == 3
+
+    def test_retry_exhausted(self):
+        policy = RequestPolicy(max_retries=2, backoff_factor=0.01)
+        res = policy.send(lambda: FakeResponse(502), method='get')
+        assert res.status_code == 502
+        assert policy.stats['retries'] == 2
+        assert policy.stats['failures'] == 1
+        # post is only retried if request is not processed
+        policy = RequestPolicy(max_retries=2, backoff_factor=0.01)
+        res = policy.send(lambda: FakeResponse(502), method='post')
+        assert res.status_code == 502
+        assert policy.stats['retries'] == 0
+
+    def test_retry_after(self):
+        assert RequestPolicy.retry_after(FakeResponse(429, {'Retry-After': '3'})) == 3
+        assert RequestPolicy.retry_after(FakeResponse(429, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})) == 0
+        assert RequestPolicy.retry_after(FakeResponse(429)) == 0
+
+    def test_retry_after_longer_than_backoff(self):
+        policy = RequestPolicy(max_retries=3, backoff_factor=0.01, backoff_max=0.01, retry_after_max=1)
+        responses = [FakeResponse(503, {'Retry-After': '0.2'}), FakeResponse(200)]
+        start = time.monotonic()
+        assert policy.send(lambda: responses.pop(0), method='get').status_code == 200
+        assert time.monotonic() - start >= 0.2
+        # server asks to wait too long, response is returned without retry
+        res = policy.send(lambda: FakeResponse(429, {'Retry-After': '5'}), method='get')
+        assert res.status_code == 429
+        assert policy.stats['retries'] == 1
+        assert policy.stats['failures'] == 1
+
+
+class TestBulkSync:
+
+    @staticmethod
+    def linked_asset(i):
+        return InstanceAsset(
+            number='i-{}'.format(i),
+            hostname='host-{}'.format(i),
+            ip='10.0.0.{}'.format(i),
+            admin_user='admin', admin_user_id='a1',
+            domain='domain', domain_id='d1',
+            labels=['l'], label_ids=['l1'],
+            nodes=['n'], node_ids=['n1']
+        )
+
+    @pytest.mark.parametrize('bulk_status', [201, 405])
+    def test_bulk_sync(self, local_server, tmp_path, bulk_status):
+        settings = TestTokenManager.create_settings(local_server, tmp_path)
+        counter = {'id': 0}
+
+        def reply(path):
+            method, _, body = local_server.bodies[-1] if local_server.bodies else (None, None, None)
+            if path.startswith('/api/users/v1/auth'):
+                return 200, json.dumps({'token': 'token'})
+            if path.startswith('/api/assets/v1/assets/?hostname=host-0'):
+                return 200, json.dumps([{'id': 'exists-0'}])
+            if path.startswith('/api/assets/v1/assets/?'):
+                return 200, '[]'
+            if isinstance(body, list):
+                if bulk_status != 201:
+                    return bulk_status, '{"detail": "Method not allowed"}'
+                res = []
+                for d in body:
+                    counter['id'] += 1
+                    res.append(dict(d, id=d.get('id') or 'new-{}'.format(counter['id'])))
+                return (201 if method == 'POST' else 200), json.dumps(res)
+            counter['id'] += 1
+            return (201 if method == 'POST' else 200), json.dumps(dict(body, id=body.get('id') or 'one'))
+
+        local_server.reply = reply
+        agent = AssetAgent(settings)
+        assets = [self.linked_asset(i) for i in range(5)]
+        res = agent.bulk_sync_assets(assets, batch_size=2)
+        assert len(res) == 5
+        assert all(a is not None and a.id for a in res)
+        assert res[0].id == 'exists-0'
+        writes = [b for b in local_server.bodies if b[0] in ('POST', 'PUT') and 'auth' not in b[1]]
+        if bulk_status == 201:
+            # 4 assets to create in 2 batches, 1 asset to update one by one
+            assert [(m, len(b) if isinstance(b, list) else 1) for m, _, b in writes] == \
+                [('POST', 2), ('POST', 2), ('PUT', 1)]
+        else:
+            # first bulk rejected, then create one by one
+            assert len([w for w in writes if isinstance(w[2], list)]) == 1
+            assert len([w for w in writes if isinstance(w[2], dict)]) == 5
+
+
+class TestResourceIndex:
+
+    def test_index(self, local_server, tmp_path):
+        resources = {
+            'admin-user': [{'id': 'a1', 'name': 'admin'}, {'id': 'a2', 'name': 'root'}],
+            'domain': [{'id': 'd1', 'name': 'domain'}],
+            'labels': [{'id': 'l1', 'name': 'env', 'value': 'prod'}, {'id': 'l2', 'name': 'env', 'value': 'dev'}],
+            'system-user': [{'id': 's1', 'name': 'ops'}]
+        }
+
+        def reply(path):
+            if path.startswith('/api/users/v1/auth'):
+                return 200, json.dumps({'token': 'token'})
+            return 200, json.dumps(resources[path.split('/')[4]])
+
+        local_server.reply = reply
+        agent = AssetAgent(TestTokenManager.create_settings(local_server, tmp_path))
+        assert agent.get_admin_user_id('root') == 'a2'
+        assert agent.get_admin_user_name('a1') == 'admin'
+        assert agent.get_domain_id('domain') == 'd1'
+        assert agent.get_domain_name('d2') is None
+        assert agent.get_label_id(LabelTag('env', 'dev')) == 'l2'
+        assert agent.get_label_id({'key': 'env', 'value': 'prod'}) == 'l1'
+        assert agent.get_label_id(LabelTag('env', 'test')) is None
+        assert agent.get_label_name('l1') == LabelTag('env', 'prod')
+        assert agent.get_system_user_id('ops') == 's1'
+        assert agent.get_system_user_name('s1') == 'ops'
+        # one login and one list request for each resource
+        assert len(local_server.requests) == 5
+        # rebuilt after refresh window
+        agent._index_cache['domain'].expires_at = 0
+        agent.get_client('domain', Domain).clear_cache()
+        assert agent.get_domain_id('domain') == 'd1'
+        assert len(local_server.requests) == 6
+
+    def test_missing(self, local_server, tmp_path):
+        def reply(path):
+            if path.startswith('/api/users/v1/auth'):
+                return 200, json.dumps({'token': 'token'})
+            if path.startswith('/api/assets/v1/nodes'):
+                return 200, json.dumps(TestNodeTree.nodes)
+            return 200, '[]'
+
+        local_server.reply = reply
+        agent = AssetAgent(TestTokenManager.create_settings(local_server, tmp_path))
+        lookups = []
+        get_node_id = agent.get_node_id
+        agent.get_node_id = lambda n: lookups.append(n) or get_node_id(n)
+        for i in range(10):
+            a = agent.link_asset(InstanceAsset(number='i-{}'.format(i), labels=[LabelTag('env', 'prod')],
+                                               nodes=['Default/ops', 'Default/test']))
+            assert a.node_ids == ['n3'] and a.label_ids == []
+        # misses are looked up once
+        assert lookups.count('Default/test') == 1
+        assert agent.report_missing() == {('Label', 'env:prod'): 10, ('Node', 'Default/test'): 10}
+        assert agent.report_missing() == {}
+        agent._miss_cache.clear()
+        agent.link_asset(InstanceAsset(number='i-0', nodes=['Default/test']))
+        assert lookups.count('Default/test') == 2
+
+    def test_preload(self, local_server, tmp_path):
+        def reply(path):
+            if path.startswith('/api/users/v1/auth'):
+                return 200, json.dumps({'token': 'token'})
+            if path.startswith('/api/assets/v1/nodes'):
+                return 200, json.dumps(TestNodeTree.nodes)
+            return 200, json.dumps([{'id': '1', 'name': 'env', 'value': 'prod'}])
+
+        local_server.reply = reply
+        agent = AssetAgent(TestTokenManager.create_settings(local_server, tmp_path))
+        costs = run_coroutine(AsyncAssetAgent(agent.settings, agent=agent).preload())
+        assert set(costs.keys()) == {'token', 'admin_user', 'domain', 'label', 'node', 'system_user'}
+        assert len(local_server.requests) == 6
+        assert agent.get_label_id(LabelTag('env', 'prod')) == '1'
+        assert agent.get_node_id('Default/ops') == 'n3'
+        assert agent.get_domain_id('env') == '1'
+        assert len(local_server.requests) == 6
+
+
+class TestNodeTree:
+
+    nodes = [
+        {'id': 'n4', 'key': '1:2:3', 'value': 'prod'},
+        {'id': 'n1', 'key': '1', 'value': 'Default'},
+        {'id': 'n2', 'key': '1:1', 'value': 'dev'},
+        {'id': 'n3', 'key': '1:2', 'value': 'ops'},
+        {'id': 'n5', 'key': '1:1:1', 'value': 'prod'},
+        {'id': 'n6', 'key': '2:1', 'value': 'orphan'}
+    ]
+
+    def test_tree(self):
+        tree = NodeTree(self.nodes)
+        assert tree.find(['Default', 'ops', 'prod'])['id'] == 'n4'
+        assert tree.find(['Default', 'dev', 'prod'])['id'] == 'n5'
+        assert tree.find(['Default', 'test']) is None
+        assert tree.find(['orphan']) is None
+        assert tree.path('n4') == ['Default', 'ops', 'prod']
+        assert tree.path('n6') is None
+
+    def test_node_client(self, local_server, tmp_path):
+        def reply(path):
+            if path.startswith('/api/users/v1/auth'):
+                return 200, json.dumps({'token': 'token'})
+            if path.startswith('/api/assets/v1/nodes'):
+                return 200, json.dumps(self.nodes)
+            return 200, '{}'
+
+        local_server.reply = reply
+        cli = Node(settings=TestTokenManager.create_settings(local_server, tmp_path))
+        for _ in range(3):
+            assert cli.get_node_id('Default/ops/prod') == 'n4'
+            assert cli.get_node_full_name('n5') == 'Default/dev/prod'
+        # one login and one node listing
+        assert len(local_server.requests) == 2
+        local_server.reply = (201, '{"id": "n7"}')
+        cli.post_resource({'value': 'test'})
+        local_server.reply = reply
+        assert cli.get_node_id('Default/dev') == 'n2'
+        # tree is rebuilt after node created
+        assert len(local_server.requests) == 4
+
+
+class TestAssetMirror:
+
+    @staticmethod
+    def jms_asset(i, account='account1'):
+        return {
+            'id': 'id-{}'.format(i), 'number': 'i-{}'.format(i), 'hostname': 'host-{}'.format(i),
+            'ip': '10.0.0.{}'.format(i), 'comment': 'account={};region=us-east-1'.format(account),
+            'admin_user': 'a1', 'domain': 'd1', 'labels': [], 'nodes': ['n1']
+        }
+
+    def test_mirror(self, tmp_path):
+        mirror = AssetMirror(path=str(tmp_path / 'assets.sqlite3'), reconcile_interval=60)
+        assert mirror.is_stale() is True
+        assert mirror.reconcile((self.jms_asset(i), 'account1', 'us-east-1') for i in range(3)) == 3
+        assert mirror.is_stale() is False
+        assert mirror.is_stale(now=time.time() + 61) is True
+        mirror.put(self.jms_asset(3, 'account2'), 'account2', 'us-east-1')
+        assert mirror.get('id-1')['hostname'] == 'host-1'
+        assert mirror.find(hostname='host-2')['id'] == 'id-2'
+        assert mirror.find(number='i-9') is None
+        assert [a['id'] for a in mirror.select(account='account1')] == ['id-0', 'id-1', 'id-2']
+        assert [a['id'] for a in mirror.select(numbers=['i-1', 'i-3'], region='us-east-1')] == ['id-1', 'id-3']
+        mirror.delete('id-0')
+        assert mirror.count() == 3
+        with pytest.raises(ValueError):
+            mirror.find(comment='')
+        mirror.close()
+
+    def test_reconcile_unlocked(self, tmp_path):
+        mirror = AssetMirror(path=str(tmp_path / 'assets.sqlite3'))
+        mirror.reconcile((self.jms_asset(i), 'account1', 'us-east-1') for i in range(2))
+        reads = []
+
+        def rows():
+            for i in range(3):
+                if i == 1:
+                    # mirror is readable and written through while listing
+                    t = threading.Thread(target=lambda: reads.append(mirror.get('id-0')))
+                    t.start()
+                    t.join(timeout=5)
+                    mirror.put(self.jms_asset(9), 'account1', 'us-east-1')
+                    mirror.delete('id-0')
+                yield self.jms_asset(i), 'account1', 'us-east-1'
+
+        assert mirror.reconcile(rows()) == 3
+        assert [r['id'] for r in reads] == ['id-0']
+        assert sorted(a['id'] for a in mirror.select()) == ['id-1', 'id-2', 'id-9']
+        mirror.close()
+
+    def test_agent_mirror(self, local_server, tmp_path):
+        def reply(path):
+            if path.startswith('/api/users/v1/auth'):
+                return 200, json.dumps({'token': 'token'})
+            if path.startswith('/api/assets/v1/assets/?'):
+                return 200, json.dumps([self.jms_asset(i) for i in range(3)])
+            return 201, json.dumps(dict(self.jms_asset(5), comment='account=account2'))
+
+        local_server.reply = reply
+        settings = TestTokenManager.create_settings(local_server, tmp_path)
+        settings.set(CONF_PAGE_SIZE_KEY, 100)
+        settings.set(CONF_MIRROR_KEY, True)
+        agent = AssetAgent(settings)
+        for i in range(3):
+            assert agent.get_asset_id(InstanceAsset(hostname='host-{}'.format(i))) == 'id-{}'.format(i)
+        assert agent.get_asset_id(InstanceAsset(hostname='host-5')) is None
+        # one login and one listing to reconcile
+        assert len(local_server.requests) == 2
+        assert [a.id for a in agent.select_assets(meta={'account': 'account1'})] == ['id-0', 'id-1', 'id-2']
+        assert [a.id for a in agent.select_assets(numbers=['i-1'])] == ['id-1']
+        # written through
+        agent.create_asset(TestBulkSync.linked_asset(5))
+        assert agent.get_asset_id(InstanceAsset(hostname='host-5')) == 'id-5'
+        assert [a.id for a in agent.select_assets(meta={'account': 'account2'})] == ['id-5']
+        local_server.reply = (204, '')
+        agent.delete_asset('id-1')
+        assert agent.get_asset_id(InstanceAsset(id='id-1')) is None
+        assert len(local_server.requests) == 4
+
+
+class TestSmartSync:
+
+    class StaticProvider(AssetsProvider):
+
+        assets = []
+
+        def list_assets(self, asset_ids=None, **kwargs):
+            for a in self.assets:
+                yield a.clone()
+
+        def iter_instances(self, asset_ids=None):
+            return self.list_assets(asset_ids=asset_ids)
+
+        def select_asset(self, asset):
+            return [asset]
+
+    def test_fingerprint(self):
+        agent = AssetAgent(Settings())
+        a = TestBulkSync.linked_asset(1)
+        b = a.clone()
+        b.set_attr('label_ids', list(reversed(a.label_ids)))
+        b.set_attr('comment', 'account=account2')
+        assert agent.fingerprint(a) == agent.fingerprint(b)
+        b.set_attr('ip', '10.0.1.1')
+        assert agent.fingerprint(a) != agent.fingerprint(b)
+
+    def test_smart_sync(self, local_server, tmp_path, monkeypatch):
+        jms_assets = []
+        for i in range(3):
+            a = TestBulkSync.linked_asset(i)
+            jms_assets.append(dict(number=a.number, hostname=a.hostname, ip=a.ip, comment='account=account1',
+                                   id='id-{}'.format(i), admin_user='a1', domain='d1', labels=['l1'], nodes=['n1']))
+        provider_assets = [TestBulkSync.linked_asset(i) for i in (0, 1, 3)]
+        provider_assets[1].set_attr('ip', '10.0.1.1')
+
+        def reply(path):
+            method = local_server.methods[-1]
+            if path.startswith('/api/users/v1/auth'):
+                return 200, json.dumps({'token': 'token'})
+            if method == 'GET' and path.startswith('/api/assets/v1/assets/?limit'):
+                return 200, json.dumps(jms_assets)
+            if method == 'GET':
+                return 200, '[]'
+            if method == 'DELETE':
+                return 204, ''
+            _, _, body = local_server.bodies[-1]
+            return (201 if method == 'POST' else 200), json.dumps(dict(body, id=body.get('id') or 'id-new'))
+
+        local_server.reply = reply
+        settings = TestTokenManager.create_settings(local_server, tmp_path)
+        settings.set(CONF_PAGE_SIZE_KEY, 100)
+        settings.set(CONF_PROFILE_KEY, 'account1')
+        settings.set(CONF_PROFILES_KEY, {'account1': {'type': 'static'}})
+        self.StaticProvider.assets = provider_assets
+        monkeypatch.setattr('jumpserver_sync.workflow.get_provider',
+                            lambda settings, provider_type, provider_name: self.StaticProvider(
+                                settings, provider_type, provider_name))
+        assets = AssetsSmartSync(settings).sync_assets()
+        assert [a.id for a in assets] == ['id-new', 'id-1']
+        writes = [(m, p) for m, p in zip(local_server.methods, local_server.requests)
+                  if m != 'GET' and 'auth' not in p]
+        assert sorted(writes) == [('DELETE', '/api/assets/v1/assets/id-2/'), ('POST', '/api/assets/v1/assets/'),
+                                  ('PUT', '/api/assets/v1/assets/id-1/')]
+
+
+    def test_multi_profile(self, local_server, tmp_path, monkeypatch):
+        jms_assets = []
+        for i, account in enumerate(['a', 'a', 'b', 'c']):
+            a = TestBulkSync.linked_asset(i)
+            jms_assets.append(dict(number=a.number, hostname=a.hostname, ip=a.ip, comment='account=' + account,
+                                   id='id-{}'.format(i), admin_user='a1', domain='d1', labels=['l1'], nodes=['n1']))
+        changed = TestBulkSync.linked_asset(2)
+        changed.set_attr('ip', '10.0.1.2')
+        profile_assets = {'a': [TestBulkSync.linked_asset(0), TestBulkSync.linked_asset(4)], 'b': [changed]}
+
+        class ProfileProvider(AssetsProvider):
+
+            def list_assets(self, asset_ids=None, **kwargs):
+                for a in profile_assets[self.profile.profile_name]:
+                    yield a.clone()
+
+        def reply(path):
+            method = local_server.local.method
+            if path.startswith('/api/users/v1/auth'):
+                return 200, json.dumps({'token': 'token'})
+            if method == 'GET' and path.startswith('/api/assets/v1/assets/?limit'):
+                return 200, json.dumps(jms_assets)
+            if method == 'GET':
+                return 200, '[]'
+            if method == 'DELETE':
+                return 204, ''
+            body = local_server.local.body
+            return (201 if method == 'POST' else 200), json.dumps(dict(body, id=body.get('id') or 'id-new'))
+
+        def profile_settings(profile):
+            s = TestTokenManager.create_settings(local_server, tmp_path)
+            s.set(CONF_PROFILE_KEY, profile)
+            s.set(CONF_PROFILES_KEY, profiles)
+            return s
+
+        local_server.reply = reply
+        profiles = {'a': {'type': 'static'}, 'b': {'type': 'static'}, 'c': {'type': 'static'}}
+        settings = profile_settings('a,b')
+        settings.set(CONF_PAGE_SIZE_KEY, 100)
+        monkeypatch.setattr('jumpserver_sync.workflow.get_provider',
+                            lambda settings, provider_type, provider_name: ProfileProvider(
+                                settings, provider_type, provider_name))
+        workflow = AssetsSmartSync(settings)
+        monkeypatch.setattr(workflow, 'profile_settings', profile_settings)
+        assert workflow.get_profiles() == ['a', 'b']
+        assets = workflow.sync_assets()
+        assert [a.number for a in assets] == ['i-4', 'i-2']
+        # assets are listed once for all profiles
+        assert len([p for p in local_server.requests if p.startswith('/api/assets/v1/assets/?limit')]) == 1
+        writes = [(m, p) for m, p in zip(local_server.methods, local_server.requests)
+                  if m != 'GET' and 'auth' not in p]
+        # asset of profile c is not deleted
+        assert sorted(writes) == [('DELETE', '/api/assets/v1/assets/id-1/'), ('POST', '/api/assets/v1/assets/'),
+                                  ('PUT', '/api/assets/v1/assets/id-2/')]
+
+
+class TestShard:
+
+    def test_partition(self):
+        assert Shard.parse('') is None
+        for v in ('1', '4/4', 'a/b', '-1/2'):
+            with pytest.raises(JumpserverError):
+                Shard.parse(v)
+        shards = [Shard.parse('{}/4'.format(i)) for i in range(4)]
+        ids = ['i-{:017x}'.format(random.getrandbits(64)) for _ in range(200)]
+        owners = [[s.index for s in shards if s.contains(i)] for i in ids]
+        assert all(len(o) == 1 for o in owners)
+        assert len(set(o[0] for o in owners)) == 4
+
+    def test_sharded_smart_sync(self, local_server, tmp_path, monkeypatch):
+        jms_assets = [dict(number='i-{}'.format(i), hostname='host-{}'.format(i), ip='10.0.0.{}'.format(i),
+                           comment='account=account1', id='id-{}'.format(i), admin_user='a1', domain='d1',
+                           labels=['l1'], nodes=['n1']) for i in range(20)]
+
+        def reply(path):
+            method = local_server.local.method
+            if path.startswith('/api/users/v1/auth'):
+                return 200, json.dumps({'token': 'token'})
+            if method == 'GET' and path.startswith('/api/assets/v1/assets/?limit'):
+                return 200, json.dumps(jms_assets)
+            if method == 'DELETE':
+                return 204, ''
+            return 200, '[]'
+
+        local_server.reply = reply
+        settings = TestTokenManager.create_settings(local_server, tmp_path)
+        settings.set(CONF_PAGE_SIZE_KEY, 100)
+        settings.set(CONF_PROFILE_KEY, 'account1')
+        settings.set(CONF_PROFILES_KEY, {'account1': {'type': 'static'}})
+        settings.set(CONF_SHARD_KEY, '1/3')
+        TestSmartSync.StaticProvider.assets = []
+        monkeypatch.setattr('jumpserver_sync.workflow.get_provider',
+                            lambda settings, provider_type, provider_name: TestSmartSync.StaticProvider(
+                                settings, provider_type, provider_name))
+        AssetsSmartSync(settings).sync_assets()
+        deleted = sorted(p for m, p in zip(local_server.methods, local_server.requests) if m == 'DELETE')
+        shard = Shard(1, 3)
+        assert deleted == sorted('/api/assets/v1/assets/{}/'.format(a['id']) for a in jms_assets
+                                 if shard.contains(a['number']))
+        provider = TestSmartSync.StaticProvider(settings, 'asset', 'static')
+        assert [provider.in_shard(InstanceAsset(number=a['number'])) for a in jms_assets] == \
+            [shard.contains(a['number']) for a in jms_assets]
+        other = next(a for a in jms_assets if not shard.contains(a['number']))
+        assert AssetsProvider.select_asset(provider, InstanceAsset(number=other['number'])) == []
+
+
+class TestPayloadStore:
+
+    def test_diff(self):
+        store = PayloadStore(TieredCache(memory_size=10))
+        payload = {'id': 'id-1', 'hostname': 'host-1', 'ip': '10.0.0.1', 'labels': ['l1', 'l2']}
+        assert store.diff('i-1', payload) is None
+        store.put('i-1', payload)
+        assert store.diff('i-1', dict(payload, id=None, labels=['l2', 'l1'])) == {}
+        assert store.diff('i-1', dict(payload, ip='10.0.1.1')) == {'ip': '10.0.1.1'}
+        assert store.diff('i-1', {'hostname': 'host-1', 'ip': '10.0.0.1'}) is None
+        # payloads of another Jumpserver sharing the cache are separated
+        other = PayloadStore(store.cache, scope='http://other')
+        assert other.get('i-1') is None
+        other.put('i-1', dict(payload, ip='10.0.1.1'))
+        assert store.diff('i-1', payload) == {}
+
+    def test_update_asset(self, local_server, tmp_path):
+        def reply(path):
+            if path.startswith('/api/users/v1/auth'):
+                return 200, json.dumps({'token': 'token'})
+            # full asset is returned for partial update
+            body = dict(hostname='host-1', ip='10.0.0.1', admin_user='a1', domain='d1', labels=['l1'], nodes=['n1'])
+            body.update(local_server.local.body)
+            return 200, json.dumps(dict(body, id='id-1'))
+
+        local_server.reply = reply
+        settings = TestTokenManager.create_settings(local_server, tmp_path)
+        agent = AssetAgent(settings)
+        asset = TestBulkSync.linked_asset(1)
+        agent.update_asset('id-1', asset)
+        agent.update_asset('id-1', asset.clone())
+        changed = asset.clone()
+        changed.set_attr('ip', '10.0.1.1')
+        agent.update_asset('id-1', changed)
+        writes = [(m, b) for m, _, b in local_server.bodies if m != 'POST']
+        assert [m for m, _ in writes] == ['PUT', 'PATCH']
+        assert writes[1][1] == {'ip': '10.0.1.1'}
+        assert agent.report_writes() == {'skipped': 1, 'patched': 1}
+        # force to write
+        settings.set(CONF_FORCE_WRITE_KEY, True)
+        AssetAgent(settings).update_asset('id-1', changed.clone())
+        assert local_server.bodies[-1][0] == 'PUT'
+        # payload is removed with asset
+        assert get_payload_store(settings).get('id-1') is not None
+        local_server.reply = (204, '')
+        assert agent.delete_asset('id-1') is True
+        assert get_payload_store(settings).get('id-1') is None
+
+
+class TestPipeline:
+
+    def test_stages(self):
+        def double(i):
+            if i == 7:
+                raise ValueError('bad item')
+            return i * 2
+
+        batches = []
+        stages = [
+            Stage('double', double, concurrency=3),
+            Stage('drop', lambda i: i if i % 4 == 0 else None),
+            Stage('batch', lambda b: batches.append(len(b)) or b, concurrency=2, batch_size=4),
+            Stage('expand', lambda i: [i, i + 1], expand=True),
+        ]
+        pipeline = Pipeline(source=range(20), stages=stages, queue_size=2)
+        res = sorted(pipeline.run())
+        expected = [j for i in range(20) if i != 7 and i % 2 == 0 for j in (i * 2, i * 2 + 1)]
+        assert res == expected
+        assert max(batches) <= 4 and sum(batches) == 10
+        assert stages[0].stats['in'] == 20 and stages[0].stats['failed'] == 1
+        assert stages[1].stats['out'] == 10
+        errors = stages[0].report()
+        assert [i for i, _ in errors] == [7]
+
+    def test_streaming(self):
+        events = []
+        lock = threading.Lock()
+        produced = []
+
+        def source():
+            for i in range(100):
+                produced.append(i)
+                yield i
+
+        def stage(name, delay):
+            def func(i):
+                time.sleep(delay)
+                with lock:
+                    events.append((name, i))
+                return i
+            return Stage(name, func)
+
+        pipeline = Pipeline(source=source(), stages=[stage('write', 0.001), stage('check', 0.002)], queue_size=2)
+        outputs = pipeline.run()
+        first = next(outputs)
+        # bounded by queues and items in workers
+        assert len(produced) <= 10
+        rest = list(outputs)
+        assert sorted([first] + rest) == list(range(100))
+        # first asset is checked while others are still written
+        assert events.index(('check', 0)) < events.index(('write', 99))
+
+    def test_sync_workflow(self, local_server, tmp_path, monkeypatch):
+        def reply(path):
+            if path.startswith('/api/users/v1/auth'):
+                return 200, json.dumps({'token': 'token'})
+            if local_server.local.method == 'GET':
+                return 200, '[]'
+            body = local_server.local.body
+            if isinstance(body, dict):
+                return 201, json.dumps(dict(body, id='id-' + body['number']))
+            return 201, json.dumps([dict(d, id='id-' + d['number']) for d in body])
+
+        local_server.reply = reply
+        settings = TestTokenManager.create_settings(local_server, tmp_path)
+        settings.set(CONF_CONCURRENCY_KEY, 3)
+        settings.set(CONF_BULK_SIZE_KEY, 4)
+        settings.set(CONF_PROFILE_KEY, 'account1')
+        settings.set(CONF_PROFILES_KEY, {'account1': {'type': 'static'}})
+        TestSmartSync.StaticProvider.assets = [TestBulkSync.linked_asset(i) for i in range(10)]
+        monkeypatch.setattr('jumpserver_sync.workflow.get_provider',
+                            lambda settings, provider_type, provider_name: TestSmartSync.StaticProvider(
+                                settings, provider_type, provider_name))
+        assets = AssetsSync(settings).sync_assets()
+        assert sorted(a.id for a in assets) == sorted('id-i-{}'.format(i) for i in range(10))
+        assert 'POST' in local_server.methods
+
+
+class TestTaskMonitor:
+
+    @staticmethod
+    def celery_reply(logs, polls):
+        def reply(path):
+            if path.startswith('/api/users/v1/auth'):
+                return 200, json.dumps({'token': 'token'})
+            u = urlparse(path)
+            parts = u.path.strip('/').split('/')
+            if parts[-1] == 'log':
+                task_id = parts[-2]
+                polls[task_id] = polls.get(task_id, 0) + 1
+                data = logs(task_id, polls[task_id])
+                # output after last read of mark
+                mark = parse_qs(u.query).get('mark', ['mark-' + task_id])[0]
+                offset = marks.get(mark, 0)
+                marks[mark] = len(data)
+                return 200, json.dumps({'data': data[offset:], 'mark': mark, 'end': False})
+            return 200, '[]'
+        marks = {}
+        return reply
+
+    def test_monitor(self, local_server, tmp_path):
+        def logs(task_id, n):
+            if task_id == 'slow':
+                return 'running\r\n' * n
+            # task i is finished after polled i times, markers are split by reads
+            out = 'TASK [ping] \r\nok: [host]\r\nTask finished'
+            return out[:len(out) * n // int(task_id)]
+
+        polls = {}
+        local_server.reply = self.celery_reply(logs, polls)
+        monitor = TaskMonitor(Celery(settings=TestTokenManager.create_settings(local_server, tmp_path)))
+        monitor.INITIAL_DELAY = 0.05
+        done = []
+        futures = [monitor.submit(str(i), timeout=5, interval=0.1, callback=done.append, markers=Asset.markers())
+                   for i in range(1, 6)]
+        slow = monitor.submit('slow', timeout=0.5, interval=0.1)
+        for f in futures:
+            assert Asset.check_result(f.result(timeout=5)) is True
+        assert slow.result(timeout=5).finished is False
+        assert slow.result().output == 'running\r\n' * polls['slow']
+        assert len(done) == 5
+        assert [polls[str(i)] for i in range(1, 6)] == [1, 2, 3, 4, 5]
+        assert monitor.stats['finished'] == 5 and monitor.stats['timeout'] == 1
+        assert monitor.pending() == 0
+
+    def test_concurrent_polls(self, local_server, tmp_path):
+        polls = {}
+        reply = self.celery_reply(lambda task_id, n: 'Task finished', polls)
+
+        def slow_reply(path):
+            time.sleep(0.2)
+            return reply(path)
+
+        local_server.reply = slow_reply
+        monitor = TaskMonitor(Celery(settings=TestTokenManager.create_settings(local_server, tmp_path)), concurrency=4)
+        monitor.INITIAL_DELAY = 0.05
+        start = time.monotonic()
+        futures = [monitor.submit(str(i), timeout=5, interval=0.1) for i in range(8)]
+        assert all(f.result(timeout=5).finished for f in futures)
+        # polls of due tasks are not sent one by one
+        assert time.monotonic() - start < 1.2
+        assert monitor.pending() == 0
+
+    def test_task_log(self):
+        markers = {'passed': [Asset.PASSED_FLAG, re.compile(Asset.PASSED_PATTERN)], 'error': ['ObjectDoesNotExist']}
+        task_log = TaskLog('t1', markers=markers, max_size=10)
+        for c in ['TASK [pi', 'ng] \r', '\nok', ': [host]\r\n']:
+            task_log.feed(c, mark='m1')
+        assert task_log.matched == {'passed'}
+        assert not task_log.finished
+        task_log.feed('x' * 20, mark='m1', end=True)
+        assert task_log.finished and task_log.truncated
+        assert task_log.output == 'x' * 10
+        # whole output is read again if mark may be expired
+        task_log = Celery.new_task_log('t2')
+        assert task_log.feed('running\r\n', mark='m2', whole=True) == 'running\r\n'
+        assert task_log.feed('running\r\nTask fin', mark='m2', whole=True) == 'Task fin'
+        assert not task_log.finished
+        task_log.feed('ished', mark='m2')
+        assert task_log.finished
+        assert task_log.output == 'running\r\nTask finished'
+
+    def test_mark_expired(self):
+        output = 'TASK [ping] \r\nok: [host]\r\nTask finished'
+        reads = []
+
+        def log(task_id, mark=None):
+            reads.append(mark)
+            if len(reads) == 1:
+                return {'data': 'Waiting task start'}
+            # server reads from beginning if mark is not given or expired
+            n = (len(reads) - 1) * 10
+            return {'data': output[:n] if mark is None else output[n - 10:n], 'mark': 'm1', 'end': False}
+
+        celery = Celery(settings=Settings())
+        celery.log = log
+        task_log = Celery.new_task_log('t1', markers=Asset.markers())
+        assert celery.read_log(task_log) is False
+        assert task_log.read_size == 0
+        celery.read_log(task_log)
+        celery.read_log(task_log)
+        # mark is expired
+        task_log.read_at -= Celery.MARK_TTL
+        while not celery.read_log(task_log):
+            pass
+        assert reads[:4] == [None, None, 'm1', None]
+        assert task_log.output == output
+        assert Asset.check_result(task_log) is True
+
+    def test_push_check_assets(self, local_server, tmp_path):
+        pushed = set()
+
+        def logs(task_id, n):
+            kind, asset_id = task_id.split('-')[:2]
+            if kind == 'test' and asset_id not in ('a1', ) and asset_id not in pushed:
+                return 'failed\r\nTask finished'
+            if kind == 'push':
+                pushed.add(asset_id)
+            return 'TASK [ping] \r\nok: [host]\r\nTask finished'
+
+        polls = {}
+        reply = self.celery_reply(logs, polls)
+        tasks = []
+
+        def system_user_reply(path):
+            parts = path.strip('/').split('/')
+            if path.startswith('/api/assets/v1/system-user/u1/asset/'):
+                tasks.append('{}-{}-{}'.format(parts[-1], parts[-2], len(tasks)))
+                return 200, json.dumps({'task': tasks[-1]})
+            if path.startswith('/api/assets/v1/system-user'):
+                return 200, json.dumps([{'id': 'u1', 'name': 'root'}])
+            return reply(path)
+
+        local_server.reply = system_user_reply
+        agent = AssetAgent(TestTokenManager.create_settings(local_server, tmp_path))
+        res = agent.push_check_assets(['a1', 'a2', 'a3'], timeout=5, interval=0.5, max_tries=2)
+        assert res == {('a1', 'u1'): True, ('a2', 'u1'): True, ('a3', 'u1'): True}
+        # failed assets are pushed together in one round
+        assert sorted(t.split('-')[1] for t in tasks if t.startswith('push')) == ['a2', 'a3']
+        assert len([t for t in tasks if t.startswith('test')]) == 5
+
+
+class TestJournal:
+
+    def test_resume(self, tmp_path):
+        path = str(tmp_path / 'journal.jsonl')
+        journal = SyncJournal(path, plan='plan-1').open()
+        assets = [TestBulkSync.linked_asset(i) for i in range(3)]
+        for a in assets:
+            assert journal.is_completed(a) is False
+        journal.complete(assets[0])
+        journal.complete(assets[1])
+        journal.close()
+        with open(path, 'a') as f:
+            f.write('["i-2", "abc')
+        journal = SyncJournal(path, plan='plan-1').open(resume=True)
+        assert len(journal) == 2
+        changed = assets[1].clone()
+        changed.set_attr('ip', '10.0.1.1')
+        assert [journal.is_completed(a) for a in (assets[0], changed, assets[2])] == [True, False, False]
+        journal.close()
+        assert len(SyncJournal(path, plan='plan-2').open(resume=True)) == 0
+        journal.finish()
+        assert not os.path.exists(path)
+
+    def test_stale(self, tmp_path):
+        for name in ('journal-old.jsonl', 'journal-new.jsonl', 'other.jsonl'):
+            (tmp_path / name).write_text('{}')
+        old = time.time() - SyncJournal.MAX_AGE - 60
+        for name in ('journal-old.jsonl', 'other.jsonl'):
+            os.utime(str(tmp_path / name), (old, old))
+        assert remove_stale_journals(str(tmp_path)) == 1
+        assert sorted(os.listdir(str(tmp_path))) == ['journal-new.jsonl', 'other.jsonl']
+
+    def test_sync_resume(self, local_server, tmp_path, monkeypatch):
+        failed = {'i-3'}
+
+        def reply(path):
+            if path.startswith('/api/users/v1/auth'):
+                return 200, json.dumps({'token': 'token'})
+            if local_server.local.method == 'GET':
+                return 200, '[]'
+            body = local_server.local.body
+            if body['number'] in failed:
+                return 400, json.dumps({'detail': 'bad asset'})
+            return 201, json.dumps(dict(body, id='id-' + body['number']))
+
+        local_server.reply = reply
+        settings = TestTokenManager.create_settings(local_server, tmp_path)
+        settings.set(CONF_BULK_SIZE_KEY, 1)
+        settings.set(CONF_PROFILE_KEY, 'account1')
+        settings.set(CONF_PROFILES_KEY, {'account1': {'type': 'static'}})
+        TestSmartSync.StaticProvider.assets = [TestBulkSync.linked_asset(i) for i in range(5)]
+        monkeypatch.setattr('jumpserver_sync.workflow.get_provider',
+                            lambda settings, provider_type, provider_name: TestSmartSync.StaticProvider(
+                                settings, provider_type, provider_name))
+        # no journal for sync of single instances
+        AssetsSync(settings).run_without_exception()
+        assert [f for f in os.listdir(str(tmp_path)) if f.startswith('journal-')] == []
+        n = len(local_server.bodies)
+        settings.set(CONF_INSTANCE_ALL_KEY, True)
+        AssetsSync(settings).run_without_exception()
+        posts = [b for b in local_server.bodies[n:] if b[0] == 'POST' and 'auth' not in b[1]]
+        assert len(posts) == 5
+        assert len([f for f in os.listdir(str(tmp_path)) if f.startswith('journal-')]) == 1
+        # only failed asset is synced again
+        failed.clear()
+        n = len(local_server.bodies)
+        settings.set(CONF_RESUME_KEY, True)
+        AssetsSync(settings).run_without_exception()
+        posts = [b for b in local_server.bodies[n:] if b[0] == 'POST' and 'auth' not in b[1]]
+        assert [b[2]['number'] for b in posts] == ['i-3']
+        assert [f for f in os.listdir(str(tmp_path)) if f.startswith('journal-')] == []
+
+    def test_source_error(self, local_server, tmp_path, monkeypatch):
+        def reply(path):
+            if path.startswith('/api/users/v1/auth'):
+                return 200, json.dumps({'token': 'token'})
+            if local_server.local.method == 'GET':
+                return 200, '[]'
+            return 201, json.dumps(dict(local_server.local.body, id='id-' + local_server.local.body['number']))
+
+        class BrokenProvider(TestSmartSync.StaticProvider):
+            def iter_instances(self, asset_ids=None):
+                for a in self.assets:
+                    yield a.clone()
+                raise JumpserverError('listing interrupted')
+
+        local_server.reply = reply
+        settings = TestTokenManager.create_settings(local_server, tmp_path)
+        settings.set(CONF_PROFILE_KEY, 'account1')
+        settings.set(CONF_PROFILES_KEY, {'account1': {'type': 'static'}})
+        settings.set(CONF_INSTANCE_ALL_KEY, True)
+        BrokenProvider.assets = [TestBulkSync.linked_asset(i) for i in range(2)]
+        monkeypatch.setattr('jumpserver_sync.workflow.get_provider',
+                            lambda settings, provider_type, provider_name: BrokenProvider(
+                                settings, provider_type, provider_name))
+        with pytest.raises(JumpserverError):
+            AssetsSync(settings).run_without_exception()
+        # listed assets are completed, journal is kept to resume
+        assert len([f for f in os.listdir(str(tmp_path)) if f.startswith('journal-')]) == 1
+
+
+class TestExecutor:
+
+    def test_map(self):
+        executor = ConcurrentExecutor(concurrency=4)
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def func(i):
+            with lock:
+                running.append(i)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(i)
+            if i % 5 == 0:
+                raise ValueError('bad item')
+            return i * 2
+
+        res = executor.map(func, range(20))
+        assert res == [None if i % 5 == 0 else i * 2 for i in range(20)]
+        assert max(peak) <= 4
+        errors = executor.report_errors()
+        assert sorted(i for i, _ in errors) == [0, 5, 10, 15]
+        assert executor.errors == []
+
+    def test_map_concurrency(self):
+        executor = ConcurrentExecutor(concurrency=4)
+        threads = set()
+        lock = threading.Lock()
+
+        def func(i):
+            with lock:
+                threads.add(threading.current_thread().ident)
+            time.sleep(0.01)
+            if i == 3:
+                raise ValueError('bad item')
+            return i
+
+        # run in caller thread, errors are still collected
+        assert executor.map(func, range(5), concurrency=1) == [0, 1, 2, None, 4]
+        assert threads == {threading.current_thread().ident}
+        assert len(executor.report_errors()) == 1
+
+    def test_interrupt(self):
+        executor = ConcurrentExecutor(concurrency=2)
+        done = []
+
+        def func(i):
+            if i == 0:
+                raise KeyboardInterrupt()
+            time.sleep(0.05)
+            done.append(i)
+
+        # interrupted in worker is raised by result
+        with pytest.raises(KeyboardInterrupt):
+            executor.map(func, range(10))
+        assert len(done) < 9
+
+    def test_concurrent_bulk_sync(self, local_server, tmp_path):
+        def reply(path):
+            if path.startswith('/api/users/v1/auth'):
+                return 200, json.dumps({'token': 'token'})
+            if local_server.local.method == 'GET':
+                return 200, '[]'
+            body = local_server.local.body
+            if isinstance(body, dict):
+                return 201, json.dumps(dict(body, id='id-' + body['number']))
+            return 201, json.dumps([dict(d, id='id-' + d['number']) for d in body])
+
+        local_server.reply = reply
+        settings = TestTokenManager.create_settings(local_server, tmp_path)
+        settings.set(CONF_CONCURRENCY_KEY, 4)
+        agent = AssetAgent(settings)
+        res = agent.bulk_sync_assets([TestBulkSync.linked_asset(i) for i in range(10)], batch_size=3)
+        assert [a.id for a in res] == ['id-i-{}'.format(i) for i in range(10)]
+
+
+class TestCodec:
+
+    def test_dumps_loads(self):
+        obj = {'hostname': '主机', 'labels': [1, 2.5, None, True]}
+        assert loads(dumps(obj)) == obj
+        assert loads(dumps(obj).decode('utf-8')) == obj
+
+    @pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 1024])
+    def test_iter_json_array(self, chunk_size):
+        items = [{'id': str(i), 'hostname': '主机-{}'.format(i), 'port': 22}
+                 for i in range(20)] + [12345, 'a,]b', [1, [2]]]
+        data = json.dumps(items, ensure_ascii=False, indent=1).encode('utf-8')
+        chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+        assert list(iter_json_array(chunks)) == items
+        assert list(iter_json_array([b'[', b' ]'])) == []
+
+    def test_iter_json_array_invalid(self):
+        with pytest.raises(ValueError):
+            list(iter_json_array([b'{"results": []}']))
+        with pytest.raises(ValueError):
+            list(iter_json_array([b'[{"id": 1}, {"id"']))
+
+    def test_stream_resources(self, local_server):
+        local_server.reply = TestPagination.paged_reply(30)
+        settings = Settings()
+        settings.set(CONF_BASE_URL_KEY, 'http://127.0.0.1:{}'.format(local_server.server_port))
+        cli = RestfulResource(settings=settings)
+        cli.resource = 'api/assets/v1/assets'
+        cli.STREAM_CHUNK_SIZE = 16
+        assert [r['id'] for r in cli.iter_resources(page_size=0)] == [str(i) for i in range(30)]
+        # compression is negotiated by requests
+        assert 'gzip' in local_server.headers[-1]['Accept-Encoding']
+
+
+class TestSingleFlight:
+
+    def test_threads(self):
+        flight = SingleFlight()
+        calls = []
+        barrier = threading.Barrier(8)
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.1)
+            return [{'id': '1'}]
+
+        results = []
+
+        def worker():
+            barrier.wait()
+            results.append(flight.do('nodes', fetch))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(calls) == 1
+        assert flight.shared == 7
+        assert all(r is results[0] for r in results)
+        # key is released after call finished
+        assert flight.do('nodes', fetch) == [{'id': '1'}]
+        assert len(calls) == 2
+
+    def test_threads_error(self):
+        flight = SingleFlight()
+
+        def fail():
+            raise ValueError('failed')
+
+        with pytest.raises(ValueError):
+            flight.do('key', fail)
+
+    def test_async(self):
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'labels'
+
+        async def main():
+            return await asyncio.gather(*[flight.do('labels', fetch) for _ in range(10)])
+
+        assert run_coroutine(main()) == ['labels'] * 10
+        assert len(calls) == 1
+        assert flight.shared == 9
+
+
+class TestCircuitBreaker:
+
+    def test_transitions(self):
+        breaker = CircuitBreaker(name='test', threshold=3, cooldown=0.1)
+        for _ in range(2):
+            assert breaker.allow() is True
+            breaker.record(False)
+        assert breaker.state == breaker.CLOSED
+        breaker.record(True)
+        for _ in range(3):
+            assert breaker.allow() is True
+            breaker.record(False)
+        assert breaker.state == breaker.OPEN
+        assert breaker.allow() is False
+        assert breaker.remaining() > 0
+        time.sleep(0.1)
+        # only one probe is allowed
+        assert breaker.allow() is True
+        assert breaker.state == breaker.HALF_OPEN
+        assert breaker.allow() is False
+        # probe failed
+        breaker.record(False)
+        assert breaker.state == breaker.OPEN
+        time.sleep(0.1)
+        assert breaker.allow() is True
+        breaker.record(True)
+        assert breaker.state == breaker.CLOSED
+        s = breaker.stats
+        assert s['opened'] == 2
+        assert s['half_opened'] == 2
+        assert s['closed'] == 1
+        assert s['rejected'] == 2
+
+    def test_late_request(self):
+        breaker = CircuitBreaker(name='test', threshold=1, cooldown=0.1)
+        assert breaker.allow() is True
+        breaker.record(False)
+        assert breaker.state == breaker.OPEN
+        time.sleep(0.1)
+        assert breaker.allow() is True
+        # requests started before opened finish while probing
+        late = threading.Thread(target=breaker.record, args=(True, ))
+        late.start()
+        late.join()
+        assert breaker.state == breaker.HALF_OPEN
+        late = threading.Thread(target=breaker.record, args=(False, ))
+        late.start()
+        late.join()
+        assert breaker.state == breaker.HALF_OPEN
+        assert breaker.allow() is False
+        breaker.record(True)
+        assert breaker.state == breaker.CLOSED
+
+    def test_listen_task(self, local_server, tmp_path, monkeypatch):
+        settings = TestTokenManager.create_settings(local_server, tmp_path)
+        breaker = get_breaker(settings)
+
+        class OpenWorkflow(AssetsSync):
+            def run_without_exception(self):
+                raise JumpserverCircuitOpenError('open')
+
+        class FailedWorkflow(AssetsSync):
+            def run_without_exception(self):
+                # error of single asset is collected by workflow
+                breaker.record(False)
+
+        class PassedWorkflow(AssetsSync):
+            def run_without_exception(self):
+                breaker.record(True)
+
+        preloads = []
+        monkeypatch.setattr(AssetsSync, 'preload', lambda self: preloads.append(self))
+        settings.set(CONF_PRELOAD_KEY, True)
+        listen = AssetsListenSync(settings)
+        task = Task(task_settings=settings, produced_by=None)
+        for workflow_cls, expected in [(OpenWorkflow, False), (FailedWorkflow, False), (PassedWorkflow, True)]:
+            monkeypatch.setattr('jumpserver_sync.workflow.import_string', lambda path: workflow_cls)
+            assert listen.process_task(task) is expected
+        # preloaded once by listener, not for each task
+        assert preloads == []
+
+    def test_client_open(self, local_server):
+        local_server.reply = (502, '{}')
+        settings = Settings()
+        settings.set(CONF_BASE_URL_KEY, 'http://127.0.0.1:{}/breaker'.format(local_server.server_port))
+        settings.set(CONF_MAX_RETRIES_KEY, 0)
+        settings.set(CONF_BREAKER_THRESHOLD_KEY, 2)
+        cli = RestfulResource(settings=settings)
+        cli.resource = 'api/assets/v1/assets'
+        assert cli.list_resources() == []
+        assert cli.ping() is False
+        with pytest.raises(JumpserverCircuitOpenError):
+            cli.list_resources()
+        assert len(local_server.requests) == 2
+
+
+class TestCache:
+
+    class CachedLabel(CachedResource):
+
+        resource = Label.resource
+        cache_name = Label.cache_name
+        cache_ttl = Label.cache_ttl
+
+    def test_lru_cache(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        # least recently used key is evicted
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        cache.set('d', 4, expire_at=time.time() - 1)
+        assert cache.get('d', 0) == 0
+        assert len(cache) == 1
+
+    def test_tiered_cache(self, tmp_path):
+        cache = TieredCache(directory=str(tmp_path), memory_size=2, ttl=60)
+        cache.set('a', {'id': 'a'})
+        cache.memory.clear()
+        # disk hit is kept in memory
+        assert cache.get('a') == {'id': 'a'}
+        assert cache.memory.get('a') == {'id': 'a'}
+        cache.set('b', 1, expire=0.1)
+        time.sleep(0.2)
+        assert cache.get('b') is None
+        assert cache.incr('v') == 1
+        assert cache.incr('v') == 2
+        # version increased by other process is seen at once
+        assert cache.get('v') == 2
+        cache.backend.incr('v')
+        assert cache.get('v') == 3
+        cache.set('n', 1, expire=0)
+        assert cache.memory.get('n') is None and cache.get('n') == 1
+        cache.delete('a')
+        assert cache.get('a') is None
+        cache.close()
+        memory = TieredCache(directory=None)
+        assert memory.incr('v') == 1
+        assert memory.incr('v') == 2
+
+    def test_invalidate(self, local_server, tmp_path):
+        local_server.reply = (200, '[{"id": "1", "name": "label"}]')
+        settings = Settings()
+        settings.set(CONF_BASE_URL_KEY, 'http://127.0.0.1:{}'.format(local_server.server_port))
+        settings.set(CONF_CACHE_DIR_KEY, str(tmp_path))
+        settings.set(CONF_CACHE_TTLS_KEY + '.label', 300)
+        cli = self.CachedLabel(settings=settings)
+        assert cli._cache_ttl == 300
+        assert cli.list_resources() == [{'id': '1', 'name': 'label'}]
+        assert cli.list_resources() == [{'id': '1', 'name': 'label'}]
+        assert len(local_server.requests) == 1
+        cli.delete_resource('1')
+        cli.list_resources()
+        assert len(local_server.requests) == 3
+
+
+class TestCacheBackend:
+
+    def test_resp_client(self, resp_server):
+        client = RespClient(port=resp_server.server_address[1], password='secret', db=1)
+        assert client.execute('SET', 'k', 'v') == 'OK'
+        assert client.pipeline([('GET', 'k'), ('PTTL', 'k'), ('GET', 'none')]) == [b'v', -1, None]
+        assert client.execute('INCRBY', 'n', 2) == 2
+        assert resp_server.commands[:2] == ['AUTH', 'SELECT']
+        # reconnect after connection lost
+        client._sock.close()
+        assert client.execute('GET', 'k') == b'v'
+        client.close()
+        with pytest.raises(CacheBackendError):
+            RespClient(port=resp_server.server_address[1], password='wrong').execute('GET', 'k')
+
+    def test_redis_backend(self, resp_server, tmp_path):
+        settings = Settings()
+        settings.set(CONF_CACHE_BACKEND_KEY, 'redis')
+        settings.set(CONF_CACHE_URL_KEY, 'redis://127.0.0.1:{}/0'.format(resp_server.server_address[1]))
+        settings.set(CONF_CACHE_PREFIX_KEY, 'test:')
+        cache = get_cache(settings)
+        assert isinstance(cache.backend, RedisBackend)
+        assert get_cache(settings) is cache
+        cache.set('token', {'token': 'abc'}, expire=30)
+        assert resp_server.data[b'test:token'][0] == b'{"token": "abc"}'
+        # shared by another process
+        other = TieredCache(backend=RedisBackend.from_url(settings.get(CONF_CACHE_URL_KEY), prefix='test:'))
+        assert other.get('token') == {'token': 'abc'}
+        assert 29 < other.memory._data['token'][1] - time.time() <= 30
+        assert other.incr('version') == 1
+        assert cache.incr('version') == 2
+        other.delete('token')
+        cache.memory.clear()
+        assert cache.get('token') is None
+        cache.set('a', 1)
+        cache.clear()
+        assert resp_server.data == {}
+        other.close()
+        # server not available is cache miss
+        resp_server.shutdown()
+        resp_server.server_close()
+        down = TieredCache(backend=RedisBackend.from_url(settings.get(CONF_CACHE_URL_KEY)))
+        assert down.get('a', 0) == 0
+        down.set('a', 1)
+        settings.set(CONF_CACHE_BACKEND_KEY, 'file')
+        with pytest.raises(JumpserverError):
+            get_cache(settings)
+
+
 class TestProvider:
 
     @pytest.fixture(scope='module')